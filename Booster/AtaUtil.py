@@ -46,6 +46,26 @@ def log_env(logfile):
             fhandle.write("%s=%s\n" % (key, os.environ[key]))
 
 
+def get_cache_dir(name):
+    """
+    Returns the agent local cache directory for name, the directory is created if it does not exist.
+    The cache root is BOOSTER_CACHE_DIR (or bamboo variable booster_cache_dir), default is ~/.booster/cache
+    :param name: (str) name of the cache, e.g. config
+    :return: absolute path of the cache directory
+    """
+    root = os.environ.get('BOOSTER_CACHE_DIR', os.environ.get('BAMBOO_BOOSTER_CACHE_DIR', ''))
+    if root.strip() == '':
+        root = os.path.join(os.path.expanduser('~'), '.booster', 'cache')
+    path = os.path.abspath(os.path.join(root, name))
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
+
+
 def setupFakeBambooEnv():
     env = {}
     with open('win_x64_bamboo_test_env.txt', 'r') as fhandle:
@@ -1,4 +1,6 @@
+from __future__ import print_function
 from Booster.Debug import Debug as Debugger
+from Booster import Incremental
 from Booster.Scope import Scope
 
 class Action(object):
@@ -18,6 +20,8 @@ class Action(object):
         self.root = root
         self.name = name
         self.skipmsg = None
+        self.dry = False
+        self.fingerprint = None
 
     def run(self, dry=False):
         """
@@ -26,6 +30,7 @@ class Action(object):
         :return:        None
         """
         scope = Scope(self.name)
+        self.dry = dry
         if not self._setup():
             return
         self._perform(dry)
@@ -33,12 +38,18 @@ class Action(object):
 
     def _setup(self):
         """
-        Prepare to perform an action. The default behavior is to check if the action is marked as skipped.
+        Prepare to perform an action. The default behavior is to check if the action is marked as skipped,
+        or if it's incremental and up to date.
 
         :return:    continue to perform only when it returns True
         """
         if Debugger().skip(self.name, self.skipmsg):
             return False
+        if not self.dry:
+            self.fingerprint = Incremental.fingerprint(self.root, self._inputs(), self._outputs())
+            if self.fingerprint is not None and self.fingerprint.upToDate():
+                print('----Skip: {} is up to date'.format(self.name))
+                return False
         return True
 
     def _perform(self, dry=False):
@@ -51,8 +62,23 @@ class Action(object):
 
     def _tear(self):
         """
-        Hood called after perform. Not very useful except for tracing
+        Hood called after perform. Saves the fingerprint of an incremental action
         :return:        None
         """
-        pass
+        if self.fingerprint is not None:
+            self.fingerprint.save()
+
+    def _inputs(self):
+        """
+        Default inputs of an incremental action, used if the element has no inputs attribute
+        :return:        list of files, directories or globs
+        """
+        return []
+
+    def _outputs(self):
+        """
+        Default outputs of an incremental action, used if the element has no outputs attribute
+        :return:        list of files or directories
+        """
+        return []
 
@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Registry of booster actions
+
+Maps a tag name to the callables performing it, so that build.process dispatches an element with a dictionary lookup
+instead of evaluating 'Booster.<tag>.Execute' for every node. Booster/__init__.py only registers the module names of
+the package; a module is imported on the first lookup of its tag (or by preload), and registered under its module
+name if it exposes Execute(root) (and optionally Debug(root)). The import cost of every loaded module is recorded.
+Other callables can be registered explicitly with register() or the action decorator, e.g.
+
+    @ActionRegistry.action('Hello')
+    def hello(root):
+        print('Hello ' + root.text)
+
+"""
+from __future__ import print_function
+import collections
+import importlib
+import time
+
+ActionEntry = collections.namedtuple('ActionEntry', ['tag', 'execute', 'debug', 'module'])
+
+_actions = {}
+_modules = {}           # tag: name of the module not imported yet
+_importCost = {}        # module name: seconds spent importing it
+
+
+def register(tag, execute=None, debug=None, module=None):
+    """
+    Register (or update) the callables of an action tag
+    :param tag:         tag name in build files
+    :param execute:     callable(root) performing the action, None to keep the registered one
+    :param debug:       callable(root) used when BOOSTERDEBUG is set, None to keep the registered one
+    :param module:      module implementing the action, e.g. to look up optional hooks such as getOutputs
+    :return:            the registry entry
+    """
+    entry = _actions.get(tag, ActionEntry(tag, None, None, None))
+    if execute is not None:
+        entry = entry._replace(execute=execute)
+    if debug is not None:
+        entry = entry._replace(debug=debug)
+    if module is not None:
+        entry = entry._replace(module=module)
+    _actions[tag] = entry
+    return entry
+
+
+def registerModule(module, tag=None):
+    """
+    Register a module exposing Execute(root), and optionally Debug(root)
+    :param module:      the module object
+    :param tag:         tag name, default is the module name
+    :return:            the registry entry, or None if the module isn't an action
+    """
+    execute = getattr(module, 'Execute', None)
+    if not callable(execute):
+        return None
+    if tag is None:
+        tag = module.__name__.split('.')[-1]
+    debug = getattr(module, 'Debug', None)
+    return register(tag, execute, debug if callable(debug) else None, module)
+
+
+def registerLazy(tag, moduleName):
+    """
+    Register a module that is imported on the first lookup of tag
+    :param tag:         tag name in build files
+    :param moduleName:  full name of the module, e.g. Booster.Copy
+    :return:            None
+    """
+    if tag not in _actions:
+        _modules[tag] = moduleName
+
+
+def load(tag):
+    """
+    Import the module registered for tag if it's not imported yet
+    :param tag:         tag name
+    :return:            the registry entry, or None if tag is not an action
+    """
+    moduleName = _modules.pop(tag, None)
+    if moduleName is None:
+        return _actions.get(tag)
+    start = time.time()
+    module = importlib.import_module(moduleName)
+    _importCost[moduleName] = time.time() - start
+    return registerModule(module, tag)
+
+
+def preload(tags):
+    """
+    Import the modules of all action tags in tags, e.g. the tags used by a build file
+    :param tags:        iterable of tag names
+    :return:            None
+    """
+    for tag in sorted(set(tags)):
+        if tag in _modules:
+            load(tag)
+
+
+def importCost():
+    """
+    Return the import cost of loaded modules, the most expensive first. Costs are inclusive, a module imported
+    by another one is counted in both
+    :return:            list of (module name, seconds)
+    """
+    return sorted(_importCost.items(), key=lambda c: c[1], reverse=True)
+
+
+def action(tag, debug=False):
+    """
+    Decorator registering a function as the Execute (or Debug) callable of tag
+    """
+    def decorator(f):
+        if debug:
+            register(tag, debug=f)
+        else:
+            register(tag, execute=f)
+        return f
+    return decorator
+
+
+def lookup(tag):
+    """
+    Return the registry entry of tag, or None if tag is not an action
+    """
+    entry = _actions.get(tag)
+    if entry is None and tag in _modules:
+        entry = load(tag)
+    return entry
+
+
+def tags():
+    """
+    Return all registered tag names, sorted. Modules not imported yet are included
+    """
+    return sorted(set(_actions.keys()) | set(_modules.keys()))
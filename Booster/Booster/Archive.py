@@ -0,0 +1,331 @@
+from __future__ import print_function
+"""
+    In-process archiver used by <Tar> and <Zip>
+
+    Entries are streamed from a sorted walk of the source, the file list is never built in memory. Data is
+    compressed by a pool of threads in chunks of CHUNK_SIZE bytes, pigz style: every chunk is an independent raw
+    deflate stream ended by a sync flush (the last one by a final block), so that the chunks of a gzip stream or
+    of a zip member are simply concatenated in order.
+
+    Entries are sorted and owners are dropped. Entries keep the modification time of their file, unless the
+    archive is reproducible (reproducible=True, or SOURCE_DATE_EPOCH set): every timestamp is then set to
+    SOURCE_DATE_EPOCH (default 1980-01-01, the earliest date zip supports).
+"""
+
+import collections
+import os
+import stat
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import ata.log
+
+logger = ata.log.AtaLog(__name__)
+
+CHUNK_SIZE = 1 << 20
+LEVEL = 6
+EPOCH = 315532800       # 1980-01-01
+
+
+def getEpoch(reproducible=False):
+    """
+    :return:    the timestamp of every entry of a reproducible archive, None to keep the timestamps of the files
+    """
+    value = os.environ.get('SOURCE_DATE_EPOCH')
+    if value is None and not reproducible:
+        return None
+    try:
+        return max(int(value or EPOCH), EPOCH)
+    except ValueError:
+        return EPOCH
+
+
+def walk(source, exclude_root=False, hidden=True, exclude=None):
+    """
+    Yield (arcname, path) of source and everything under it, sorted, a directory before its content.
+    Symlinked directories are yielded but not followed
+    :param source:          file or directory
+    :param exclude_root:    name entries relative to the source directory, instead of including its name
+    :param hidden:          with exclude_root, False to skip hidden entries at the top (like tar's *)
+    :param exclude:         path to leave out, e.g. the archive being written
+    """
+    exclude = os.path.abspath(exclude) if exclude else None
+    for arcname, path in _walk(source, exclude_root, hidden):
+        if exclude is None or os.path.abspath(path) != exclude:
+            yield arcname, path
+
+
+def _walk(source, exclude_root, hidden):
+    if not exclude_root:
+        name = os.path.basename(os.path.normpath(source))
+        yield name, source
+        if os.path.isdir(source) and not os.path.islink(source):
+            for entry in _walkDir(source, name):
+                yield entry
+        return
+    for name in sorted(os.listdir(source)):
+        if not hidden and name.startswith('.'):
+            continue
+        path = os.path.join(source, name)
+        yield name, path
+        if os.path.isdir(path) and not os.path.islink(path):
+            for entry in _walkDir(path, name):
+                yield entry
+
+
+def _walkDir(path, arcname):
+    for name in sorted(os.listdir(path)):
+        child = os.path.join(path, name)
+        yield arcname + '/' + name, child
+        if os.path.isdir(child) and not os.path.islink(child):
+            for entry in _walkDir(child, arcname + '/' + name):
+                yield entry
+
+
+def _deflate(data, level, final):
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class _Pipeline(object):
+    """
+    Ordered queue of compression jobs: callbacks are called in submission order with the result of their job,
+    at most depth jobs are in flight
+    """
+    def __init__(self, workers, depth=None):
+        self.pool = ThreadPool(max(1, workers))
+        self.depth = depth or max(1, workers) * 4
+        self.pending = collections.deque()
+
+    def deflate(self, data, final, callback):
+        self.put(self.pool.apply_async(_deflate, (data, LEVEL, final)), callback)
+
+    def put(self, job, callback):
+        self.pending.append((job, callback))
+        while len(self.pending) > self.depth:
+            self._pop()
+
+    def _pop(self):
+        job, callback = self.pending.popleft()
+        callback(job.get() if job is not None else None)
+
+    def drain(self):
+        while self.pending:
+            self._pop()
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+class GzipWriter(object):
+    """
+    File object writing a single member gzip stream compressed by a _Pipeline, e.g. the target of a stream tarfile
+    """
+    def __init__(self, fileobj, pipeline, mtime=None):
+        self.fileobj = fileobj
+        self.pipeline = pipeline
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32(b'') & 0xffffffff
+        self.size = 0
+        # no name, and no mtime (0) unless one is given for reproducible output
+        self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<L', mtime or 0) + b'\x00\xff')
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= CHUNK_SIZE:
+            self._submit(False)
+
+    def _submit(self, final):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pipeline.deflate(data, final, self.fileobj.write)
+
+    def close(self):
+        self._submit(True)
+        self.pipeline.drain()
+        self.fileobj.write(struct.pack('<LL', self.crc, self.size & 0xffffffff))
+
+
+def gzipFile(source, dest, workers=1):
+    """
+    Compress a single file, e.g. a core dump, chunks are deflated in parallel
+    :param source:      file to compress
+    :param dest:        gzip file
+    :param workers:     number of compressing threads
+    :return:            None
+    """
+    pipeline = _Pipeline(workers)
+    try:
+        with open(source, 'rb') as fin, open(dest, 'wb') as fout:
+            out = GzipWriter(fout, pipeline)
+            while True:
+                data = fin.read(CHUNK_SIZE)
+                if not data:
+                    break
+                out.write(data)
+            out.close()
+    finally:
+        pipeline.close()
+
+
+def _report(kind, archive, entries, size, start):
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info('{kind} {archive}: {entries} entries, {size} bytes -> {out} bytes in {elapsed:.1f}s ({rate:.1f} MB/s)'.format(
+        kind=kind, archive=archive, entries=entries, size=size, out=os.path.getsize(archive), elapsed=elapsed,
+        rate=size / elapsed / 1048576))
+
+
+def createTar(archive, source, exclude_root=False, compress=True, workers=1, reproducible=False):
+    """
+    Create a tar (or tar.gz) archive of source
+    :param archive:         archive file name, with its extension
+    :param source:          file or directory to archive
+    :param exclude_root:    archive the content of source directory, without hidden files at the top
+    :param compress:        gzip the archive
+    :param workers:         number of compressing threads
+    :param reproducible:    set every timestamp to SOURCE_DATE_EPOCH, see getEpoch
+    :return:                None
+    """
+    start = time.time()
+    epoch = getEpoch(reproducible)
+    entries = 0
+    size = 0
+    pipeline = _Pipeline(workers) if compress else None
+    with open(archive, 'wb') as fh:
+        out = GzipWriter(fh, pipeline, epoch) if compress else fh
+        try:
+            tar = tarfile.open(fileobj=out, mode='w|', format=tarfile.GNU_FORMAT)
+            try:
+                for arcname, path in walk(source, exclude_root, hidden=False, exclude=archive):
+                    info = tar.gettarinfo(path, arcname)
+                    if info is None:
+                        logger.warning('skip {}, sockets can not be archived'.format(path))
+                        continue
+                    if epoch is not None:
+                        info.mtime = epoch
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ''
+                    entries += 1
+                    if info.isreg():
+                        size += info.size
+                        with open(path, 'rb') as f:
+                            tar.addfile(info, f)
+                    else:
+                        tar.addfile(info)
+            finally:
+                tar.close()
+            if compress:
+                out.close()
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+    _report('tar', archive, entries, size, start)
+
+
+def createZip(archive, source, exclude_root=False, workers=1, reproducible=False):
+    """
+    Create a zip archive of source, members are compressed in parallel
+    :param archive:         archive file name, with its extension
+    :param source:          file or directory to archive
+    :param exclude_root:    archive the content of source directory
+    :param workers:         number of compressing threads
+    :param reproducible:    set every timestamp to SOURCE_DATE_EPOCH, see getEpoch
+    :return:                None
+    """
+    start = time.time()
+    epoch = getEpoch(reproducible)
+    entries = 0
+    size = 0
+    pipeline = _Pipeline(workers)
+    zf = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        for arcname, path in walk(source, exclude_root, exclude=archive):
+            try:
+                st = os.stat(path)      # like make_archive, symlinked files are archived with their content
+            except OSError as e:
+                logger.warning('skip {}: {}'.format(path, e))
+                continue
+            entries += 1
+            # zip timestamps are local times, from 1980
+            zinfo = zipfile.ZipInfo(arcname, time.gmtime(epoch)[0:6] if epoch is not None else
+                                    time.localtime(max(st.st_mtime, EPOCH + 86400))[0:6])
+            zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+            if stat.S_ISDIR(st.st_mode):
+                zinfo.filename += '/'
+                zinfo.external_attr |= 0x10
+                zinfo.compress_type = zipfile.ZIP_STORED
+                _ZipMember(zf, zinfo, False).add(pipeline)
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                size += _ZipMember(zf, zinfo, st.st_size * 1.05 > zipfile.ZIP64_LIMIT).add(pipeline, path)
+        pipeline.close()
+    finally:
+        pipeline.pool.terminate()
+        zf.close()
+    _report('zip', archive, entries, size, start)
+
+
+class _ZipMember(object):
+    """
+    Member written through the raw file of a ZipFile: the local header is written with placeholder sizes, and
+    rewritten once the compressed data is out
+    """
+    def __init__(self, zf, zinfo, zip64):
+        self.zf = zf
+        self.zinfo = zinfo
+        self.zip64 = zip64
+
+    def add(self, pipeline, path=None):
+        zinfo = self.zinfo
+        zinfo.file_size = zinfo.compress_size = 0
+        zinfo.CRC = 0
+        pipeline.put(None, self._header)
+        if path is None:
+            pipeline.put(None, self._finish)
+            return 0
+        crc = zlib.crc32(b'') & 0xffffffff
+        with open(path, 'rb') as fh:
+            data = fh.read(CHUNK_SIZE)
+            while True:
+                following = fh.read(CHUNK_SIZE) if data else b''
+                crc = zlib.crc32(data, crc) & 0xffffffff
+                zinfo.file_size += len(data)
+                pipeline.deflate(data, not following, self._write)
+                if not following:
+                    break
+                data = following
+        zinfo.CRC = crc
+        pipeline.put(None, self._finish)
+        return zinfo.file_size
+
+    def _header(self, result):
+        self.zinfo.header_offset = self.zf.fp.tell()
+        self.zf.fp.write(self.zinfo.FileHeader(self.zip64))
+
+    def _write(self, data):
+        self.zinfo.compress_size += len(data)
+        self.zf.fp.write(data)
+
+    def _finish(self, result):
+        zf = self.zf
+        end = zf.fp.tell()
+        zf.fp.seek(self.zinfo.header_offset)
+        zf.fp.write(self.zinfo.FileHeader(self.zip64))
+        zf.fp.seek(end)
+        zf.filelist.append(self.zinfo)
+        zf.NameToInfo[self.zinfo.filename] = self.zinfo
+        zf.start_dir = end      # python 3 writes the central directory there
+        zf._didModify = True
@@ -0,0 +1,329 @@
+from __future__ import print_function
+"""
+    Content-addressed cache of fetched artifacts, shared by the plans of an agent
+
+    Fetch steps (<Artifactory> downloads, <Extract> and <Copy> from network file systems) keep what they fetch in
+    the agent cache (see AtaUtil.get_cache_dir), keyed by what identifies the content:
+        remote artifact     url and checksum (or ETag), see urlKey
+        shared file         path, size and modification time, see fileKey
+    A repeated fetch is then a hardlink (or a reflink, or a local copy) of the cached file instead of a network
+    transfer.
+
+    The cache is bounded to BOOSTER_ARTIFACT_CACHE_MB megabytes (default 10240), the least recently used entries are
+    evicted first. The index is updated under a file lock, so that concurrent agents of a host share the cache.
+    Files are fetched and copied outside of the lock: a fetched file is renamed into place, a cached file is pinned
+    by a temporary hardlink while it is copied.
+
+    The cache is disabled by environment BOOSTER_NO_ARTIFACT_CACHE=1 (or bamboo variable no_artifact_cache=1), or
+    by DEBUG_SKIP=artifactcache.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import platform
+import shutil
+import time
+import uuid
+
+import AtaUtil
+import ata.log
+from Booster.Debug import Debug as Debugger
+
+logger = ata.log.AtaLog(__name__)
+
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'fuse.sshfs', 'glusterfs', 'ceph', 'lustre')
+MIN_SIZE = 1 << 20      # smaller files are not worth an entry
+
+_cache = None
+_mounts = None
+
+
+def isEnabled():
+    for key in ('BOOSTER_NO_ARTIFACT_CACHE', 'BAMBOO_NO_ARTIFACT_CACHE'):
+        if os.environ.get(key, '0').strip().lower() in ('1', 'true'):
+            return False
+    return not Debugger().skip('artifactcache')
+
+
+def get():
+    """
+    Return the artifact cache of the agent, None if it is disabled or not available
+    """
+    global _cache
+    if not isEnabled():
+        return None
+    if _cache is None:
+        try:
+            _cache = ArtifactCache(AtaUtil.get_cache_dir('artifacts'))
+        except (IOError, OSError) as e:
+            logger.warning('artifact cache is not available: {}'.format(e))
+    return _cache
+
+
+def wanted(mode, path, size):
+    """
+    Return True if a file is to be cached
+    :param mode:    cache attribute of the fetch step: true, false or auto (files on network file systems)
+    :param size:    size of the file, small files are never cached
+    """
+    mode = (mode or 'auto').lower()
+    if mode == 'false' or size < MIN_SIZE:
+        return False
+    return mode == 'true' or isRemote(path)
+
+
+def urlKey(url, checksum):
+    return _key('url', url, checksum)
+
+
+def fileKey(path, st=None):
+    st = st or os.stat(path)
+    return _key('file', os.path.abspath(path), st.st_size, int(st.st_mtime))
+
+
+def _key(*parts):
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+
+def isRemote(path):
+    """
+    Return True if path is on a network file system, i.e. worth caching
+    """
+    path = os.path.abspath(path)
+    if platform.system() == 'Windows':
+        return path.startswith('\\\\')
+    global _mounts
+    if _mounts is None:
+        _mounts = []
+        try:
+            with open('/proc/mounts', 'r') as fh:
+                for line in fh:
+                    fields = line.split()
+                    if len(fields) > 2:
+                        _mounts.append((fields[1].replace('\\040', ' '), fields[2]))
+        except (IOError, OSError):
+            pass
+        _mounts.sort(key=lambda m: len(m[0]), reverse=True)
+    for mount, fstype in _mounts:
+        if path == mount or path.startswith(mount.rstrip('/') + '/'):
+            return fstype in NETWORK_FS
+    return False
+
+
+class _Lock(object):
+    """
+    Exclusive lock of a file, between processes
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fh = None
+
+    def __enter__(self):
+        self.fh = open(self.path, 'a+')
+        if os.name == 'nt':
+            import msvcrt
+            while True:
+                try:
+                    self.fh.seek(0)
+                    msvcrt.locking(self.fh.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except (IOError, OSError) as e:
+                    if e.errno != errno.EDEADLK:        # LK_LOCK gives up after 10 seconds
+                        raise
+        else:
+            import fcntl
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self.fh.seek(0)
+                msvcrt.locking(self.fh.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.fh.close()     # releases the flock
+
+
+class ArtifactCache(object):
+    """
+    Usage:
+        cache = ArtifactCache.get()
+        if cache is None:
+            fill(target)
+        else:
+            cache.fetch(ArtifactCache.urlKey(url, sha1), target, fill)
+    """
+    def __init__(self, root, limit=None):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.index = os.path.join(root, 'index.json')
+        self.lock = os.path.join(root, 'lock')
+        if limit is None:
+            try:
+                limit = int(os.environ.get('BOOSTER_ARTIFACT_CACHE_MB', '10240')) * 1048576
+            except ValueError:
+                limit = 10240 * 1048576
+        self.limit = limit
+        self.stats = {'hits': 0, 'misses': 0, 'saved': 0}
+        if not os.path.isdir(self.objects):
+            try:
+                os.makedirs(self.objects)
+            except OSError:
+                if not os.path.isdir(self.objects):
+                    raise
+
+    def _blob(self, key):
+        return os.path.join(self.objects, key[:2], key)
+
+    def _load(self):
+        try:
+            with open(self.index, 'r') as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {'entries': {}, 'hits': 0, 'misses': 0}
+
+    def _save(self, index):
+        tmp = '{}.{}'.format(self.index, uuid.uuid4().hex)
+        with open(tmp, 'w') as fh:
+            json.dump(index, fh, indent=1, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.index):
+            os.remove(self.index)
+        os.rename(tmp, self.index)
+
+    def _report(self, result, name, size):
+        self.stats[result] += 1
+        if result == 'hits':
+            self.stats['saved'] += size
+        logger.info('artifact cache {}: {} ({} bytes) - {hits} hits, {misses} misses, {saved} bytes not fetched'.format(
+            'hit' if result == 'hits' else 'miss', name, size, **self.stats))
+
+    def lookup(self, key, target, hardlink=True):
+        """
+        Materialize a cached file
+        :param key:         see urlKey and fileKey
+        :param target:      file to create, replaced if it exists
+        :param hardlink:    False if target might be modified in place, it is then a reflink or a copy
+        :return:            True on a hit
+        """
+        blob = self._blob(key)
+        pin = None
+        with _Lock(self.lock):
+            index = self._load()
+            entry = index['entries'].get(key)
+            if entry is not None and os.path.isfile(blob) and os.path.getsize(blob) != entry['size']:
+                logger.warning('artifact cache entry {} is corrupted, drop it'.format(entry['name']))
+                os.remove(blob)
+            if entry is None or not os.path.isfile(blob):
+                index['misses'] = index.get('misses', 0) + 1
+                index['entries'].pop(key, None)
+                self._save(index)
+                found = False
+            else:
+                # pinned (or linked) while locked, so that the blob is not evicted meanwhile; a copy is made after
+                # the lock is released, not to hold up the other agents
+                if not hardlink and hasattr(os, 'link'):
+                    pin = '{}.{}'.format(blob, uuid.uuid4().hex)
+                    try:
+                        os.link(blob, pin)
+                    except OSError:
+                        pin = None
+                if pin is None:
+                    _materialize(blob, target, hardlink)
+                entry['used'] = time.time()
+                index['hits'] = index.get('hits', 0) + 1
+                self._save(index)
+                found = True
+        if pin is not None:
+            try:
+                _materialize(pin, target, False)
+            finally:
+                os.remove(pin)
+        if found:
+            self._report('hits', os.path.basename(target), entry['size'])
+        return found
+
+    def store(self, key, path, hardlink=True):
+        """
+        Add a file to the cache, then evict the least recently used entries beyond the size limit
+        :param key:         see urlKey and fileKey
+        :param path:        file fetched, it is linked (or copied) into the cache
+        :param hardlink:    False if path might be modified in place
+        """
+        blob = self._blob(key)
+        if not os.path.isdir(os.path.dirname(blob)):
+            try:
+                os.makedirs(os.path.dirname(blob))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(blob)):
+                    raise
+        tmp = '{}.{}'.format(blob, uuid.uuid4().hex)
+        _materialize(path, tmp, hardlink)
+        size = os.path.getsize(tmp)
+        try:
+            with _Lock(self.lock):
+                if os.path.exists(blob):
+                    os.remove(blob)
+                os.rename(tmp, blob)
+                index = self._load()
+                index['entries'][key] = {'size': size, 'used': time.time(), 'name': os.path.basename(path)}
+                self._evict(index)
+                self._save(index)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _evict(self, index):
+        entries = index['entries']
+        total = sum(e['size'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['used']):
+            if total <= self.limit:
+                break
+            total -= entries[key]['size']
+            logger.info('artifact cache evicts {} ({} bytes)'.format(entries[key]['name'], entries[key]['size']))
+            del entries[key]
+            try:
+                os.remove(self._blob(key))
+            except OSError:
+                pass
+
+    def fetch(self, key, target, fill, hardlink=True):
+        """
+        Materialize a cached file, or fetch and cache it
+        :param fill:        function fetching the file, called with target
+        :return:            'hit' or 'miss'
+        """
+        if self.lookup(key, target, hardlink):
+            return 'hit'
+        fill(target)
+        self.add(key, target, hardlink)
+        return 'miss'
+
+    def add(self, key, path, hardlink=True):
+        """
+        Cache a file fetched after a miss, a failure is only reported
+        """
+        self._report('misses', os.path.basename(path), os.path.getsize(path))
+        try:
+            self.store(key, path, hardlink)
+        except (IOError, OSError) as e:
+            logger.warning('failed to cache {}: {}'.format(path, e))
+
+
+def _materialize(source, target, hardlink):
+    """
+    Create target with the content of source: hardlink, reflink or copy
+    """
+    if os.path.islink(target) or os.path.exists(target):
+        os.remove(target)
+    if hardlink and hasattr(os, 'link'):
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass        # e.g. another file system
+    import Copy
+    Copy._copyData(source, target)
+    shutil.copymode(source, target)
@@ -1,9 +1,24 @@
 from __future__ import print_function
+"""
+    <Artifactory request="upload|download" dest="..." [user="..."] [password="..."] [workers="4"] [engine="http|curl"]
+                 [cache="true|false"]>
+        <File>...</File>
+    </Artifactory>
+
+    Files are uploaded to the dest url, or downloaded from their url to the dest directory. By default the files are
+    transferred in-process (see ArtifactoryClient), engine="curl" runs a curl command per file. curl is the default
+    on AIX, HP-UX and Solaris 10 (see getCurl), and where python has no ssl module. Downloads are kept
+    in the agent artifact cache (see ArtifactCache) unless cache="false".
+"""
 
 import os
 import platform
+import ArtifactCache
 import Command
+import Parallel
 import ata.log
+from ArtifactoryClient import ArtifactoryClient
+from BoosterError import BoosterError
 
 logger = ata.log.AtaLog(__name__)
 
@@ -13,11 +28,27 @@ def _doExecute(root, isDebug):
     print('      Enter GTest        ')
     print('=========================')
 
-    curl = getCurl(root)
     dest = getDest(root)
     request = getRequest(root)
     user, password = getCredential(root)
     files = list(root)
+    if request not in ('upload', 'download'):
+        raise BoosterError(__name__, 'unknown request {}, expect upload or download'.format(request))
+    if getEngine(root) != 'curl':
+        jobs = getJobs(dest, request, [file.text for file in files])
+        if isDebug:
+            for job in jobs:
+                logger.info('{} {} -> {}'.format(*job))
+            return
+        cache = ArtifactCache.get() if request == 'download' and getCache(root) != 'false' else None
+        client = ArtifactoryClient(user, password, min(Parallel.getWorkers(root), MAX_WORKERS), cache)
+        try:
+            client.transfer(jobs)
+        finally:
+            client.close()
+        return
+
+    curl = getCurl(root)
     for file in files:
         command = getCommand(curl, dest, request, user, password, file.text)
         if isDebug:
@@ -38,17 +69,62 @@ def Debug(root):
     _doExecute(root, True)
 
 
-def getCurl(root):
+MAX_WORKERS = 8      # concurrent transfers, whatever the number of cpus
+
+
+def getEngine(root):
+    """
+    Return the transfer engine, curl by default where python usually lacks a working ssl (the platforms with a
+    curl of their own, see getCurl) or where ssl can't be imported
+    """
+    default = 'http'
+    if _getBundledCurl() is not None:
+        default = 'curl'
+    else:
+        try:
+            import ssl
+        except ImportError:
+            default = 'curl'
+    return root.attrib.get('engine', default)
+
+
+def getCache(root):
+    return root.attrib.get('cache', 'true')
+
+
+def getJobs(dest, request, files):
+    """
+    :return:    list of ('upload', path, url) or ('download', url, path), see ArtifactoryClient.transfer
+    """
+    if request == 'upload':
+        return [(request, file, os.path.join(dest, os.path.basename(file)).replace('\\', '/')) for file in files]
+    makeDest(dest)
+    return [(request, file, os.path.join(dest, os.path.basename(file))) for file in files]
+
+
+def makeDest(dest):
+    if not os.path.isdir(dest):
+        os.umask(0o000)
+        os.makedirs(dest, 0o0777)
+
+
+def _getBundledCurl():
+    """
+    Return the curl command of the platforms with a curl installed by the agent setup, None elsewhere
+    """
     if platform.system() == 'AIX':
-        default = 'export LIBPATH=$LIBPATH:/bamboo/opt/curl/ && /bamboo/opt/curl/curl'
+        return 'export LIBPATH=$LIBPATH:/bamboo/opt/curl/ && /bamboo/opt/curl/curl'
     elif platform.system() == 'HP-UX':
-        default = 'export LD_LIBRARY_PATH=${LD_LIBRARY_PATH:+LD_LIBRARY_PATH:}:/bamboo/opt/curl/ && /bamboo/opt/curl/curl'
+        return 'export LD_LIBRARY_PATH=${LD_LIBRARY_PATH:+LD_LIBRARY_PATH:}:/bamboo/opt/curl/ && /bamboo/opt/curl/curl'
     elif os.environ.get('BOOSTER_VAR_DISTRIBUTION', 'undef') == 'solaris10sparc' or os.environ.get('BOOSTER_VAR_DISTRIBUTION', 'undef') == 'solaris10x86':
-        default = '/opt/csw/bin//curl'
-    elif platform.system() == 'Windows':
-        default = 'C:/opt/curl/bin/curl'
-    else:
-        default = 'curl'
+        return '/opt/csw/bin//curl'
+    return None
+
+
+def getCurl(root):
+    default = _getBundledCurl()
+    if default is None:
+        default = 'C:/opt/curl/bin/curl' if platform.system() == 'Windows' else 'curl'
     return root.attrib.get('curl', default)
 
 
@@ -71,8 +147,6 @@ def getCommand(curl, dest, request, user, password, file):
     if request == 'upload':
         command = curl + ' -u ' + user + ':' + password + ' -X PUT ' + os.path.join(dest, os.path.basename(file)).replace('\\', '/') + ' -T ' + file
     if request == 'download':
-        if not os.path.isdir(dest):
-            os.umask(0o000)
-            os.makedirs(dest, 0o0777)
+        makeDest(dest)
         command = curl + ' -u ' + user + ':' + password + ' ' + file + ' -o ' + os.path.join(dest, os.path.basename(file))
     return command
\ No newline at end of file
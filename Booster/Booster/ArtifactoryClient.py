@@ -0,0 +1,308 @@
+from __future__ import print_function
+"""
+    In-process transfer engine of <Artifactory>
+
+    Files are transferred by a bounded pool of threads sharing keep-alive connections: connections are kept per
+    host once a response is read, and reused by the next request, so that a batch of files pays a single TLS
+    handshake per worker. Credentials are sent in an Authorization header, never on a command line.
+
+    Uploads are checksum deploys: the artifact is probed with HEAD and skipped if Artifactory already has it with the
+    same sha1, otherwise it is deployed by checksum (X-Checksum-Deploy), and only uploaded if Artifactory doesn't
+    have the content anywhere.
+
+    Downloads are written to <file>.part and resumed with a Range request when the connection breaks, the file is
+    checked against the X-Checksum-Sha1 of the response when there is one. With an ArtifactCache, artifacts are
+    probed with HEAD and taken from the cache when their checksum (or ETag) is known.
+"""
+
+import base64
+import hashlib
+import os
+import socket
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import httplib
+    from urllib import quote
+    from urlparse import urlsplit
+except ImportError:     # python 3
+    import http.client as httplib
+    from urllib.parse import quote, urlsplit
+
+import ArtifactCache
+import ata.log
+from BoosterError import BoosterError
+
+logger = ata.log.AtaLog(__name__)
+
+CHUNK_SIZE = 1 << 20
+RETRIES = 3             # attempts to resume a download
+TIMEOUT = 300           # seconds without data before a transfer fails
+
+
+def fileDigests(path, algorithms=('sha1', 'sha256', 'md5')):
+    """
+    :return:    tuple of the digests of a file, in hex
+    """
+    digests = [hashlib.new(a) for a in algorithms]
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(CHUNK_SIZE)
+            if not data:
+                break
+            for d in digests:
+                d.update(data)
+    return tuple(d.hexdigest() for d in digests)
+
+
+def _text(data):
+    """
+    Beginning of a response body, for error messages
+    """
+    return data[:200].decode('utf-8', 'replace')
+
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections, per scheme and host
+    """
+    def __init__(self, timeout=TIMEOUT):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """
+        :return:    (connection, reused)
+        """
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return connections.pop(), True
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self.timeout), False
+
+    def put(self, scheme, netloc, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(connection)
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
+class ArtifactoryClient(object):
+    """
+    Upload and download files with a pool of workers
+    """
+    def __init__(self, user=None, password=None, workers=4, cache=None):
+        self.workers = max(1, workers)
+        self.pool = ConnectionPool()
+        self.cache = cache              # ArtifactCache of the downloads
+        self.headers = {}
+        if user:
+            token = base64.b64encode('{}:{}'.format(user, password).encode('utf-8')).decode('ascii')
+            self.headers['Authorization'] = 'Basic ' + token
+
+    def close(self):
+        self.pool.close()
+
+    def _send(self, method, url, headers=None, body=None):
+        """
+        Send a request on a pooled connection
+        :return:    (response, release), call release() once the response is read to keep the connection,
+                    release(False) to drop it
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise BoosterError(__name__, 'unsupported url {}'.format(url))
+        path = quote(parts.path or '/', safe='/%:@!$&\'()*+,;=~') + ('?' + parts.query if parts.query else '')
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        while True:
+            connection, reused = self.pool.get(parts.scheme, parts.netloc)
+            try:
+                if body is not None and hasattr(body, 'seek'):
+                    body.seek(0)
+                connection.request(method, path, body, all_headers)
+                response = connection.getresponse()
+                break
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, try again on a new one
+
+        def release(keep=True):
+            if keep and not response.will_close:
+                self.pool.put(parts.scheme, parts.netloc, connection)
+            else:
+                connection.close()
+
+        return response, release
+
+    def _call(self, method, url, headers=None, body=None):
+        """
+        :return:    (status, headers, body) of a request
+        """
+        response, release = self._send(method, url, headers, body)
+        try:
+            data = response.read()
+        except Exception:
+            release(False)
+            raise
+        release()
+        return response.status, dict((k.lower(), v) for k, v in response.getheaders()), data
+
+    def upload(self, path, url):
+        """
+        Checksum deploy a file
+        :param path:    local file
+        :param url:     url of the artifact
+        :return:        'skipped' if Artifactory has it already, 'deployed' if it was deployed by checksum,
+                        'uploaded' otherwise
+        """
+        sha1, sha256, md5 = fileDigests(path)
+        status, headers, data = self._call('HEAD', url)
+        if status == 200 and headers.get('x-checksum-sha1') == sha1:
+            return 'skipped'
+        checksums = {'X-Checksum-Sha1': sha1, 'X-Checksum-Sha256': sha256, 'X-Checksum': md5}
+        deploy = dict(checksums)
+        deploy['X-Checksum-Deploy'] = 'true'
+        deploy['Content-Length'] = '0'
+        status, headers, data = self._call('PUT', url, deploy)
+        if status in (200, 201):
+            return 'deployed'
+        if status != 404:
+            raise BoosterError(__name__, 'checksum deploy of {} failed: HTTP {} {}'.format(url, status, _text(data)))
+        checksums['Content-Length'] = str(os.path.getsize(path))
+        with open(path, 'rb') as fh:
+            status, headers, data = self._call('PUT', url, checksums, fh)
+        if status not in (200, 201):
+            raise BoosterError(__name__, 'upload of {} failed: HTTP {} {}'.format(url, status, _text(data)))
+        return 'uploaded'
+
+    def download(self, url, target):
+        """
+        Download a file, resuming it if the connection breaks
+        :param url:     url of the artifact
+        :param target:  local file
+        :return:        'cached', 'downloaded' or 'resumed'
+        """
+        if self.cache is not None:
+            status, headers, data = self._call('HEAD', url)
+            checksum = headers.get('x-checksum-sha1') or headers.get('etag')
+            if status == 200 and checksum and ArtifactCache.wanted('true', url, int(headers.get('content-length', 0))):
+                result = []
+                key = ArtifactCache.urlKey(url, checksum)
+                # never hardlinked, a later step may rewrite the file in place
+                fill = lambda path: result.append(self._download(url, path))
+                if self.cache.fetch(key, target, fill, hardlink=False) == 'hit':
+                    return 'cached'
+                return result[0]
+        return self._download(url, target)
+
+    def _download(self, url, target):
+        part = target + '.part'
+        result, sha1 = self._fetch(url, part)
+        if sha1 and fileDigests(part, ('sha1',))[0] != sha1:
+            os.remove(part)
+            if result != 'resumed':
+                raise BoosterError(__name__, 'download of {} failed: sha1 mismatch'.format(url))
+            # e.g. the part was left by a previous download of another version
+            logger.warning('resumed download of {} is corrupted, download it again'.format(url))
+            result, sha1 = self._fetch(url, part)
+            if sha1 and fileDigests(part, ('sha1',))[0] != sha1:
+                os.remove(part)
+                raise BoosterError(__name__, 'download of {} failed: sha1 mismatch'.format(url))
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(part, target)
+        return result
+
+    def _fetch(self, url, part):
+        """
+        Download or complete part
+        :return:    ('downloaded' or 'resumed', sha1 announced by the server or None)
+        """
+        result = 'downloaded'
+        sha1 = None
+        attempt = 0
+        while True:
+            offset = os.path.getsize(part) if os.path.isfile(part) else 0
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+            try:
+                response, release = self._send('GET', url, headers)
+                if response.status == 416 and offset:
+                    # the part is not shorter than the artifact, e.g. left by another version: start over
+                    response.read()
+                    release()
+                    logger.warning('{} does not match {}, download it again'.format(part, url))
+                    os.remove(part)
+                    result = 'downloaded'
+                    continue
+                if response.status not in (200, 206):
+                    data = response.read()
+                    release()
+                    raise BoosterError(__name__, 'download of {} failed: HTTP {} {}'.format(url, response.status, _text(data)))
+                if response.status == 206:
+                    result = 'resumed'
+                sha1 = response.getheader('X-Checksum-Sha1') or sha1
+                expected = response.getheader('Content-Length')
+                received = 0
+                try:
+                    with open(part, 'ab' if response.status == 206 else 'wb') as fh:
+                        while True:
+                            data = response.read(CHUNK_SIZE)
+                            if not data:
+                                break
+                            fh.write(data)
+                            received += len(data)
+                    if expected is not None and received < int(expected):
+                        # read(amt) returns what was received when the connection is closed
+                        raise httplib.IncompleteRead(b'', int(expected) - received)
+                except Exception:
+                    release(False)
+                    raise
+                release()
+                return result, sha1
+            except (socket.error, httplib.HTTPException) as e:
+                attempt += 1
+                if attempt > RETRIES:
+                    raise BoosterError(__name__, 'download of {} failed: {}'.format(url, e))
+                logger.warning('download of {} interrupted, resume: {}'.format(url, e))
+
+    def transfer(self, jobs):
+        """
+        Run transfers in parallel
+        :param jobs:    list of ('upload', path, url) or ('download', url, target)
+        :return:        None, raise BoosterError once all jobs are done if some failed
+        """
+        errors = []
+        pool = ThreadPool(min(self.workers, len(jobs)) or 1)
+        try:
+            for job, result, error in pool.imap_unordered(self._run, jobs):
+                if error is None:
+                    logger.info('{} {}: {}'.format(job[0], job[1], result))
+                else:
+                    logger.warning('{} {} failed: {}'.format(job[0], job[1], error))
+                    errors.append(job[1])
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            raise BoosterError(__name__, '{} transfers failed: {}'.format(len(errors), ', '.join(errors)))
+
+    def _run(self, job):
+        request, source, dest = job
+        try:
+            if request == 'upload':
+                return job, self.upload(source, dest), None
+            return job, self.download(source, dest), None
+        except Exception as e:
+            return job, None, e
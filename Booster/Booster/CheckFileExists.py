@@ -7,6 +7,7 @@ from distutils.file_util import copy_file
 from BoosterError import FileNotFoundError, BoosterError
 
 import Command
+import Shared.FileWatch as FileWatch
 import ata.log
 
 logger = ata.log.AtaLog(__name__)
@@ -72,28 +73,12 @@ def addFileListToCheckList(filelist, checklist):
 
 
 def checkFiles(basedir, checklist, timeout):
-    def FindMissingFile():
-        for file in checklist:
-            filePath = os.path.join(basedir, file)
-            logger.info('check ' + filePath)
-            if not os.path.exists(filePath):
-                return filePath
-        return None
-    
-    start_time = time.time()
-    missing = None
-    while True:
-        missing = FindMissingFile()
-        if (missing is None):
-            return
-        
-        elapsed = time.time() - start_time
-        if timeout is None or elapsed > timeout:
-            print("{} contains {}".format(os.path.dirname(missing), os.listdir(os.path.dirname(missing))))
-            raise FileNotFoundError(missing)
-        else:
-            logger.info('missing ' + missing + ' but timeout has not yet elapsed, sleeping for 1 second and retrying...')
-            time.sleep(1)
-
-
-
+    # returns as soon as the last missing file is written, see FileWatch
+    missing = FileWatch.waitForFiles([os.path.join(basedir, file) for file in checklist], timeout)
+    if missing:
+        logger.info('{} of {} files are missing'.format(len(missing), len(checklist)))
+        missing = missing[0]
+        directory = os.path.dirname(missing)
+        if os.path.isdir(directory or '.'):
+            print("{} contains {}".format(directory, os.listdir(directory or '.')))
+        raise FileNotFoundError(missing)
@@ -1,8 +1,13 @@
 from __future__ import print_function
 
+import json
 import os
 import ata.log
 import fnmatch
+try:
+    from os import scandir
+except ImportError:     # python 2
+    scandir = None
 from Booster.Debug import Debug as Debugger
 from Booster.XMLFile import XMLFile, getFileName
 from Booster.XMLFile import dumpXMLNode
@@ -31,6 +36,7 @@ def Execute(root):
     print('==============================')
     logger.info('=== Scanning ' + packageName + ' ===')   
     additionalfiles = validatePackage(checklist, packagelist, AdditionalFileErrorRaiseList)
+    writeReport(getReportFile(root, packageName), diffChecklist(checklist, packagelist))
     if missingfiles != 0 or additionalfiles != 0:
         exit(-1)
 
@@ -46,7 +52,7 @@ def Debug(root):
     AdditionalFileErrorRaiseList = []
     checklistfile = getChecklistFile(root)
     logger.info('--- checklist 1: ' + checklistfile)
-    (checklistSet, removeSet)= generateChecklistSet(checklistfile, basedir)
+    (checklistSet, removeSet)= generateChecklistSet(checklistfile)
     print('checklistSet' + str(checklistSet))
     checklist = combineChecklists(checklistSet, basedir)
     print('checklist' + str(checklist))
@@ -71,6 +77,11 @@ def getPackageName(root):
    
 def getChecklistFile(root):
     return root.text
+
+
+def getReportFile(root, packageName):
+    return root.attrib.get('report', os.path.join('log', 'checklist', '{}.json'.format(packageName)))
+
     
 def combineChecklists(checklistSet, cwd):
     checklist = []
@@ -159,75 +170,98 @@ def findRemoveSet(node, removeSet):
     return removeSet 
             
 def removeDuplicate(checklist):
+    seen = set()
     list = []
     for item in checklist:
-        if item not in list:
+        if item not in seen:
+            seen.add(item)
             list.append(item)
     return list
 
 def subtractChecklist(checklist,removelist):
-    list = []
-    for item in checklist:
-        if item not in removelist:
-            list.append(item)
-    return list
+    removeset = set(removelist)
+    return [item for item in checklist if item not in removeset]
+
+def _scan(path):
+    """
+    Return (name, is directory, is symlink) of the entries of path
+    """
+    if scandir is not None:
+        return [(e.name, e.is_dir(), e.is_symlink()) for e in scandir(path)]
+    entries = []
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        entries.append((name, os.path.isdir(child), os.path.islink(child)))
+    return entries
 
 def scanFolder(directory_path, pattern="*"):
-    for dirpath, dirnames, filenames in os.walk(directory_path):
-        for file_name in filenames:
-            yield os.path.join(os.path.realpath(dirpath), file_name)
-        for dir_name in dirnames:
-            if not os.listdir(os.path.join(dirpath, dir_name)):
-                yield os.path.join(os.path.realpath(dirpath), dir_name)
-        
+    """
+    Yield the files and empty directories of directory_path, in one pass. Like os.walk, symlinked directories
+    are not followed
+    """
+    if not os.path.isdir(directory_path):
+        return
+    root = os.path.realpath(directory_path)
+    pending = [root]
+    while pending:
+        dirpath = pending.pop()
+        entries = _scan(dirpath)
+        if len(entries) == 0 and dirpath != root:
+            yield dirpath
+        for name, isdir, islink in entries:
+            path = os.path.join(dirpath, name)
+            if not isdir:
+                yield path
+            elif not islink:
+                pending.append(path)
+            elif not os.listdir(path):
+                yield path
+
+
+def diffChecklist(checklist, packagelist):
+    """
+    Compare the expected files to the package content
+    :return:    dict with the sorted lists of missing and extra files, and the counts
+    """
+    expected = set(checklist)
+    found = set(packagelist)
+    missing = sorted(expected - found)
+    extra = sorted(found - expected)
+    return {'missing': missing, 'extra': extra,
+            'counts': {'missing': len(missing), 'extra': len(extra), 'ok': len(expected & found)}}
+
+
+def writeReport(reportFile, diff):
+    directory = os.path.dirname(reportFile)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(reportFile, 'w') as fh:
+        json.dump(diff, fh, indent=1, sort_keys=True)
+    logger.info('=== Checklist report: {} (missing {missing}, extra {extra}, ok {ok}) ==='.format(
+        reportFile, **diff['counts']))
+
 
 def validateChecklist(checklist, packagelist, MissingFileErrorRaiseList):
-    missingfiles = 0
-    missingfilelist = []
-    existingfilelist = []
-     
-    for item in checklist:
-        if item not in packagelist:
-            logger.info(item + ' does not exist')
-            missingfiles = missingfiles + 1
-            missingfilelist.append(item)
-            MissingFileErrorRaiseList.append(item)
-        else:
-            existingfilelist.append(item)
-    for fileName in existingfilelist:
-        logger.info (fileName)
+    missingfilelist = sorted(set(checklist) - set(packagelist))
+    MissingFileErrorRaiseList.extend(missingfilelist)
+    missingfiles = len(missingfilelist)
     if missingfiles == 0:
         logger.info ('=== Base on checklists, All ' + str(len(checklist)) + ' files exist ===')
     else:
         logger.critical ('=== Missing '+ str(missingfiles) + ' files ===')
-        for file in MissingFileErrorRaiseList:
+        for file in missingfilelist:
             logger.critical(file)
     return missingfiles
 
 
 def validatePackage(checklist, packagelist, AdditionalFileErrorRaiseList):
-    additionfiles = 0
-    additionfileslist = []
-    existingfilelist = []
-    
-    for item in packagelist:
-        if item not in checklist:
-            logger.info(item + ' is additional file/folder')
-            additionfiles = additionfiles + 1
-            additionfileslist.append(item)
-            AdditionalFileErrorRaiseList.append(item)
-        else:
-            existingfilelist.append(item)
-    for fileName in existingfilelist:
-        logger.info (fileName)        
+    additionfileslist = sorted(set(packagelist) - set(checklist))
+    AdditionalFileErrorRaiseList.extend(additionfileslist)
+    additionfiles = len(additionfileslist)
     if additionfiles == 0:
         logger.info ('=== Scan package folder ' + str(len(packagelist)) + ' files , No additional files ===')
     else:
         logger.critical ('=== Additional '+ str(additionfiles) + ' files/folders ===')
-        for file in AdditionalFileErrorRaiseList:
+        for file in additionfileslist:
             logger.critical(file)
     return additionfiles
-        
-        
-        
-
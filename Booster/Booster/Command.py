@@ -1,15 +1,15 @@
 # Execute command and print out error
 
 from __future__ import print_function
+import collections
 import glob
-import io
 import os
 import os.path
 import platform
 import shutil
 import subprocess
 import sys
-import time
+import threading
 import Shared.CrashUtils as CrashUtils
 import tempfile
 
@@ -18,6 +18,17 @@ from BoosterError import BoosterError
 
 logger = ata.log.AtaLog(__name__)
 
+CHUNK_SIZE = 65536      # pipe reads, and the longest line kept in memory
+TAIL_LINES = 50         # lines of output kept for error reports
+CLOSE_GRACE = 2         # seconds to wait for the output once the command exited, background children may hold it
+                        # (a captured output is waited for until it is closed)
+
+CommandResult = collections.namedtuple('CommandResult', ['pid', 'returncode', 'output', 'tail'])
+
+
+def _text(data):
+    return data if str is bytes else data.decode('utf-8', 'replace')
+
 def _cmdlog(cmd, cwd=None, title=None):
     c_cwd = os.getcwd()
     if title is not None and title != '':
@@ -32,6 +43,119 @@ def _cmdlog(cmd, cwd=None, title=None):
         logger.info(cmd)
 
 
+class _Tee(threading.Thread):
+    """
+    Read the output of a process as soon as it is written, and tee it to a log file, the console and the logger.
+    The last lines are kept in a ring buffer, the whole output only if it is captured
+    """
+    def __init__(self, stream, log=None, console=False, logLevel=None, capture=False, tail=TAIL_LINES):
+        super(_Tee, self).__init__()
+        self.daemon = True
+        self.stream = stream
+        self.log = log
+        self.console = console
+        self.logLevel = logLevel
+        self.chunks = [] if capture else None
+        self.tail = collections.deque(maxlen=tail)
+
+    def run(self):
+        pending = b''
+        try:
+            while True:
+                data = os.read(self.stream.fileno(), CHUNK_SIZE)
+                if not data:
+                    break
+                if self.log is not None:
+                    self.log.write(data)
+                    self.log.flush()
+                if self.console:
+                    sys.stdout.write(_text(data))
+                    sys.stdout.flush()
+                if self.chunks is not None:
+                    self.chunks.append(data)
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                if len(pending) >= CHUNK_SIZE:
+                    lines.append(pending)
+                    pending = b''
+                for line in lines:
+                    self._line(line)
+            if pending:
+                self._line(pending)
+        finally:
+            self.stream.close()
+            if self.log is not None:
+                self.log.close()
+
+    def _line(self, line):
+        line = _text(line.rstrip())
+        self.tail.append(line)
+        if self.logLevel is not None:
+            getattr(logger, self.logLevel)(line)
+
+    def output(self):
+        return b''.join(self.chunks) if self.chunks is not None else None
+
+
+def runCommand(command, cwd=None, bash=None, shell=True, log=None, logMode='ab', console=False, logLevel=None,
+               capture=False, inherit=False):
+    """
+    Run a command to its end. Its stdout and stderr are merged, and read by a thread as soon as they are written
+    :param command:     command line with shell, list of arguments otherwise
+    :param log:         file receiving the output
+    :param logMode:     'ab' to append to the log file, 'wb' to overwrite it
+    :param console:     echo the output on stdout
+    :param logLevel:    name of the logger method receiving each line, e.g. 'info'
+    :param capture:     keep the whole output in memory
+    :param inherit:     the command writes to the stdout/stderr of booster, nothing is read
+    :return:            CommandResult(pid, returncode, output (bytes, None if not captured), tail (last lines))
+    """
+    if inherit:
+        proc = subprocess.Popen(command, cwd=cwd, executable=bash, shell=shell)
+        proc.wait()
+        return CommandResult(proc.pid, proc.returncode, None, [])
+    logFile = open(log, logMode) if log is not None else None
+    try:
+        proc = subprocess.Popen(command, cwd=cwd, executable=bash, shell=shell,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except BaseException:
+        if logFile is not None:
+            logFile.close()
+        raise
+    tee = _Tee(proc.stdout, logFile, console, logLevel, capture)
+    tee.start()
+    try:
+        proc.wait()
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        tee.join(CLOSE_GRACE)
+    if capture and tee.is_alive():
+        # the output is parsed by the caller, wait for all of it like check_output did
+        logger.warning('the output of {} is still open, wait for it'.format(proc.pid))
+        while tee.is_alive():
+            tee.join(CLOSE_GRACE)
+    if tee.is_alive():
+        logger.warning('the output of {} is still open, stop waiting for it'.format(proc.pid))
+    return CommandResult(proc.pid, proc.returncode, tee.output(), list(tee.tail))
+
+
+def _reportFailure(command, result):
+    logger.critical("*** Command {} failed with error code {} ***".format(command, result.returncode))
+    if result.tail:
+        logger.critical('last {} lines of output:'.format(len(result.tail)))
+        for line in result.tail:
+            logger.critical(line)
+
+
+def _check(command, result):
+    if result.returncode != 0:
+        _reportFailure(command, result)
+        raise subprocess.CalledProcessError(result.returncode, command, result.output)
+    return result
+
+
 def Execute(root):
     print('==============================')
     print('        Enter Command')
@@ -81,11 +205,9 @@ def ExecuteAndGetResultAndCheckForCrash(command, params, cwd, outputDir, isDebug
         _cmdlog(commandAndParams, cwd)
         
         if not isDebug:
-            proc = subprocess.Popen(commandAndParams, cwd=cwd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-            
-            # Wait for command to exit
-            returnedData, _ = proc.communicate()
-            
+            result = runCommand(commandAndParams, cwd, shell=False, capture=True)
+            returnedData = result.output
+
             core = None
             stackTrace = None
             if procDump is not None:
@@ -96,15 +218,15 @@ def ExecuteAndGetResultAndCheckForCrash(command, params, cwd, outputDir, isDebug
                         coreFileName = os.path.basename(dumpFiles[0])
                     core = CrashUtils.save_core_dump(dumpFiles[0], outputDir, coreFileName)
                     logger.info('core={0}'.format(core))
-            elif proc.returncode != 0:
+            elif result.returncode != 0:
                 try:
-                    core = CrashUtils.find_and_save_core_dump(proc.pid, cwd, outputDir, coreFileName=coreFileName)
+                    core = CrashUtils.find_and_save_core_dump(result.pid, cwd, outputDir, coreFileName=coreFileName)
                 except:
                     logger.warning('Can not find core file')
                 
             if core is not None:
                 stackTrace = CrashUtils.get_back_trace(command, core)
-            return (proc.pid, proc.returncode, returnedData, core, stackTrace)
+            return (result.pid, result.returncode, returnedData, core, stackTrace)
         return (None, None, None, None, None)
     finally:
         if tempDir is not None:
@@ -114,46 +236,25 @@ def ExecuteAndGetResultAndCheckForCrash(command, params, cwd, outputDir, isDebug
 def ExecuteAndGetResult(command, cwd=None, bash=None, isDebug=False):
     _cmdlog(command, cwd)
     if not isDebug:
-        try:
-            result = subprocess.check_output(command, stderr=subprocess.STDOUT, cwd=cwd, executable=bash, shell=True)
-            return result
-        except subprocess.CalledProcessError as error:
-            logger.critical("*** Command " + command + " failed with error output ***")
-            logger.critical(error.output)
-            raise error
+        return _check(command, runCommand(command, cwd, bash, capture=True)).output
 
 
 def ExecuteAndLog(command, log, cwd=None, bash=None):
     _cmdlog(command, cwd, 'ExecuteAndLog')
-    try:
-        output = subprocess.check_output(command, cwd=cwd, executable=bash, stderr=subprocess.STDOUT, shell=True)
-        with open(log, 'a') as f:
-            f.write(output)
-    except subprocess.CalledProcessError as error:
-        logger.critical("*** Command " + command + " failed with error output ***")
-        logger.critical(error.output)
-        raise error
+    _check(command, runCommand(command, cwd, bash, log=log, capture=True))
 
 
 def ExecuteAndTail(command, log, checkreturncode=True, cwd=None, bash=None, isDebug=False):
     _cmdlog(command, cwd, 'ExecuteAndTail')
     if not isDebug:
-        try:
-            with io.open(log, 'wb') as writer, io.open(log, 'rb', 1) as reader:
-                proc = subprocess.Popen(command, cwd=cwd, executable=bash, stdout=writer, stderr=subprocess.STDOUT, shell=True,
-                                        universal_newlines=True)
-                while proc.poll() is None:
-                    sys.stdout.write(reader.read())
-                    time.sleep(0.5)
-                sys.stdout.write(reader.read())
-                if checkreturncode == True:
-                    rc = proc.returncode
-                    if rc != 0:
-                        raise Exception("Error: command %s returned error code %d\n" % (command, rc))
-                    else:
-                        logger.info("Command %s ended successfully" % command)
-        except subprocess.CalledProcessError:
-            raise
+        result = runCommand(command, cwd, bash, log=log, logMode='wb', console=True)
+        if checkreturncode == True:
+            rc = result.returncode
+            if rc != 0:
+                _reportFailure(command, result)
+                raise Exception("Error: command %s returned error code %d\n" % (command, rc))
+            else:
+                logger.info("Command %s ended successfully" % command)
 
 
 def ExecuteAndLogVerbose(command, cwd=None, bash=None, shell=True, isDebug=False):
@@ -163,12 +264,7 @@ def ExecuteAndLogVerbose(command, cwd=None, bash=None, shell=True, isDebug=False
         command_display = ' '.join(command)
     _cmdlog(command_display, cwd, 'ExecuteAndLogVerbose')
     if not isDebug:
-        proc = subprocess.Popen(command, cwd=cwd, executable=bash, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell)
-        for line in iter(proc.stdout.readline, b''):
-            logger.info(line.rstrip())
-        # Wait for the process to get the return code
-        proc.communicate()
-        rc = proc.returncode
+        rc = runCommand(command, cwd, bash, shell, logLevel='info').returncode
         if rc != 0:
             raise BoosterError(__name__, "Error: command {cmd} has failed\n".format(cmd=command_display))
         else:
@@ -179,17 +275,11 @@ def ExecuteInSilentMode(command, cwd=None, bash=None, shell=True):
     print('Silent Mode')
     if shell:
         command_display = command
-        _cmdlog(command_display, cwd, 'ExecuteInSilentMode')
-        proc = subprocess.Popen(command, cwd=cwd, executable=bash, stdout=None, stderr=None, shell=True)
     else:
         command_display = ' '.join(command)
-        _cmdlog(command_display, cwd, 'ExecuteInSilentMode')
-        proc = subprocess.Popen(command, cwd=cwd, executable=bash, stdout=None, stderr=None)
-    for line in iter(proc.stdout.readline, b''):
-        logger.info(line.rstrip())
-    # Wait for the process to get the return code
-    proc.communicate()
-    rc = proc.returncode
+    _cmdlog(command_display, cwd, 'ExecuteInSilentMode')
+    # the output goes straight to booster's stdout/stderr
+    rc = runCommand(command, cwd, bash, shell, inherit=True).returncode
     if rc != 0:
         raise BoosterError(__name__, "Error: command {cmd} has failed\n".format(cmd=command_display))
     else:
@@ -198,9 +288,4 @@ def ExecuteInSilentMode(command, cwd=None, bash=None, shell=True):
 
 def ExecuteAndATALog(command, cwd=None, bash=None):
     _cmdlog(command, cwd, 'ExecuteAndATALog')
-    try:
-        output = subprocess.check_output(command, cwd=cwd, executable=bash, stderr=subprocess.STDOUT, shell=True)
-        logger.debug(output)
-    except subprocess.CalledProcessError as error:
-        logger.critical(error.output)
-        raise error
+    _check(command, runCommand(command, cwd, bash, logLevel='debug', capture=True))
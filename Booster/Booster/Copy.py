@@ -1,10 +1,40 @@
 from __future__ import print_function
+"""
+    Copy files and directories
 
+    <Copy dest="staging" required="true" ignoreEmptySource="false" compare="none" workers="8" cache="auto">
+        <Item>build/lib/*.so</Item>
+        <Item>docs</Item>
+    </Copy>
+
+    Every item is a glob; matching files and symlinks are copied into dest, matching directories are copied
+    recursively into dest, hidden files included; the content of an item ending with a separator (e.g. docs/)
+    is copied into dest itself. Symlinks are copied as symlinks. The sources are walked once,
+    then files are copied by a pool of threads (workers, see Parallel.getWorkers) with the fastest way the
+    platform supports (reflink, copy_file_range, sendfile).
+
+    compare     none (default)      always copy
+                mtime               skip files whose size and modification time match the destination
+                hash                skip files whose size and content match the destination
+
+    cache       auto (default)      keep the large files of network file systems in the agent artifact cache (see
+                                    ArtifactCache), a repeated copy is a local copy (or reflink) from the cache
+                true                cache all large files
+                false               never use the cache
+"""
+
+import errno
 import glob
+import hashlib
 import os
-from distutils.file_util import copy_file
+import shutil
+import sys
+import time
+from multiprocessing.pool import ThreadPool
 
+import ArtifactCache
 import Command
+import Parallel
 import ata.log
 
 logger = ata.log.AtaLog(__name__)
@@ -17,14 +47,10 @@ def Execute(root):
     print('==============================')
 
     sourcefiles = getSource(root)
+    matches = [(s.text, glob.glob(s.text)) for s in sourcefiles]
     ignoreEmptySource = root.attrib.get('ignoreEmptySource', 'false')
     if (ignoreEmptySource == 'true'):
-        source_exist = False
-        for sourcefile in sourcefiles:
-            source = sourcefile.text
-            if len(glob.glob(source)) != 0:
-                source_exist = True
-        if not source_exist:
+        if not any(items for source, items in matches):
             logger.info('source files are empty.')
             logger.info('skip the copy.')
             return
@@ -35,17 +61,23 @@ def Execute(root):
         return
     required = root.attrib.get('required', 'false')
 
-    for sourcefile in sourcefiles:
-        source = sourcefile.text
-        # print('Copy ' + source + ' to ' + dest)
+    tasks = []
+    for source, items in matches:
         logger.info('Copy ' + source + ' to ' + dest)
         try:
-            copyGlobFiles(source, dest, required)
+            tasks.extend(planCopy(source, items, dest))
         except IOError as err:
             if (required == 'true'):
                 raise err
             else:
                 logger.warning('WARNING: {}'.format(err))
+    try:
+        runCopy(tasks, Parallel.getWorkers(root), root.attrib.get('compare', 'none'), root.attrib.get('cache', 'auto'))
+    except IOError as err:
+        if (required == 'true'):
+            raise err
+        else:
+            logger.warning('WARNING: {}'.format(err))
 
 
 def Debug(root):
@@ -76,87 +108,218 @@ def getSource(root):
     return list(root)
 
 
-def copySingleFile(source, dest, required='false'):
-    checkItem(source, required)
-    file = os.path.basename(source)
-    try:
-        if not os.path.isdir(dest):
-            os.umask(0o000)
-            os.makedirs(dest, 0o0777)
-        destFile = dest + '/' + file
-        if os.path.isfile(destFile):
-            os.umask(0o000)
-            try:
-                os.chmod(destFile, 0o0777)
-            except Exception:
-                pass
-            os.remove(destFile)
-        os.umask(0o000)
-        copy_file(source, destFile, preserve_mode=True)
-        os.chmod(destFile, 0o0777)
-    except OSError as e:
-        logger.exception(
-            "Failed to copy {src} to {dst}: {error}".format(src=source, dst=dest, error=str(e)))
-
-
-def copyLink(source, dest, required='false'):
-    checkItem(source, required)
-    file = os.path.basename(source)
-    try:
-        if not os.path.isdir(dest):
-            os.umask(0o000)
-            os.makedirs(dest, 0o0777)
-        destFile = dest + '/' + file
-        if os.path.exists(destFile):
-            os.umask(0o000)
-            try:
-                os.chmod(destFile, 0o0777)
-            except Exception:
-                pass
-            os.remove(destFile)
-        os.umask(0o000)
-        Command.ExecuteAndGetResult('cp -RfP ' + source + ' ' + dest)
-        #os.chmod(destFile, 0o0777)
-    except OSError as e:
-        logger.exception(
-            "Failed to copy symlink {src} to {dst}: {error}".format(src=source, dst=dest, error=str(e)))
-
-
-def copyGlobFiles(source, dest, required='false'):
-    if len(glob.glob(source)) == 0:
+def getInputs(root):
+    return [s.text for s in getSource(root)]
+
+
+def getOutputs(root):
+    return [root.attrib.get('dest', './')]
+
+
+def copyGlobFiles(source, dest, required='false', workers=None, compare='none'):
+    """
+    Copy the files, symlinks and directories matching glob source into directory dest
+    :param source:      glob
+    :param dest:        destination directory
+    :param required:    'true' to fail if an item disappears before it's copied
+    :param workers:     number of copying threads, default see Parallel.getWorkers
+    :param compare:     mtime, hash or none, see module doc
+    :return:            None, raise IOError if nothing matches source or a copy failed
+    """
+    tasks = planCopy(source, glob.glob(source), dest, required)
+    runCopy(tasks, workers or Parallel.getWorkers(), compare)
+
+
+def planCopy(source, items, dest, required='false'):
+    """
+    Walk the items matched by glob source once, and return the copy tasks, directories first
+    :return:            list of (kind, source, destination), kind being dir, file or link
+    """
+    if len(items) == 0:
         raise IOError('No paths match {}'.format(source))
-    for item in glob.glob(source):
+    tasks = [('dir', None, dest)]
+    for item in items:
+        checkItem(item, required)
+        # as a directory, dir/ has no name: its content is copied into dest
+        target = os.path.join(dest, os.path.basename(item)) if os.path.basename(item) else dest
         #On some platform, isfile and islink return both ture for link
         #So we need check both to make sure it's actually a file
-        if os.path.isfile(item) and not os.path.islink(item):
-            copySingleFile(item, dest, required)
         if os.path.islink(item):
-            copyLink(item, dest, required)
-        if os.path.isdir(item):
-            copyDir(item, dest, required)
+            tasks.append(('link', item, target))
+        elif os.path.isfile(item):
+            tasks.append(('file', item, target))
+        elif os.path.isdir(item):
+            tasks.append(('dir', item, target))
+            for dirpath, dirs, files in os.walk(item):
+                relpath = os.path.relpath(dirpath, item)
+                destpath = target if relpath == os.curdir else os.path.join(target, relpath)
+                for name in list(dirs):
+                    if os.path.islink(os.path.join(dirpath, name)):
+                        dirs.remove(name)       # symlinks are copied as symlinks, never followed
+                        files.append(name)
+                    else:
+                        tasks.append(('dir', os.path.join(dirpath, name), os.path.join(destpath, name)))
+                for name in files:
+                    path = os.path.join(dirpath, name)
+                    if os.path.islink(path):
+                        tasks.append(('link', path, os.path.join(destpath, name)))
+                    elif os.path.isfile(path):
+                        tasks.append(('file', path, os.path.join(destpath, name)))
+    return tasks
+
+
+def runCopy(tasks, workers=1, compare='none', cache='false'):
+    """
+    Create the directories, then copy files and symlinks on a thread pool
+    :param cache:       true, false or auto, see ArtifactCache.wanted
+    :return:            None, raise IOError once all tasks are done if any of them failed
+    """
+    start = time.time()
+    os.umask(0o000)
+    for kind, source, dest in tasks:
+        if kind == 'dir' and not os.path.isdir(dest):
+            os.makedirs(dest, 0o0777)
+    copies = [t for t in tasks if t[0] != 'dir']
+    if workers > 1 and len(copies) > 1:
+        pool = ThreadPool(min(workers, len(copies)))
+        try:
+            results = pool.map(lambda t: _copyTask(t, compare, cache), copies, chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_copyTask(t, compare, cache) for t in copies]
+    summary = {'copied': 0, 'unchanged': 0, 'link': 0, 'failed': 0}
+    size = 0
+    for (kind, source, dest), (status, n) in zip(copies, results):
+        if status not in summary:
+            logger.error('Failed to copy {src} to {dst}: {error}'.format(src=source, dst=dest, error=status))
+            status = 'failed'
+        summary[status] += 1
+        size += n
+    logger.info('{copied} files copied ({size} bytes), {unchanged} unchanged, {link} symlinks, {failed} failed '
+                'in {seconds:.1f}s'.format(size=size, seconds=time.time() - start, **summary))
+    if summary['failed'] > 0:
+        raise IOError('failed to copy {} files'.format(summary['failed']))
 
 
-def copyDir(source, dest, required='false'):
-    checkItem(source, required)
-    folder = os.path.basename(source)
-    destFolder = dest + '/' + folder
+def _copyTask(task, compare, cache):
+    kind, source, dest = task
     try:
-        if not os.path.isdir(destFolder):
-            os.umask(0o000)
-            os.makedirs(destFolder, 0o0777)
+        if kind == 'link':
+            copyLink(source, dest)
+            return 'link', 0
+        return copySingleFile(source, dest, compare, cache)
+    except (IOError, OSError) as e:
+        return str(e), 0
 
+
+def copySingleFile(source, destFile, compare='none', cache='false'):
+    """
+    Copy file source to destFile, unless it's unchanged
+    :param cache:       true, false or auto, see ArtifactCache.wanted
+    :return:            ('copied', size) or ('unchanged', 0)
+    """
+    st = os.stat(source)
+    if not os.path.islink(destFile) and os.path.isfile(destFile) and _unchanged(source, st, destFile, compare):
+        if os.stat(destFile).st_mode & 0o0777 != 0o0777:
+            os.chmod(destFile, 0o0777)
+        return 'unchanged', 0
+    _removeDest(destFile)
+    store = ArtifactCache.get() if ArtifactCache.wanted(cache, source, st.st_size) else None
+    if store is None:
+        _copyData(source, destFile)
+    else:
+        # never a hardlink, the copy can be modified in place
+        store.fetch(ArtifactCache.fileKey(source, st), destFile, lambda path: _copyData(source, path), hardlink=False)
+    os.utime(destFile, (st.st_atime, st.st_mtime))
+    os.chmod(destFile, 0o0777)
+    return 'copied', st.st_size
+
+
+def copyLink(source, destFile):
+    """
+    Copy symlink source as a symlink
+    """
+    if hasattr(os, 'symlink'):
+        link = os.readlink(source)
+        if os.path.islink(destFile) and os.readlink(destFile) == link:
+            return
+        _removeDest(destFile)
+        os.symlink(link, destFile)
+    else:
+        _removeDest(destFile)
+        Command.ExecuteAndGetResult('cp -RfP ' + source + ' ' + os.path.dirname(destFile))
+
+
+def _removeDest(destFile):
+    if os.path.islink(destFile) or os.path.isfile(destFile):
         try:
-            copyGlobFiles(source + '/*', destFolder)
-        except IOError as err:
-            logger.warning('WARNING: {}'.format(err))
-        try:
-            copyGlobFiles(source + '/.*', destFolder)
-        except IOError:
-            logger.debug('No hidden files in {}'.format(source))
+            os.chmod(destFile, 0o0777)
+        except Exception:
+            pass
+        os.remove(destFile)
+
+
+def _unchanged(source, st, destFile, compare):
+    if compare == 'none':
+        return False
+    dst = os.stat(destFile)
+    if st.st_size != dst.st_size:
+        return False
+    if compare == 'hash':
+        return _hash(source) == _hash(destFile)
+    return int(st.st_mtime) == int(dst.st_mtime)
+
+
+def _hash(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1048576), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
 
-    except OSError as e:
-        logger.exception(
-            "Failed to copy {src} to {dst}: {error}".format(src=source, dst=dest, error=str(e)))
+_FICLONE = 0x40049409
+
+
+def _copyData(source, destFile):
+    with open(source, 'rb') as fsrc:
+        with open(destFile, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            if size == 0:
+                return
+            if sys.platform.startswith('linux'):
+                try:
+                    import fcntl
+                    fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())     # reflink, on btrfs, xfs...
+                    return
+                except (IOError, OSError, ImportError):
+                    pass
+                for name in ('copy_file_range', 'sendfile'):
+                    if hasattr(os, name) and _copyRange(getattr(os, name), fsrc, fdst, size):
+                        return
+            shutil.copyfileobj(fsrc, fdst, 1048576)
+
+
+def _copyRange(f, fsrc, fdst, size):
+    # kernel side copy with os.copy_file_range(src, dst, count) or os.sendfile(dst, src, offset, count),
+    # False if it's not supported for these files
+    offset = 0
+    while offset < size:
+        try:
+            if f.__name__ == 'sendfile':
+                n = f(fdst.fileno(), fsrc.fileno(), offset, size - offset)
+            else:
+                n = f(fsrc.fileno(), fdst.fileno(), size - offset, offset, offset)
+        except OSError as e:
+            if offset == 0 and e.errno in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                return False
+            raise
+        if n == 0:
+            break       # the file got truncated
+        offset += n
+    return True
 
 
 def checkItem(source, required='false'):
@@ -31,6 +31,12 @@ class CopyAs(Action):
         if not dry:
             shutil.copyfile(self.source, self.dest)
 
+    def _inputs(self):
+        return [self.source]
+
+    def _outputs(self):
+        return [self.dest]
+
 def Execute(root):
     action = CopyAs(root)
     action.run()
@@ -25,6 +25,8 @@ class Debug(object):
                 extract     don't extract from nfs zip/tar
                 remove      don't remove so you can check the result of execution
                 copy        don't copy, for whatever reasons
+                configcache don't reuse or save expanded build files in the config cache
+                incremental always run actions marked incremental="true"
 
     trace       dump information such as
                 xmlparse    import sequence
@@ -36,7 +38,8 @@ class Debug(object):
     # modules that are skipped
     initialized = False
     skipAll = ('skipper', 'p4revert', 'p4sync', 'extract', 'remove', 'copy',
-               'make', 'ts', 'ant', 'jts', 'zip', 'tar', 'biinject', 'p4changes')
+               'make', 'ts', 'ant', 'jts', 'zip', 'tar', 'biinject', 'p4changes', 'configcache',
+               'incremental')
     skipDict = {}
     traceAll = ('xmlparse', 'xmlstrip', 'var', 'exec')
     traceDict = {}
@@ -1,11 +1,30 @@
+"""
+    Extract archives
+
+    <Extract dest="sdk" required="true" verify="false" workers="8" cache="auto">
+        <Item>/nfs/packages/sdk.tar.gz</Item>
+    </Extract>
+
+    Every item is copied into the current directory and extracted into dest, in order. The format is sniffed from
+    the magic bytes: tar archives (plain, gz, bz2, xz) are streamed once, the local copy being written while
+    members are extracted; zip members are extracted by a pool of threads (workers, see Parallel.getWorkers).
+    With verify="true", the size of every extracted file is checked (zip members are also CRC checked while
+    they are written), and a broken tar archive fails the action instead of being reported as a warning.
+    Archives on network file systems (cache="auto"), or all of them (cache="true"), are kept in the agent artifact
+    cache (see ArtifactCache): a repeated extract links the local copy from the cache instead of reading the share.
+"""
 import os
+import shutil
 import sys
 import tarfile
+import threading
 import zipfile
-from shutil import copy
+from multiprocessing.pool import ThreadPool
 from Booster.Debug import Debug as Debugger
+import ArtifactCache
 import ata.log
 import BoosterError
+import Parallel
 
 logger = ata.log.AtaLog(__name__)
 
@@ -19,16 +38,17 @@ def Execute(root):
     sourcefiles = getSource(root)
     debug_skip = Debugger().skip('extract')
     required = root.attrib.get('required', 'false')
+    verify = root.attrib.get('verify', 'false').lower() == 'true'
+    workers = Parallel.getWorkers(root)
+    cache = root.attrib.get('cache', 'auto')
     for sourcefile in sourcefiles:
         file = sourcefile.text
         if debug_skip:
             logger.info('----Skip: extract ' + file + ' to ' + dest)
         elif os.path.exists(file):
-            copy(file, './')
-            archive = os.path.basename(file)
             # print('extract ' + archive + ' to ' + dest)
             logger.info('extract ' + file + ' to ' + dest)
-            extractArchive(archive, dest)
+            extractCached(file, dest, workers, verify, cache)
         else:
             logger.warning('attempt to extract ' + file + ' failed')
             if required.lower() == 'true':
@@ -60,17 +80,212 @@ def getSource(root):
     return list(root)
 
 
-def extractArchive(archive, dest):
-    if (zipfile.is_zipfile(archive) is True):
-        with zipfile.ZipFile(archive, 'r') as zip:
-            zip.extractall(dest)
-    if (tarfile.is_tarfile(archive) is True):
+def getInputs(root):
+    return [s.text for s in getSource(root)]
+
+
+def getOutputs(root):
+    return [root.attrib.get('dest', './')]
+
+
+CHUNK_SIZE = 1 << 20
+
+_magic = [
+    (0, b'PK\x03\x04', 'zip'),
+    (0, b'PK\x05\x06', 'zip'),       # empty zip
+    (0, b'\x1f\x8b', 'gz'),
+    (0, b'BZh', 'bz2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (257, b'ustar', ''),
+]
+
+
+def sniff(archive):
+    """
+    Return the format of archive: 'zip', the compression of a tar ('', 'gz', 'bz2', 'xz'), or None
+    """
+    with open(archive, 'rb') as fh:
+        head = fh.read(512)
+    for offset, magic, fmt in _magic:
+        if head[offset:offset + len(magic)] == magic:
+            return fmt
+    # e.g. self extracting zips, or old tars without ustar header
+    if zipfile.is_zipfile(archive):
+        return 'zip'
+    if tarfile.is_tarfile(archive):
+        return ''
+    return None
+
+
+def extractArchive(archive, dest, workers=1, verify=False, copy=None):
+    """
+    Extract archive into dest
+    :param archive:     zip or tar archive
+    :param dest:        destination directory
+    :param workers:     number of threads extracting zip members
+    :param verify:      check the size of extracted files, and fail on a broken tar archive
+    :param copy:        directory where a copy of archive is kept, written as the archive is read
+    :return:            None
+    """
+    fmt = sniff(archive)
+    if fmt == 'zip':
+        if copy is not None:
+            archive = _copy(archive, copy)
+        extractZip(archive, dest, workers, verify)
+    elif fmt is not None:
         try:
-            with tarfile.open(archive, 'r:gz') as tar:
-                tar.extractall(dest)
-        except:
+            extractTar(archive, dest, fmt, verify, copy)
+        except (tarfile.TarError, EnvironmentError, EOFError) as e:
+            if verify:
+                raise BoosterError.BoosterError(__name__, 'failed to extract {}: {}'.format(archive, e))
+            logger.warning('failed to extract {}: {}'.format(archive, e))
+    else:
+        if copy is not None:
+            _copy(archive, copy)
+        logger.warning('{} is not a zip or tar archive'.format(archive))
+
+
+def extractCached(archive, dest, workers=1, verify=False, cache='auto'):
+    """
+    Extract archive into dest, keeping a copy in the current directory taken from the artifact cache if possible
+    :param cache:       true, false or auto, see ArtifactCache.wanted
+    """
+    st = os.stat(archive)
+    local = _localCopy(archive, './')
+    store = ArtifactCache.get() if local is not None and ArtifactCache.wanted(cache, archive, st.st_size) else None
+    if store is None:
+        extractArchive(archive, dest, workers, verify, copy='./')
+        return
+    key = ArtifactCache.fileKey(archive, st)
+    # never hardlinked, a later step may rewrite the local copy in place
+    if store.lookup(key, local, hardlink=False):
+        extractArchive(local, dest, workers, verify)
+        return
+    extractArchive(archive, dest, workers, verify, copy='./')
+    # a broken archive is only reported, its copy can be incomplete
+    if os.path.isfile(local) and os.path.getsize(local) == st.st_size:
+        store.add(key, local, hardlink=False)
+
+
+def _localCopy(archive, directory):
+    """
+    :return:    path of the copy of archive in directory, removed if it exists so that writing it never modifies
+                a file it is linked to (e.g. in the artifact cache), None if archive is in directory
+    """
+    target = os.path.join(directory, os.path.basename(archive))
+    if os.path.exists(target) and os.path.samefile(archive, target):
+        return None
+    if os.path.islink(target) or os.path.exists(target):
+        os.remove(target)
+    return target
+
+
+def _copy(archive, directory):
+    target = _localCopy(archive, directory)
+    if target is None:
+        return archive
+    shutil.copy(archive, target)
+    return target
+
+
+class _Tee(object):
+    """
+    Read only file object, copying what is read into another file
+    """
+    def __init__(self, fileobj, copy):
+        self.fileobj = fileobj
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.copy.write(data)
+        return data
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def _checkSize(path, size):
+    if os.path.getsize(path) != size:
+        raise BoosterError.BoosterError(__name__, '{} has {} bytes, {} expected'.format(path, os.path.getsize(path), size))
+
+
+def extractTar(archive, dest, compression='', verify=False, copy=None):
+    """
+    Extract a tar archive in one sequential read
+    :param compression: '', 'gz', 'bz2' or 'xz', see sniff
+    """
+    target = _localCopy(archive, copy) if copy is not None else None
+    with open(archive, 'rb') as fh:
+        out = open(target, 'wb') if target is not None else None
+        try:
+            src = _Tee(fh, out) if out is not None else fh
+            tar = tarfile.open(fileobj=src, mode='r|' + compression, bufsize=CHUNK_SIZE)
             try:
-                with tarfile.open(archive, 'r') as tar:
-                    tar.extractall(dest)
-            except:
-                pass
\ No newline at end of file
+                tar.extractall(dest, members=_verified(tar, dest, verify))
+            finally:
+                tar.close()
+            if out is not None:
+                src.drain()
+        finally:
+            if out is not None:
+                out.close()
+                shutil.copymode(archive, target)
+
+
+def _verified(tar, dest, verify):
+    # members of a stream tarfile, the previous member is written when the next one is requested
+    previous = None
+    for member in tar:
+        if previous is not None:
+            _checkSize(os.path.join(dest, previous.name), previous.size)
+            previous = None
+        if verify and member.isreg():
+            previous = member
+        yield member
+    if previous is not None:
+        _checkSize(os.path.join(dest, previous.name), previous.size)
+
+
+def extractZip(archive, dest, workers=1, verify=False):
+    """
+    Extract a zip archive, members are extracted in parallel. A corrupted member raises BadZipfile
+    """
+    with zipfile.ZipFile(archive, 'r') as zf:
+        members = zf.infolist()
+        files = []
+        for info in members:
+            if info.filename.endswith('/'):
+                zf.extract(info, dest)
+            else:
+                files.append(info)
+    # create the directories first, threads would race on them
+    for d in sorted(set(os.path.dirname(_safeName(info.filename)) for info in files)):
+        if d and not os.path.isdir(os.path.join(dest, d)):
+            os.makedirs(os.path.join(dest, d))
+    local = threading.local()
+    opened = []
+
+    def extract(info):
+        if not hasattr(local, 'zf'):
+            local.zf = zipfile.ZipFile(archive, 'r')
+            opened.append(local.zf)
+        path = local.zf.extract(info, dest)
+        if verify:
+            _checkSize(path, info.file_size)
+
+    pool = ThreadPool(max(1, min(workers, len(files))))
+    try:
+        pool.map(extract, files, chunksize=4)
+    finally:
+        pool.close()
+        pool.join()
+        for zf in opened:
+            zf.close()
+
+
+def _safeName(name):
+    # the path zipfile extracts name to, relative to the destination
+    parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.', '..')]
+    return '/'.join(parts)
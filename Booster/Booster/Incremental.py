@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental build steps
+
+An action with incremental="true" is skipped when it already ran successfully on this agent with the same
+attributes and text (after variable expansion), its inputs are unchanged, and its outputs still exist.
+
+    <Extract incremental="true" dest="sdk"><Item>$(SDK_ZIP)</Item></Extract>
+    <Make incremental="true" inputs="src/*.cpp;src/*.h" outputs="bin/libdriver.so">...</Make>
+
+    inputs          files, directories or globs read by the action, separated by ';'. Directories are walked.
+    outputs         files or directories produced by the action, separated by ';'
+
+Action modules provide defaults for both with getInputs(root)/getOutputs(root), OOP actions by overriding
+Action._inputs()/_outputs(). An action without any output is never skipped.
+
+The fingerprint manifest of an action is saved in the 'incremental' directory of the agent cache
+(see AtaUtil.get_cache_dir), keyed by the working directory and the expanded element. Inputs and outputs are
+compared by size and modification time, the files of directories included.
+"""
+from __future__ import print_function
+import glob
+import hashlib
+import json
+import os
+import re
+
+import AtaUtil
+import ata.log
+from Booster.Debug import Debug as Debugger
+
+logger = ata.log.AtaLog(__name__)
+
+_active = set()         # id of elements whose fingerprint is taken care of by a caller
+
+
+def isIncremental(root):
+    return root.attrib.get('incremental', 'false').lower() == 'true'
+
+
+def getPaths(root, name, default=None):
+    """
+    Return the paths declared by attribute name (inputs/outputs), or default if the attribute is not set
+    """
+    value = root.attrib.get(name)
+    if value is None:
+        return [p for p in (default or []) if p]
+    return [p.strip() for p in re.split(r'[;\n]', value) if p.strip()]
+
+
+def _canonical(root):
+    attrib = sorted((k, v) for k, v in root.attrib.items())
+    children = [_canonical(c) for c in root]
+    return [root.tag, attrib, (root.text or '').strip(), children]
+
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_size, int(st.st_mtime * 1000)]
+
+
+def _walk(path):
+    """
+    Yield the files of directory path, in a stable order
+    """
+    for dirpath, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            fname = os.path.join(dirpath, f)
+            if os.path.isfile(fname):
+                yield fname
+
+
+def _statPaths(patterns):
+    result = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        result[pattern] = len(matches)
+        for path in matches:
+            if os.path.isdir(path):
+                for fname in _walk(path):
+                    result[fname] = _stat(fname)
+            elif os.path.isfile(path):
+                result[path] = _stat(path)
+    return result
+
+
+def _statOutputs(paths):
+    result = {}
+    for path in paths:
+        if os.path.isfile(path):
+            result[path] = _stat(path)
+        elif os.path.isdir(path):
+            result[path] = dict((os.path.relpath(fname, path), _stat(fname)) for fname in _walk(path))
+        else:
+            result[path] = None
+    return result
+
+
+class Fingerprint(object):
+    """
+    Fingerprint of an incremental action: its expanded element, its inputs and its outputs
+    """
+    def __init__(self, root, inputs, outputs):
+        self.name = root.tag
+        key = json.dumps([os.getcwd(), _canonical(root)])
+        self.key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(AtaUtil.get_cache_dir('incremental'), self.key + '.json')
+        self.outputs = outputs
+        self.inputs = _statPaths(inputs)       # snapshot before the action runs
+
+    def upToDate(self):
+        """
+        Return True if the last successful run had the same inputs, and its outputs are untouched
+        """
+        try:
+            with open(self.path, 'r') as fh:
+                m = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return False
+        if m.get('inputs') != self.inputs:
+            return False
+        outputs = m.get('outputs', {})
+        if len(outputs) == 0 or outputs != _statOutputs(list(outputs.keys())):
+            return False
+        return None not in outputs.values()
+
+    def save(self):
+        """
+        Save the manifest after a successful run
+        """
+        m = {'tag': self.name, 'inputs': self.inputs, 'outputs': _statOutputs(self.outputs)}
+        tmp = self.path + '.tmp{}'.format(os.getpid())
+        try:
+            with open(tmp, 'w') as fh:
+                json.dump(m, fh, indent=1, sort_keys=True)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.warning('failed to save incremental manifest of {}: {}'.format(self.name, e))
+
+
+def fingerprint(root, inputs=None, outputs=None):
+    """
+    Return the fingerprint of an incremental action, None if the action is not incremental or already handled
+    :param root:        XML node of the action
+    :param inputs:      default inputs, used if the inputs attribute is not set
+    :param outputs:     default outputs, used if the outputs attribute is not set
+    :return:            Fingerprint or None
+    """
+    if not isIncremental(root) or id(root) in _active or Debugger().skip('incremental'):
+        return None
+    outputs = getPaths(root, 'outputs', outputs)
+    if len(outputs) == 0:
+        logger.warning('{}: incremental is ignored, no outputs are declared'.format(root.tag))
+        return None
+    return Fingerprint(root, getPaths(root, 'inputs', inputs), outputs)
+
+
+def execute(f, root, inputs=None, outputs=None):
+    """
+    Call f(root) unless the incremental action is up to date
+    :return:            True if f was called
+    """
+    fp = fingerprint(root, inputs, outputs)
+    if fp is None:
+        f(root)
+        return True
+    if fp.upToDate():
+        logger.info('----Skip: {} is up to date'.format(root.tag))
+        return False
+    _active.add(id(root))
+    try:
+        f(root)
+    finally:
+        _active.discard(id(root))
+    fp.save()
+    return True
+
+
+def executeAction(action, root):
+    """
+    Dispatch an ActionRegistry entry, skipping it if it's incremental and up to date. OOP actions deriving
+    from Action take care of their own fingerprint, unless the outputs are declared on the element or by the module
+    """
+    module = action.module
+    hooked = module is not None and hasattr(module, 'getOutputs')
+    if isIncremental(root) and not hooked and 'outputs' not in root.attrib and _isOOP(module):
+        action.execute(root)
+        return True
+    inputs = module.getInputs(root) if module is not None and hasattr(module, 'getInputs') else None
+    outputs = module.getOutputs(root) if hooked and isIncremental(root) else None
+    return execute(action.execute, root, inputs, outputs)
+
+
+def _isOOP(module):
+    from Booster.Action import Action
+    if module is None:
+        return False
+    for v in vars(module).values():
+        if isinstance(v, type) and issubclass(v, Action) and v is not Action:
+            return True
+    return False
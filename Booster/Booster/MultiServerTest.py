@@ -171,11 +171,7 @@ def _update_suite_file(suite_file, replacement_tag, running_servers, extra_repla
         
     replacement = "\n".join(create_server_xml(server) for server in running_servers)
 
-    ReplaceInFile.replace(suite_file, '<'+replacement_tag+'/>', replacement)
-    
-    # TODO: Make this more efficient than doing a whole-file replacement multiple times
-    for needle, replacement in extra_replacements:
-        ReplaceInFile.replace(suite_file, needle, replacement)
+    ReplaceInFile.replaceMany(suite_file, [('<'+replacement_tag+'/>', replacement)] + list(extra_replacements))
     
 def _stop_servers(started_servers):
     for server in started_servers:
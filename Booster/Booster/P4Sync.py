@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+import tempfile
 import Command
 from Booster.Debug import Debug as Debugger
 
@@ -61,6 +62,56 @@ def unshelvedepot(p4exe, changelist, depot):
         Command.ExecuteAndGetResult(command)
 
 
+def syncBatch(p4, revisions):
+    """
+    Same as sync for many files, with one p4 command per step instead of one per file
+    :param revisions:   list of (depot, label)
+    """
+    depots = [depot for depot, label in revisions]
+    if Debugger().skip('p4sync', '----Skip: {} sync {} files'.format(p4, len(depots))):
+        return
+    runBatch(p4 + ' revert', depots)
+    runBatch(p4 + ' -s sync -f', [depot + '#0' for depot in depots])
+    runBatch(p4 + ' -s sync', [depot + label for depot, label in revisions])
+
+
+def unshelveBatch(p4exe, changelist, depots):
+    """
+    Same as unshelvedepot for many files
+    """
+    if changelist == '' or not depots:
+        return
+    if Debugger().skip('p4sync', '----Skip: {} unshelve -s {} {} files'.format(p4exe, changelist, len(depots))):
+        return
+    runBatch(p4exe + ' unshelve -s ' + changelist, depots)
+
+
+def runBatch(command, args):
+    """
+    Run a p4 command once for a list of file arguments, given in an argument file (p4 -x)
+    :param command:     p4 executable followed by the command, e.g. "p4" -s sync
+    """
+    if not args:
+        return None
+    p4, rest = _splitExe(command)
+    fd, argfile = tempfile.mkstemp(prefix='p4args', suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write('\n'.join(args) + '\n')
+        return Command.ExecuteAndGetResult('{} -x "{}" {}'.format(p4, argfile, rest))
+    finally:
+        os.remove(argfile)
+
+
+def _splitExe(command):
+    # the executable is quoted by getP4Exe
+    if command.startswith('"'):
+        end = command.index('"', 1) + 1
+    else:
+        end = command.find(' ') if ' ' in command else len(command)
+    return command[:end], command[end:].strip()
+
+
 def tag():
     print('')
 
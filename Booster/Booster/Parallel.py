@@ -0,0 +1,275 @@
+from __future__ import print_function
+"""
+    Run independent actions concurrently
+
+    <Parallel workers="4">
+        <Extract name="sdk">...</Extract>
+        <Artifactory name="driver">...</Artifactory>
+        <Copy depends="sdk,driver">...</Copy>
+    </Parallel>
+
+    The children of <Parallel> (or consecutive sibling actions sharing the same group="..." attribute) form a DAG:
+    an action starts once every action named in its depends="..." attribute succeeded, and at most workers
+    actions run at the same time (default BOOSTER_PARALLEL_WORKERS, or the number of cpus). Everything outside
+    a group keeps running in document order, a group is a barrier in that sequence.
+
+    Each action runs in a forked process with its output redirected to log/parallel/<name>.log, which is
+    printed once the action is done, so logs of concurrent actions never interleave. Actions run in their own
+    process, changes of environment variables or current directory are not visible to the following actions.
+    The first failure terminates the running siblings, and cancels the ones not started yet.
+    On platforms without fork (Windows), the group runs sequentially in dependency order.
+"""
+
+__all__ = ['Execute', 'Debug', 'run']
+
+import errno
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import time
+import traceback
+
+import ActionRegistry
+import Incremental
+import ata.log
+from BoosterError import BoosterError, BoosterTagError
+
+logger = ata.log.AtaLog(__name__)
+LOG_DIR = os.path.join('log', 'parallel')
+
+
+def Execute(root):
+    print('==============================')
+    print('        Enter Parallel')
+    print('==============================')
+    run(getActions(root), getWorkers(root))
+
+
+def Debug(root):
+    print('==============================')
+    print('        Enter Parallel')
+    print('==============================')
+    run(getActions(root), getWorkers(root), dry=True)
+
+
+def getActions(root):
+    return [child for child in root if ActionRegistry.lookup(child.tag) is not None]
+
+
+def getWorkers(root=None):
+    workers = os.environ.get('BOOSTER_PARALLEL_WORKERS', '')
+    if root is not None:
+        workers = root.attrib.get('workers', workers)
+    try:
+        workers = int(workers)
+    except ValueError:
+        workers = multiprocessing.cpu_count()
+    return max(1, workers)
+
+
+def isParallelChild(element):
+    """
+    Return True if the element is inside a <Parallel> tag, such an element is executed by Parallel
+    """
+    p = getattr(element, 'parent', None)
+    while p is not None:
+        p = p()
+        if p is None:
+            break
+        if p.tag == 'Parallel':
+            return True
+        p = getattr(p, 'parent', None)
+    return False
+
+
+def groupMembers(element):
+    """
+    Return the consecutive sibling actions sharing the group attribute of element, element included
+    """
+    group = element.attrib.get('group')
+    p = getattr(element, 'parent', None)
+    p = p() if p is not None else None
+    if group is None or p is None:
+        return [element]
+    siblings = list(p)
+    members = []
+    for e in siblings[siblings.index(element):]:
+        if ActionRegistry.lookup(e.tag) is None:
+            continue
+        if e.attrib.get('group') != group:
+            break
+        members.append(e)
+    return members
+
+
+class _Node(object):
+    def __init__(self, element, index):
+        self.element = element
+        self.name = element.attrib.get('name', '{}#{}'.format(element.tag, index))
+        self.depends = [d.strip() for d in element.attrib.get('depends', '').split(',') if d.strip()]
+        self.pid = None
+        self.log = os.path.join(LOG_DIR, re.sub(r'[^\w.\-#]', '_', self.name) + '.log')
+        self.start = None
+
+
+def _plan(elements):
+    nodes = [_Node(e, i) for i, e in enumerate(elements)]
+    names = {}
+    for n in nodes:
+        if n.name in names:
+            raise BoosterTagError(__name__, 'duplicate action name {}'.format(n.name))
+        names[n.name] = n
+    for n in nodes:
+        for d in n.depends:
+            if d not in names:
+                raise BoosterTagError(__name__, '{} depends on unknown action {}'.format(n.name, d))
+    return nodes
+
+
+def run(elements, workers=1, dry=False):
+    """
+    Run actions concurrently according to their dependencies
+    :param elements:    action elements
+    :param workers:     maximum number of actions running at the same time
+    :param dry:         call Debug of the actions instead of Execute, sequentially
+    :return:            None, raise BoosterError on the first failure
+    """
+    nodes = _plan(elements)
+    if len(nodes) == 0:
+        return
+    for n in nodes:
+        logger.info('{name} depends on [{depends}]'.format(name=n.name, depends=', '.join(n.depends)))
+    if dry or not hasattr(os, 'fork') or workers == 1 or len(nodes) == 1:
+        if not dry and workers > 1 and len(nodes) > 1:
+            logger.warning('fork is not supported, run {} actions sequentially'.format(len(nodes)))
+        _runSequential(nodes, dry)
+    else:
+        _runForked(nodes, workers)
+
+
+def _perform(node, dry=False):
+    action = ActionRegistry.lookup(node.element.tag)
+    if dry:
+        if action.debug is not None:
+            action.debug(node.element)
+    elif action.execute is not None:
+        Incremental.executeAction(action, node.element)
+
+
+def _ready(pending, done):
+    return [n for n in pending if all(d in done for d in n.depends)]
+
+
+def _runSequential(nodes, dry):
+    pending = list(nodes)
+    done = set()
+    while pending:
+        ready = _ready(pending, done)
+        if not ready:
+            raise BoosterTagError(__name__, 'circular depends among ' + ', '.join(n.name for n in pending))
+        for n in ready:
+            _perform(n, dry)
+            done.add(n.name)
+            pending.remove(n)
+
+
+def _spawn(node):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid != 0:
+        # set by both sides, so that the group exists before the parent may signal it
+        try:
+            os.setpgid(pid, pid)
+        except OSError as e:
+            if e.errno not in (errno.EACCES, errno.ESRCH):     # the child already exec'd or exited
+                raise
+        return pid
+    # child, in its own process group so that it can be terminated with its commands
+    code = 1
+    try:
+        os.setpgid(0, 0)
+        fd = os.open(node.log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        _perform(node)
+        code = 0
+    except SystemExit as e:
+        code = 0 if e.code is None else e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+def _dumpLog(node, status):
+    print('------------------------------ [{}] {} ------------------------------'.format(node.name, status))
+    try:
+        with open(node.log, 'r') as fh:
+            for line in fh:
+                sys.stdout.write(line)
+    except IOError as e:
+        logger.warning('cannot read {}: {}'.format(node.log, e))
+    sys.stdout.flush()
+
+
+def _wait(running):
+    # block until one of our children exits, other children (e.g. background commands) are not expected here
+    while True:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid in running:
+            return running.pop(pid), status
+        logger.warning('reaped pid {} that is not a parallel action'.format(pid))
+
+
+def _runForked(nodes, workers):
+    if not os.path.isdir(LOG_DIR):
+        os.makedirs(LOG_DIR)
+    pending = list(nodes)
+    running = {}
+    done = set()
+    failed = None
+    while (pending and failed is None) or running:
+        if failed is None:
+            for n in _ready(pending, done)[:workers - len(running)]:
+                pending.remove(n)
+                n.start = time.time()
+                n.pid = _spawn(n)
+                running[n.pid] = n
+                logger.info('start {} (pid {})'.format(n.name, n.pid))
+            if not running:
+                failed = 'circular depends among ' + ', '.join(n.name for n in pending)
+                break
+        n, status = _wait(running)
+        elapsed = time.time() - n.start
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            done.add(n.name)
+            _dumpLog(n, 'succeeded in {:.1f}s'.format(elapsed))
+            continue
+        if failed is not None:
+            _dumpLog(n, 'terminated after {:.1f}s'.format(elapsed))
+            continue
+        _dumpLog(n, 'failed in {:.1f}s'.format(elapsed))
+        failed = '{} failed'.format(n.name)
+        for other in running.values():
+            logger.info('terminate {} (pid {})'.format(other.name, other.pid))
+            try:
+                os.killpg(other.pid, signal.SIGTERM)     # the action and the commands it started
+            except OSError:
+                pass
+    if failed is not None:
+        if pending:
+            logger.info('cancelled: ' + ', '.join(n.name for n in pending))
+        raise BoosterError(__name__, failed)
@@ -1,11 +1,28 @@
 from __future__ import print_function
-import fileinput
+"""
+    Replace strings in files
+
+    <ReplaceInFile file="odbc.ini">
+        <Item newstring="new">old</Item>
+        <Item newstring="\1=1" regex="true">^(\w+)=0$</Item>
+    </ReplaceInFile>
+
+    All items are applied in one pass over each file, see Replacer.
+
+    With bulkReplace="true", file is a directory and every file under it is screened first: binaries (files with
+    a NUL byte in their first block) and files that can't match any item are skipped without being rewritten.
+    The files are processed by a pool of workers processes (attribute workers, see Parallel.getWorkers).
+"""
+import mmap
+import multiprocessing
 import os
-import Remove
 import re
+import shutil
+import time
 import ata.log
 import sys
-from BoosterError import BoosterTagError, FileNotFoundError
+import Parallel
+from BoosterError import BoosterError, BoosterTagError, FileNotFoundError
 
 logger = ata.log.AtaLog(__name__)
 
@@ -15,13 +32,19 @@ def Execute(root):
     print('==============================')
 
     files = getFile(root)
+    replacements = []
     for element in list(root):
         source = element.text
         dest = element.attrib.get('newstring', '')
         useRegex = element.attrib.get('regex', 'False')
         print(source + ' => ' + dest)
+        replacements.append((source, dest, useRegex))
+    if root.attrib.get('bulkReplace', 'false') == 'false':
+        replacer = Replacer(replacements)
         for file in files:
-            replace(file, source, dest, useRegex)
+            replacer.apply(file)
+    else:
+        bulkReplace(files, replacements, Parallel.getWorkers(root))
 
 
 def Debug(root):
@@ -62,20 +85,206 @@ def getFile(root):
     return fileLists
 
 
-def replace(file, source, dest, useRegex=None, re_flags=0):
-    Remove.removeSingleFile(file + '.bak')
-    if isinstance(useRegex, basestring):
-        useRegex = useRegex.upper() == 'TRUE'
-    elif re_flags != 0:
-        useRegex = True
-    f = fileinput.FileInput(file, inplace=True, backup='.bak')
+def _isRegex(useRegex, re_flags):
+    if isinstance(useRegex, str) or (sys.version_info[0] < 3 and isinstance(useRegex, basestring)):
+        return useRegex.upper() == 'TRUE'
+    return bool(useRegex) or re_flags != 0
+
+
+class Replacer(object):
+    """
+    A list of replacements applied line by line in one pass
+
+    Each replacement is a tuple (source, dest[, useRegex[, re_flags]]), useRegex being a bool or 'true'/'false'.
+    Replacements are applied in order. Consecutive literal replacements are matched together by a single
+    alternation (longest source first), so they don't apply to the output of each other; a regex replacement
+    sees the result of all the replacements before it, as with successive calls of replace().
+    """
+    def __init__(self, replacements):
+        self.replacements = list(replacements)
+        self.steps = []
+        self.needles = []       # bytes or compiled bytes regex screening files, None if a file can't be screened
+        literals = {}
+        for r in self.replacements:
+            source, dest = r[0], r[1]
+            useRegex = r[2] if len(r) > 2 else None
+            re_flags = r[3] if len(r) > 3 else 0
+            if not source:
+                continue
+            if _isRegex(useRegex, re_flags):
+                self._flush(literals)
+                literals = {}
+                self.steps.append((re.compile(source, re_flags), dest))
+                self.needles.append(_bytesRegex(source, re_flags))
+            elif source not in literals:
+                literals[source] = dest
+                self.needles.append(_bytes(source))
+        self._flush(literals)
+
+    def _flush(self, literals):
+        if len(literals) == 0:
+            return
+        sources = sorted(literals.keys(), key=len, reverse=True)
+        pattern = re.compile('|'.join(re.escape(source) for source in sources))
+        self.steps.append((pattern, lambda m: literals[m.group(0)]))
+
+    def sub(self, line):
+        for pattern, dest in self.steps:
+            line = pattern.sub(dest, line)
+        return line
+
+    def screen(self, file):
+        """
+        Tell whether apply may change file, without reading it line by line. No replacement can match the output
+        of another one unless the first one matched, so a file where no source matches is left unchanged
+        :param file:    file name
+        :return:        None for a binary file, else False if the file can't match any replacement
+        """
+        with open(file, 'rb') as fh:
+            if b'\0' in fh.read(8192):
+                return None
+            try:
+                data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return False        # empty file
+        try:
+            for needle in self.needles:
+                if needle is None:
+                    return True
+                if isinstance(needle, bytes):
+                    if data.find(needle) != -1:
+                        return True
+                elif needle.search(data) is not None:
+                    return True
+            return False
+        finally:
+            data.close()
+
+    def apply(self, file):
+        """
+        Rewrite file with the replacements applied. The result is written to a temporary file next to it, which
+        replaces file only if something changed
+        :param file:    file name
+        :return:        True if the file was changed
+        """
+        if len(self.steps) == 0:
+            return False
+        dirname = os.path.dirname(os.path.abspath(file))
+        tmp = os.path.join(dirname, '.{}.{}.tmp'.format(os.path.basename(file), os.getpid()))
+        changed = False
+        try:
+            with open(file, 'r') as src, open(tmp, 'w') as dst:
+                for line in src:
+                    new = self.sub(line)
+                    if new != line:
+                        changed = True
+                    dst.write(new)
+            if changed:
+                shutil.copymode(file, tmp)
+                if os.name == 'nt':
+                    os.remove(file)     # rename doesn't overwrite on windows
+                os.rename(tmp, file)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return changed
+
+
+def _bytes(s):
+    return s if isinstance(s, bytes) else s.encode('utf-8')
+
+
+def _bytesRegex(source, re_flags):
+    # the screening regex runs on the bytes of the whole file instead of a line, it's only trusted when anchors
+    # can't differ, and when the pattern matches the same on bytes and on text
+    if '$' in source:
+        return None
+    if sys.version_info[0] >= 3 and (re.search(r'\\[wWbBsSdD]', source) or (re_flags & re.IGNORECASE and
+                                                                          re.search(r'[^\x00-\x7f]', source))):
+        return None
     try:
-        for line in f:
-            if useRegex:
-                line = re.sub(source, dest, line, flags=re_flags)
-                sys.stdout.write(line)
-            else:
-                sys.stdout.write(line.replace(source, dest))
-    finally:
-        f.close()
-    Remove.removeSingleFile(file + '.bak')
+        return re.compile(_bytes(source), (re_flags & ~re.UNICODE) | re.MULTILINE)
+    except (re.error, ValueError, TypeError):
+        return None
+
+
+_worker = None
+
+
+def _initWorker(replacements):
+    global _worker
+    _worker = Replacer(replacements)
+
+
+def _bulkOne(file):
+    try:
+        match = _worker.screen(file)
+        if match is None:
+            return file, 'binary', 0
+        if not match:
+            return file, 'skipped', 0
+        if _worker.apply(file):
+            return file, 'rewritten', os.path.getsize(file)
+        return file, 'unchanged', 0
+    except (IOError, OSError, UnicodeError) as e:
+        return file, 'failed: {}'.format(e), 0
+
+
+def bulkReplace(files, replacements, workers=1):
+    """
+    Apply replacements to many files, screening them first and rewriting the matching ones on a process pool
+    :param files:           file names
+    :param replacements:    list of (source, dest[, useRegex[, re_flags]]), see Replacer
+    :param workers:         number of processes, 1 to run in this process
+    :return:                dict of status (binary, skipped, unchanged, rewritten, failed) to number of files
+    """
+    start = time.time()
+    summary = {'binary': 0, 'skipped': 0, 'unchanged': 0, 'rewritten': 0, 'failed': 0}
+    rewritten = 0
+    if workers > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(min(workers, len(files)), _initWorker, (replacements,))
+        try:
+            results = pool.imap_unordered(_bulkOne, files, chunksize=16)
+            summary, rewritten = _summarize(results, summary)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _initWorker(replacements)
+        summary, rewritten = _summarize((_bulkOne(file) for file in files), summary)
+    logger.info('Bulk replace: {total} files in {seconds:.1f}s, {rewritten} rewritten ({size} bytes), '
+                '{unchanged} unchanged, {skipped} without match, {binary} binaries, {failed} failed'
+                .format(total=len(files), seconds=time.time() - start, size=rewritten, **summary))
+    if summary['failed'] > 0:
+        raise BoosterError(__name__, 'failed to replace in {} files'.format(summary['failed']))
+    return summary
+
+
+def _summarize(results, summary):
+    rewritten = 0
+    for file, status, size in results:
+        if status.startswith('failed'):
+            logger.warning('cannot replace in {}: {}'.format(file, status))
+            status = 'failed'
+        elif status == 'rewritten':
+            logger.debug('rewritten ' + file)
+        summary[status] += 1
+        rewritten += size
+    return summary, rewritten
+
+
+def replace(file, source, dest, useRegex=None, re_flags=0):
+    """
+    Replace source by dest in file, source is a regex if useRegex is true or re_flags is set
+    """
+    return Replacer([(source, dest, useRegex, re_flags)]).apply(file)
+
+
+def replaceMany(file, replacements):
+    """
+    Apply a list of replacements to file in one pass, see Replacer
+    :param file:            file name
+    :param replacements:    list of (source, dest[, useRegex[, re_flags]])
+    :return:                True if the file was changed
+    """
+    return Replacer(replacements).apply(file)
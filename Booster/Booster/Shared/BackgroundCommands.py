@@ -26,9 +26,9 @@ import os
 import os.path
 import atexit
 import re
-import gzip
 import shutil
 import Booster.Shared.CrashUtils as CU
+import Booster.Shared.CrashPipeline as CrashPipeline
 import ata.log
 
 _py_version = sys.version_info.major
@@ -753,22 +753,10 @@ class AppProcess(App):
         else:
             cores = core_file
 
+        # the backtrace is extracted while the core is compressed in parallel chunks
         msg = ''
         for core_f in cores:
-            msg += "Core-dump: {}\n".format(core_f)
-            if _is_posix:
-                try:
-                    msg += CU.get_back_trace(self.cmd[0], core_f)
-                except Exception as e:
-                    msg += 'exception at getting back trace: ' + str(e)
-            # compress it
-            try:
-                with open(core_f, 'rb') as f_in, gzip.open(core_f + '.gz', 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-                if os.path.exists(core_f + '.gz'):
-                    os.remove(core_f)
-            except IOError as e:
-                msg += '==== fail to compress: {}'.format(e)
+            msg += CrashPipeline.processCore(self.cmd[0], core_f, _is_posix)
         if msg:
             # add indent and prefix for every line
             for msg_line in msg.split('\n'):
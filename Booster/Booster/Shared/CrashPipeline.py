@@ -0,0 +1,111 @@
+"""Background processing of saved core dumps: backtrace and compression
+
+Getting the backtrace of a multi-GB core and compressing it take minutes. A CrashPipeline processes cores on a
+pool of threads so that the caller (e.g. the monitor relaunching Touchstone) goes on right away, and collects
+the reports later. For each core the backtrace is extracted while the core is compressed, in chunks deflated in
+parallel (see Archive.gzipFile); the core is removed once both are done.
+"""
+
+__all__ = ['CrashPipeline', 'processCore']
+
+import collections
+import multiprocessing
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import ata.log
+import Booster.Shared.CrashUtils as CU
+from Booster.Archive import gzipFile
+
+logger = ata.log.AtaLog(__name__)
+
+
+def _text(data):
+    if isinstance(data, bytes) and not isinstance(data, str):
+        return data.decode('utf-8', 'replace')
+    return data
+
+
+def processCore(app, core, backtrace=True, workers=None):
+    """
+    Get the backtrace of a core and compress it to core.gz
+        app         binary that dumped the core
+        core        core file
+        backtrace   False to compress only
+        workers     number of compressing threads, default is the number of cpus
+
+    :return:        the report, i.e. the core name and its backtrace
+    """
+    result = []
+
+    def get_back_trace():
+        try:
+            result.append(_text(CU.get_back_trace(app, core)) or '')
+        except Exception as e:
+            result.append('exception at getting back trace: {}\n'.format(e))
+
+    thread = None
+    if backtrace:
+        thread = threading.Thread(target=get_back_trace)
+        thread.start()
+    error = ''
+    try:
+        gzipFile(core, core + '.gz', workers or multiprocessing.cpu_count())
+    except (IOError, OSError) as e:
+        error = '==== fail to compress: {}\n'.format(e)
+    finally:
+        if thread is not None:
+            thread.join()
+    if not error and os.path.exists(core + '.gz'):
+        os.remove(core)
+        name = core + '.gz'
+    else:
+        name = core
+    return 'Core-dump: {}\n{}{}'.format(name, ''.join(result), error)
+
+
+class CrashPipeline(object):
+    """
+    Cores submitted with a tag are processed in the background, reports are collected in submission order
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.pool = None
+        self.pending = collections.deque()
+
+    def submit(self, app, core, backtrace=True, tag=None):
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        logger.info('processing {} in background'.format(core))
+        self.pending.append((tag, self.pool.apply_async(processCore, (app, core, backtrace))))
+
+    def collect(self, wait=False):
+        """
+        Return the reports that are ready
+            wait        wait for all submitted cores
+
+        :return:        list of (tag, report)
+        """
+        reports = []
+        while self.pending and (wait or self.pending[0][1].ready()):
+            tag, job = self.pending.popleft()
+            try:
+                reports.append((tag, job.get()))
+            except Exception as e:
+                reports.append((tag, 'fail to process core: {}\n'.format(e)))
+        return reports
+
+    def close(self):
+        """
+        Wait for all submitted cores
+        :return:        list of (tag, report) not collected yet
+        """
+        try:
+            return self.collect(wait=True)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
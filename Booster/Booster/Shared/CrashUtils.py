@@ -1,16 +1,25 @@
 """Utilities to deal with process crashes (getting core dumps, stack traces)
+
+On Linux, backtraces are decoded by a gdb session kept alive per binary (see GdbSession), so that the symbols of
+Touchstone and the driver are loaded once for all the cores of a run. The crashing frames of each core make a
+signature: a core with the same binary (build-id) and signature as a previous one only reports its crashing
+thread, with a reference to the first core.
 """
 
-__all__ = ['save_core_dump', 'find_and_save_core_dump', 'get_back_trace']
+__all__ = ['save_core_dump', 'find_and_save_core_dump', 'get_back_trace', 'get_build_id']
 
 import ata.log
+import atexit
+import binascii
 import os
 import os.path
 import platform
 import re
 import shutil
 import glob
+import struct
 import subprocess
+import threading
 
 logger = ata.log.AtaLog(__name__)
 
@@ -149,6 +158,154 @@ def find_and_save_core_dump(pid, working_dir, output_dir, core_file_name=None, o
     return core
 
 
+def get_build_id(app):
+    """
+    Return the GNU build-id of an ELF binary, or its path, size and mtime if it has none
+    """
+    try:
+        with open(app, 'rb') as f:
+            header = f.read(64)
+            if header[:4] == b'\x7fELF':
+                is64 = header[4:5] == b'\x02'
+                e = '<' if header[5:6] == b'\x01' else '>'
+                if is64:
+                    phoff, = struct.unpack(e + 'Q', header[32:40])
+                    phentsize, phnum = struct.unpack(e + 'HH', header[54:58])
+                else:
+                    phoff, = struct.unpack(e + 'I', header[28:32])
+                    phentsize, phnum = struct.unpack(e + 'HH', header[42:46])
+                for i in range(phnum):
+                    f.seek(phoff + i * phentsize)
+                    ph = f.read(phentsize)
+                    if is64:
+                        p_type, = struct.unpack(e + 'I', ph[:4])
+                        offset, = struct.unpack(e + 'Q', ph[8:16])
+                        size, = struct.unpack(e + 'Q', ph[32:40])
+                    else:
+                        p_type, offset = struct.unpack(e + 'II', ph[:8])
+                        size, = struct.unpack(e + 'I', ph[16:20])
+                    if p_type != 4:     # PT_NOTE
+                        continue
+                    f.seek(offset)
+                    notes = f.read(size)
+                    pos = 0
+                    while pos + 12 <= len(notes):
+                        namesz, descsz, n_type = struct.unpack(e + 'III', notes[pos:pos + 12])
+                        desc = pos + 12 + ((namesz + 3) & ~3)
+                        if n_type == 3 and notes[pos + 12:pos + 12 + namesz].rstrip(b'\0') == b'GNU':
+                            return binascii.hexlify(notes[desc:desc + descsz]).decode('ascii')
+                        pos = desc + ((descsz + 3) & ~3)
+        st = os.stat(app)
+        return '{}:{}:{}'.format(os.path.realpath(app), st.st_size, int(st.st_mtime))
+    except (IOError, OSError, struct.error):
+        return app
+
+
+class GdbSession(object):
+    """
+    gdb process kept alive to decode the cores of one binary, commands are sent through its stdin
+    """
+    END = '__booster_gdb_end__'
+    _sessions = {}
+    _starting = {}      # key: lock held while its session starts, other keys are served meanwhile
+    _lock = threading.Lock()
+
+    def __init__(self, gdb, app):
+        self.app = app
+        self.lock = threading.RLock()     # held by run, or by a caller across a sequence of commands
+        self.proc = subprocess.Popen([gdb, '--quiet', '--nx', '-ex', 'set pagination off', '-ex', 'set confirm off',
+                                      '-ex', 'set width 0', '-ex', 'set height 0', app],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     universal_newlines=True)
+        self.run()      # wait until the symbols are loaded
+
+    @classmethod
+    def get(cls, gdb, app):
+        """
+        Return the session of app, started on the first call (or if the binary was rebuilt)
+        """
+        key = (os.path.realpath(app), get_build_id(app))
+        with cls._lock:
+            session = cls._sessions.get(key)
+            if session is not None and session.proc.poll() is None:
+                return session
+            starting = cls._starting.setdefault(key, threading.Lock())
+        with starting:
+            with cls._lock:
+                session = cls._sessions.get(key)
+            if session is None or session.proc.poll() is not None:      # not started by another thread meanwhile
+                logger.info('start gdb session for {}'.format(app))
+                session = GdbSession(gdb, app)
+                with cls._lock:
+                    cls._sessions[key] = session
+            return session
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions.clear()
+
+    def run(self, *commands):
+        """
+        Run gdb commands
+        :return:    their output
+        """
+        with self.lock:
+            for command in commands + ('echo {}\\n'.format(self.END),):
+                self.proc.stdin.write(command + '\n')
+            self.proc.stdin.flush()
+            lines = []
+            while True:
+                line = self.proc.stdout.readline()
+                if not line:
+                    raise CrashUtilsException('gdb exited')
+                line = re.sub(r'^(\(gdb\) )+', '', line)
+                if line.rstrip() == self.END:
+                    return ''.join(lines)
+                lines.append(line)
+
+    def close(self):
+        try:
+            if self.proc.poll() is None:
+                self.proc.stdin.write('quit\n')
+                self.proc.stdin.close()
+                self.proc.wait()
+        except (IOError, OSError):
+            self.proc.kill()
+
+
+atexit.register(GdbSession.close_all)
+
+_signatures = {}        # (build-id, crashing frames): first core
+_signatures_lock = threading.Lock()
+
+
+def _crash_signature(bt, depth=5):
+    """
+    Return the function names of the top frames of a backtrace, without addresses and arguments
+    """
+    frames = re.findall(r'^#\d+\s+(?:0x[0-9a-fA-F]+ in )?(\S+)', bt, re.MULTILINE)
+    return tuple(frames[:depth])
+
+
+def _gdb_back_trace(gdb, app, core):
+    session = GdbSession.get(gdb, app)
+    # the session is shared by the pipeline threads, no other core may be loaded until the last command
+    with session.lock:
+        header = session.run('core-file ' + core)
+        crashing = session.run('bt')
+        signature = _crash_signature(crashing)
+        first = core
+        if signature:
+            with _signatures_lock:
+                first = _signatures.setdefault((get_build_id(app), signature), core)
+        if first != core:
+            return '{}{}(same crashing frames as {}, other threads are not reported)\n'.format(header, crashing, first)
+        return header + session.run('thread apply all bt')
+
+
 def get_back_trace(app, core):
     def find_app(app):
         """ Return the full path of an app by searching $PATH
@@ -192,7 +349,12 @@ def get_back_trace(app, core):
             """
             pfn = platform.system().lower()
             if pfn == 'linux':
-                return run_cmd([find_app('gdb'),
+                gdb = find_app('gdb')
+                try:
+                    return _gdb_back_trace(gdb, self.app, self.core)
+                except (CrashUtilsException, IOError, OSError) as e:
+                    logger.warning('gdb session failed, run gdb for {}: {}'.format(self.core, e))
+                return run_cmd([gdb,
                                 '--batch',
                                 '--quiet',
                                 '-ex',
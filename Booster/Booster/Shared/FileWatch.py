@@ -0,0 +1,160 @@
+from __future__ import print_function
+"""
+Wait for files to appear
+
+On Linux the parent directories of the missing files are watched with inotify, so that a wait returns as soon
+as the last file is written and closed, or moved into place. A file counts as present only once it is non-empty,
+so a file that was created but not written yet is still waited for. Directories that don't exist yet are found by
+watching their closest existing ancestor for new subdirectories. inotify doesn't see changes made by other hosts
+on network file systems, so the watch still re-checks at least every POLL_MAX seconds. Elsewhere (or if inotify is not available) the files are polled, with an interval
+growing from POLL_MIN to POLL_MAX. Only the files still missing are checked again.
+"""
+
+__all__ = ['waitForFiles']
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+import select
+import time
+
+import ata.log
+
+logger = ata.log.AtaLog(__name__)
+
+POLL_MIN = 0.05
+POLL_MAX = 1.0
+
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_MASK = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_DELETE_SELF | _IN_MOVE_SELF
+_ANCESTOR_MASK = _MASK | _IN_CREATE     # a missing directory on the way to the file was created
+
+_libc = None
+
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        _libc = False
+        if platform.system() == 'Linux':
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                if hasattr(libc, 'inotify_init1') and hasattr(libc, 'inotify_add_watch'):
+                    _libc = libc
+            except OSError:
+                pass
+    return _libc
+
+
+def _existingAncestor(path):
+    path = os.path.dirname(os.path.abspath(path))
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def _isReady(path):
+    if os.path.isdir(path):
+        return True
+    try:
+        return os.path.getsize(path) > 0
+    except OSError:
+        return False
+
+
+def _stillMissing(missing):
+    return [p for p in missing if not _isReady(p)]
+
+
+class _Inotify(object):
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watched = {}
+
+    def watch(self, paths):
+        masks = {}
+        for p in paths:
+            directory = _existingAncestor(p)
+            parent = os.path.dirname(os.path.abspath(p))
+            masks[directory] = masks.get(directory, 0) | (_MASK if directory == parent else _ANCESTOR_MASK)
+        for directory, mask in masks.items():
+            mask |= self.watched.get(directory, 0)
+            if mask == self.watched.get(directory):
+                continue
+            name = directory if isinstance(directory, bytes) else directory.encode('utf-8')
+            if self.libc.inotify_add_watch(self.fd, name, mask) < 0:
+                logger.debug('cannot watch {}: {}'.format(directory, os.strerror(ctypes.get_errno())))
+            self.watched[directory] = mask
+
+    def wait(self, timeout):
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            try:
+                while os.read(self.fd, 65536):     # events are not decoded, the missing files are checked again
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+def waitForFiles(paths, timeout=None):
+    """
+    Wait until every path exists, or the timeout expires. Empty files are still considered missing.
+    :param paths:       files or directories
+    :param timeout:     seconds, None or 0 to check only once
+    :return:            list of the paths still missing, in the order of paths
+    """
+    missing = _stillMissing(paths)
+    if not missing or not timeout:
+        return missing
+    logger.info('waiting up to {}s for {} missing files, e.g. {}'.format(timeout, len(missing), missing[0]))
+    deadline = time.time() + timeout
+    libc = _getLibc()
+    watcher = None
+    if libc:
+        try:
+            watcher = _Inotify(libc)
+        except OSError as e:
+            logger.debug('inotify is not available, poll: {}'.format(e))
+    interval = POLL_MIN
+    try:
+        while missing:
+            if watcher is not None:
+                watcher.watch(missing)
+                missing = _stillMissing(missing)     # created before the watch was added
+            remaining = deadline - time.time()
+            if not missing or remaining <= 0:
+                break
+            if watcher is not None:
+                watcher.wait(min(remaining, POLL_MAX))
+            else:
+                time.sleep(min(remaining, interval))
+                interval = min(interval * 2, POLL_MAX)
+            missing = _stillMissing(missing)
+    finally:
+        if watcher is not None:
+            watcher.close()
+    return missing
@@ -1,8 +1,14 @@
 from __future__ import print_function
+"""
+    <Tar dest="build.tar.gz" exclude_root="false" tar_extension="false" reproducible="false" workers="8">dir</Tar>
+
+    reproducible="true" sets the timestamp of every entry to SOURCE_DATE_EPOCH (default 1980-01-01), entries keep
+    the modification time of their file otherwise, see Archive
+"""
 import os
 
-import Command
-import platform
+import Archive
+import Parallel
 from Booster.Debug import Debug as Debugger
 
 
@@ -27,16 +33,8 @@ def Execute(root):
     else:
         print('Create ' + archive + '.tar.gz from ' + file)
     
-    if (exclude_root == 'true'):
-        if (tar_extension == 'true'):
-            createTar(archive, file, True, True)
-        else:
-            createTar(archive, file, True, False)
-    else:
-        if (tar_extension == 'true'):
-            createTar(archive, file, False, True)
-        else:
-            createTar(archive, file)
+    createTar(archive, file, exclude_root == 'true', tar_extension == 'true', Parallel.getWorkers(root),
+              root.attrib.get('reproducible', 'false') == 'true')
 
 def Debug(root):
     print('==============================')
@@ -58,35 +56,24 @@ def getSource(root):
     return root.text
 
 
-def createTar(archive_name, source, exclude_root=False, extension=False):
-    current_platform = platform.system()
-    if exclude_root:
-        if extension:
-            if current_platform == 'Linux' or current_platform == 'AIX' or current_platform == 'HP-UX':
-                command = "tar -vcf {}.tar *"
-            else:
-                command = "tar -vcf - * > {}.tar"
-            Command.ExecuteAndGetResult(command.format(archive_name), cwd=source)
-        else:
-            if current_platform == 'Linux' or current_platform == 'AIX' or current_platform == 'HP-UX':
-                command = "tar -vczf {}.tar.gz *"
-            else:
-                command = "tar -vcf - * | gzip > {}.tar.gz"
-            Command.ExecuteAndGetResult(command.format(archive_name), cwd=source)
-    else:
-        rootDir = os.path.dirname(source)
-        #if rootDir != '':
-        #    os.chdir(rootDir)
-        baseDir = os.path.basename(source)
-        if extension:
-            if current_platform == 'Linux' or current_platform == 'AIX' or current_platform == 'HP-UX':
-                command = "tar -vcf {archive_name}.tar {baseDir}"
-            else:
-                command = "tar -vcf - {baseDir} > '{archive_name}.tar'"
-            Command.ExecuteAndGetResult(command.format(baseDir=baseDir, archive_name=archive_name), cwd=rootDir)
-        else:
-            if current_platform == 'Linux' or current_platform == 'AIX' or current_platform == 'HP-UX':
-                command = "tar -vczf {archive_name}.tar.gz {baseDir}"
-            else:
-                command = "tar -vcf - {baseDir} | gzip > '{archive_name}.tar.gz'"
-            Command.ExecuteAndGetResult(command.format(baseDir=baseDir, archive_name=archive_name), cwd=rootDir)
+def getInputs(root):
+    return [getSource(root)]
+
+
+def getOutputs(root):
+    # a relative archive is created in the source directory (exclude_root) or in its parent, see createTar
+    archive = getDest(root)
+    source = getSource(root)
+    cwd = source if root.attrib.get('exclude_root', 'false') == 'true' else os.path.dirname(source)
+    ext = '.tar' if root.attrib.get('tar_extension', 'false') == 'true' else '.tar.gz'
+    return [os.path.join(cwd, archive + ext)]
+
+
+def createTar(archive_name, source, exclude_root=False, extension=False, workers=1, reproducible=False):
+    """
+    Create archive_name.tar.gz (archive_name.tar with extension) from source. As with tar in a shell, a relative
+    archive_name is created in the source directory with exclude_root, in its parent otherwise
+    """
+    cwd = source if exclude_root else os.path.dirname(source)
+    archive = os.path.join(cwd, archive_name + ('.tar' if extension else '.tar.gz'))
+    Archive.createTar(archive, source, exclude_root, not extension, workers, reproducible)
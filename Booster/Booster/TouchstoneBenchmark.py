@@ -0,0 +1,141 @@
+from __future__ import print_function
+"""
+    Micro-benchmark of the TouchstoneMonitor line ingestion
+
+    Captured Touchstone logs are replayed to a monitor over local sockets, one connection per log like Touchstone
+    does, and the ingestion rate of the monitor is reported. A log is given as <logger>=<file>, e.g.
+    ServerStatusLog=out__status.log, a file alone is replayed as the VerboseLog. Without logs, a suite of synthetic
+    test cases is replayed to the status, verbose, xml and console logs.
+
+    python TouchstoneBenchmark.py [-o output-prefix] [-n cases] [VerboseLog=out__verbose.log ...]
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import TouchstoneMonitor
+
+CHUNK_SIZE = 65536
+TIMEOUT = 60            # seconds to wait for the monitor once the logs are sent
+
+
+def synthesize(cases, sets=10):
+    """
+    Generate the logs of a suite of cases test cases
+    :return:    dict of logger name -> data
+    """
+    status = [b'INIT', b'START']
+    verbose = [b'Simba Test Verbose Log Started on Mon Jun 25 11:00:27 2018']
+    xml = [b'Touchstone']
+    console = []
+    per_set = max(1, cases // sets)
+    for n in range(cases):
+        name = 'SET_{}'.format(n // per_set).encode('ascii')
+        case = n % per_set + 1
+        if case == 1:
+            status.append(b'SET CHANGE:' + name)
+        status.append(b'CASE:%s-%d' % (name, case))
+        status.append(b'STATUS:SUCCEED(%s-%d)' % (name, case))
+        verbose.extend([b'-' * 70, b'Test Suite: Touchstone', b'Test Set: ' + name,
+                        b'Test Case: SQL_QUERY (%d) : Basic SQL Query test.' % case, b'Status: SUCCEED', b''])
+        xml.append(b'  <testcase name="%s-%d" />' % (name, case))
+        console.append(b'%s-%d SQL_QUERY \x1b[32mSUCCEED\x1b[0m' % (name, case))
+    status.append(b'COMPLETE')
+    return {name: b'\n'.join(lines) + b'\n' for name, lines in (
+        ('ServerStatusLog', status), ('VerboseLog', verbose), ('XmlSummaryLog', xml), ('Console', console))}
+
+
+def send(port, name, data):
+    sock = socket.create_connection(('localhost', port))
+    try:
+        sock.sendall(name.encode('ascii') + b'\n')
+        for offset in range(0, len(data), CHUNK_SIZE):
+            sock.sendall(data[offset:offset + CHUNK_SIZE])
+    finally:
+        sock.close()
+
+
+def replay(logs, output_prefix):
+    """
+    Replay logs to a monitor
+    :param logs:            dict of logger name -> data
+    :param output_prefix:   output prefix of the monitor logs
+    :return:                seconds spent
+    """
+    monitor = TouchstoneMonitor.TouchstoneMonitor(touchstone='Touchstone', testEnv='env.xml', testSuite='suite.xml',
+                                                  outputPrefix=output_prefix)
+    monitor.validate_config({})        # default settings, Touchstone is not launched
+    disconnected = []
+
+    def counted(on_disconnect):
+        def wrapper():
+            disconnected.append(True)
+            on_disconnect()
+        return wrapper
+
+    for name in logs:
+        log = monitor.touchstone_loggers[name]
+        log.on_disconnect = counted(log.on_disconnect)
+    server, port = monitor._create_server()
+    server.listen(5)
+    senders = [threading.Thread(target=send, args=(port, name, data)) for name, data in logs.items()]
+    start = time.time()
+    try:
+        for sender in senders:
+            sender.start()
+        # small logs fit in the socket buffers, the senders can be done before any connection is accepted
+        sent = None
+        while len(disconnected) < len(logs):
+            monitor.event_loop.run_once(0.1)
+            if sent is None and not any(sender.is_alive() for sender in senders):
+                sent = time.time()
+            if sent is not None and time.time() - sent > TIMEOUT:
+                raise RuntimeError('{} of {} logs received'.format(len(disconnected), len(logs)))
+        elapsed = time.time() - start
+    finally:
+        for sender in senders:
+            sender.join()
+        server.close()
+        monitor.event_loop.close()
+        for log in monitor.touchstone_loggers.values():
+            log.close_log()
+    return elapsed
+
+
+def main(argv):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Replay Touchstone logs to TouchstoneMonitor')
+    parser.add_argument('-o', '--outputPrefix', type=str, help='Output path prefix of the monitor logs, default is a temporary directory')
+    parser.add_argument('-n', '--cases', type=int, default=100000, help='Number of synthetic test cases')
+    parser.add_argument('logs', nargs='*', help='<logger>=<captured log>')
+    args = parser.parse_args(argv)
+
+    logs = {}
+    for arg in args.logs:
+        name, path = arg.split('=', 1) if '=' in arg else ('VerboseLog', arg)
+        with open(path, 'rb') as fh:
+            logs[name] = fh.read()
+    if not logs:
+        logs = synthesize(args.cases)
+    prefix = args.outputPrefix or os.path.join(tempfile.mkdtemp(prefix='tsm-bench-'), 'bench')
+    if not os.path.isdir(os.path.dirname(os.path.abspath(prefix))):
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)))
+
+    elapsed = max(replay(logs, prefix), 1e-6)
+    size = sum(len(data) for data in logs.values())
+    lines = sum(data.count(b'\n') for data in logs.values())
+    for name, data in sorted(logs.items()):
+        print('{:<16} {:>10} lines {:>12} bytes'.format(name, data.count(b'\n'), len(data)))
+    print('{} lines, {} bytes in {:.2f}s: {:.0f} lines/s, {:.1f} MB/s, output in {}'.format(
+        lines, size, elapsed, lines / elapsed, size / elapsed / 1048576, os.path.dirname(os.path.abspath(prefix))))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,107 @@
+from __future__ import print_function
+"""
+    Duration history of Touchstone suites, used to schedule suite lists
+
+    TouchstoneMonitor saves the duration of a suite and of its test sets in <output>_durations.json. After each
+    suite, TouchstoneTestList records it in a history store of the agent cache (see AtaUtil.get_cache_dir), one
+    store per Touchstone working directory. Durations and failure rates are exponential moving averages, so that
+    the history follows the product as it changes.
+
+    Suites are then ordered longest processing time first (LPT): slots taking the next suite as they get free
+    finish together, and a long suite never starts last. Suites that failed recently go first, longest first,
+    so that their failures show up early. Suites without history are assumed to take the mean duration.
+"""
+
+import hashlib
+import json
+import os
+
+import AtaUtil
+import ata.log
+
+logger = ata.log.AtaLog(__name__)
+
+ALPHA = 0.5             # weight of the last run in the moving averages
+
+
+def _average(old, new):
+    return new if old is None else ALPHA * new + (1 - ALPHA) * old
+
+
+class TouchstoneHistory(object):
+    """
+    History store of the suites run in a Touchstone working directory
+    """
+    def __init__(self, cwd):
+        key = hashlib.sha1(os.path.abspath(cwd).encode('utf-8')).hexdigest()
+        self.path = os.path.join(AtaUtil.get_cache_dir('touchstone-history'), key + '.json')
+        self.suites = {}
+        self.changed = False
+        try:
+            with open(self.path, 'r') as fh:
+                self.suites = json.load(fh).get('suites', {})
+        except (IOError, OSError, ValueError):
+            pass
+
+    def expected(self, suiteOutput):
+        """
+        Return the expected duration of a suite in seconds, None if it never ran
+        """
+        entry = self.suites.get(suiteOutput)
+        return entry['duration'] if entry else None
+
+    def record(self, suiteOutput, durationsFile):
+        """
+        Record the durations saved by the monitor
+        :param suiteOutput:     name of the suite output, the key of the suite
+        :param durationsFile:   <output>_durations.json
+        :return:                None
+        """
+        try:
+            with open(durationsFile, 'r') as fh:
+                run = json.load(fh)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug('no durations for {}: {}'.format(suiteOutput, e))
+            return
+        entry = self.suites.setdefault(suiteOutput, {'runs': 0, 'duration': None, 'failures': 0.0, 'sets': {}})
+        entry['runs'] += 1
+        entry['duration'] = _average(entry['duration'], run.get('elapsed', 0))
+        failed = 1.0 if run.get('abort') or run.get('failed') else 0.0
+        entry['failures'] = _average(entry['failures'] if entry['runs'] > 1 else None, failed)
+        for name, seconds in run.get('sets', {}).items():
+            entry['sets'][name] = _average(entry['sets'].get(name), seconds)
+        self.changed = True
+
+    def order(self, suites):
+        """
+        Order suites for scheduling: recently failed suites first, then longest processing time first
+        :param suites:  list of (envFile, suiteFile, suiteOutput)
+        :return:        new list, suites of equal rank keep their order
+        """
+        known = [d for d in (self.expected(s[2]) for s in suites) if d is not None]
+        default = sum(known) / len(known) if known else 0
+
+        def rank(suite):
+            entry = self.suites.get(suite[2], {})
+            duration = entry.get('duration')
+            return (entry.get('failures', 0) < 0.1, -(default if duration is None else duration))
+
+        ordered = sorted(suites, key=rank)
+        for envFile, suiteFile, suiteOutput in ordered:
+            duration = self.expected(suiteOutput)
+            logger.info('{:>10} {}'.format('?' if duration is None else '{:.1f}s'.format(duration), suiteOutput))
+        return ordered
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp = self.path + '.tmp{}'.format(os.getpid())
+        try:
+            with open(tmp, 'w') as fh:
+                json.dump({'suites': self.suites}, fh, indent=1, sort_keys=True)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+            self.changed = False
+        except (IOError, OSError) as e:
+            logger.warning('failed to save suite history: {}'.format(e))
@@ -14,16 +14,14 @@ TouchstoneMonitor.TouchstoneMonitor(**arg).run()
 from __future__ import print_function
 
 import sys
-import asynchat
-import asyncore
 import collections
-import gzip
-import logging
+import errno
+import json
 import os
 import os.path
 import platform
 import re
-import shutil
+import select
 import signal
 import socket
 import string
@@ -32,9 +30,19 @@ import threading
 import time
 import traceback
 import xml.etree.ElementTree as ET
+import xml.sax.saxutils
+try:
+    import selectors
+except ImportError:     # python 2, EventLoop falls back to select.select
+    selectors = None
+try:
+    from collections.abc import MutableMapping
+except ImportError:     # python 2
+    from collections import MutableMapping
 
 import AtaUtil
 import Booster.Shared.CrashUtils as CrashUtils
+from Booster.Shared.CrashPipeline import CrashPipeline
 import ata.log
 from BoosterError import BoosterError
 
@@ -92,7 +100,131 @@ class SubConsoleLogger(threading.Thread):
         self.f_iter = None
 
 
-class TouchstoneMonitor(collections.MutableMapping):
+def _socketpair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    # python 2 on Windows
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        w = socket.create_connection(listener.getsockname())
+        r, addr = listener.accept()
+        return r, w
+    finally:
+        listener.close()
+
+
+class EventLoop(object):
+    """
+    Single threaded socket event loop of the monitor (it replaces asyncore, removed from python 3.12).
+    Channels are objects with fileno(), handle_read() and close(); wakeup() interrupts a wait, from another thread
+    or a signal handler, so that process exit and signals are handled as soon as they happen.
+    """
+
+    def __init__(self):
+        self.channels = {}
+        self.selector = selectors.DefaultSelector() if selectors else None
+        self._wake_r, self._wake_w = _socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._register(self._wake_r)
+
+    def _register(self, sock):
+        if self.selector:
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def register(self, channel):
+        self.channels[channel.fileno()] = channel
+        self._register(channel.socket)
+
+    def unregister(self, channel):
+        for fd, c in list(self.channels.items()):
+            if c is channel:
+                del self.channels[fd]
+                if self.selector:
+                    try:
+                        self.selector.unregister(fd)
+                    except (KeyError, ValueError):
+                        pass
+
+    def wakeup(self):
+        try:
+            self._wake_w.send(b'x')
+        except socket.error:
+            pass    # the loop is already woken up
+
+    def run_once(self, timeout=None):
+        """
+        Wait until a channel is readable, wakeup() is called or timeout (in seconds) expires,
+        then dispatch the ready channels
+        """
+        try:
+            if self.selector:
+                ready = [key.fd for key, mask in self.selector.select(timeout)]
+            else:
+                fds = [self._wake_r.fileno()] + list(self.channels.keys())
+                ready = select.select(fds, [], [], timeout)[0]
+        except (select.error, socket.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in ready:
+            if fd == self._wake_r.fileno():
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+                continue
+            channel = self.channels.get(fd)
+            if channel is None:
+                continue    # closed by a previous callback
+            try:
+                channel.handle_read()
+            except Exception:
+                # like asyncore, an unexpected exception closes the channel
+                logger.info('{} closed on exception: {}'.format(channel, traceback.format_exc()))
+                channel.handle_close()
+
+    def close_all(self):
+        for channel in list(self.channels.values()):
+            try:
+                channel.close()
+            except socket.error:
+                pass
+        self.channels = {}
+
+    def close(self):
+        self.close_all()
+        if self.selector:
+            self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+
+class ProcessWatcher(threading.Thread):
+    """
+    Wait for a subprocess and wake up the event loop as soon as it exits.
+    Once started, the subprocess must be reaped by this thread only, i.e. join() it before calling wait() or poll()
+    """
+
+    def __init__(self, proc, event_loop):
+        super(ProcessWatcher, self).__init__()
+        self.daemon = True
+        self.proc = proc
+        self.event_loop = event_loop
+        self.exited = threading.Event()
+
+    def run(self):
+        try:
+            self.proc.wait()
+        finally:
+            self.exited.set()
+            self.event_loop.wakeup()
+
+
+class TouchstoneMonitor(MutableMapping):
     """
     Inheriting from collections.MutableMapping allows the object to be shared and used as a dictionary
     """
@@ -213,13 +345,17 @@ class TouchstoneMonitor(collections.MutableMapping):
         }
 
         self.lastInputTime = None
-        self.sessionStartTime = None    # what's for?
+        self.sessionStartTime = None    # launch time, for the suite duration
         self.lastTestCaseTime = None    # used for timeout
         self.test_suite_name = None
         self.currentSet = None
+        self.currentSetStartTime = None
+        self.setDurations = collections.OrderedDict()     # seconds spent in each test set, see _save_durations
         self.currentId = 1              # by convention, test case starts from 1
         self.childProc = None           # touchstone might be launched indirectly, e.g. via procdump on Windows
         self.touchstonePid = None
+        self.crash_pipeline = CrashPipeline()     # cores are processed while Touchstone is relaunched
+        self.lastSyntheticCase = None   # the synthetic failure that a core report is attached to
         # this handle is used to get return code on Windows when it can't be obtained by subprocess
         # by using win32api extension
         self.touchstoneProcessHandle = None
@@ -240,6 +376,8 @@ class TouchstoneMonitor(collections.MutableMapping):
         self.server = None
         self.procdump = None
         self.sub_console_logger = None
+        self.event_loop = EventLoop()
+        self.proc_watcher = None        # reaps childProc, see ProcessWatcher
 
         self.__dict__.update(*args, **kwargs)
         self.outputDir = '.'
@@ -309,10 +447,18 @@ class TouchstoneMonitor(collections.MutableMapping):
                 current_set_counts = [str(self.currentSetCounts[status]) for status in self.status_items]
                 self.touchstone_loggers['SetSummaryCsvLog'].write_log(
                     ','.join([self.currentSet] + current_set_counts))
+                self._end_test_set()
             self.currentSetCounts = self.init_counts()
             self.currentSet = test_set_name
+            self.currentSetStartTime = time.time()
             self.currentId = 1
 
+    def _end_test_set(self):
+        if self.currentSet and self.currentSetStartTime is not None:
+            elapsed = time.time() - self.currentSetStartTime
+            self.setDurations[self.currentSet] = self.setDurations.get(self.currentSet, 0) + elapsed
+        self.currentSetStartTime = None
+
     def validate_test_set(self, name):
         """
         Validate if test set is changed unexpectly, warn and adjust if it is.
@@ -337,7 +483,7 @@ class TouchstoneMonitor(collections.MutableMapping):
         :param msg:     error message
         """
         set_name = self.currentSet if self.currentSet is not None else 'Unknown'
-        self.touchstone_loggers['XmlSummaryLog'].append_case(set_name, self.currentId, msg)
+        self.lastSyntheticCase = self.touchstone_loggers['XmlSummaryLog'].append_case(set_name, self.currentId, msg)
         self.currentSetCounts[status] += 1
         self.totalCounts[status] += 1
         self.currentSetCounts['TOTAL'] += 1
@@ -372,7 +518,7 @@ class TouchstoneMonitor(collections.MutableMapping):
         self.lastTestCaseTime = time.time()
         if status == 'SUCCEED':
             self.consecutiveFailure = 0
-        elif re.search(r'FAILED', status):
+        elif 'FAILED' in status:
             self.consecutiveFailure += 1
         self.validate_test_set(name)
         self.validate_test_id(id)
@@ -442,7 +588,7 @@ class TouchstoneMonitor(collections.MutableMapping):
         # only kill or send signal to a running process
         if os.name == 'nt':
             sig = None
-        if self.childProc and self.childProc.poll() is None:
+        if self.childProc and self._is_child_alive():
             logger.info('kill_child: subprocess={} touchstone={}'.format(self.childProc.pid, self.touchstonePid))
             if sig:
                 self.childProc.send_signal(sig)
@@ -493,11 +639,13 @@ class TouchstoneMonitor(collections.MutableMapping):
     def signal_handler(self, sig, stack):
         self.abort = True
         self.abortReason = 'signal caught ({})'.format(sig)
+        self.event_loop.wakeup()
 
-    def _get_core_and_back_trace(self, log_it=True):
+    def _get_core_and_back_trace(self, log_it=True, wait=False):
         """
-        Get the core file (and gzip it) and backtrace
+        Get the core file, its backtrace and compression are done in background (see _collect_crash_reports)
         :param log_it:
+        :param wait:    wait for the backtrace, and return it
         :return:
         """
         core_file = CrashUtils.find_and_save_core_dump(self.touchstonePid, self.wd, self.outputDir)
@@ -509,26 +657,36 @@ class TouchstoneMonitor(collections.MutableMapping):
             cores.append(core_file)
         else:
             cores.extend(core_file)
+        backtrace = not (self.NO_BT or platform.system() == 'Windows')  # decode core on posix unless forbidden
+        case = None if wait else self.lastSyntheticCase
         for coref in cores:
-            msg += "Core-dump: {}\n".format(coref)
-            if not (self.NO_BT or platform.system() == 'Windows'): # decode core on posix unless forbidden
-                try:
-                    msg += CrashUtils.get_back_trace(self.touchstone.split(' ')[0], coref)
-                except Exception as e:
-                    msg += str(e)
-            # compress it
-            with open(coref, 'rb') as fin, gzip.open(coref + '.gz', 'wb') as fout:
-                shutil.copyfileobj(fin, fout)
-            if os.path.exists(coref + '.gz'):
-                os.remove(coref)
-        if log_it and msg != '':
+            self.touchstone_loggers['XmlSummaryLog'].hold(case)     # until the report is attached
+            self.crash_pipeline.submit(self.touchstone.split(' ')[0], coref, backtrace, case)
+            msg += "Core-dump: {} (processing in background)\n".format(coref)
+        if wait:
+            msg = ''.join(report for case, report in self._collect_crash_reports(wait=True))
+        elif log_it and msg != '':
             logger.info(msg)
         return msg
 
+    def _collect_crash_reports(self, wait=False):
+        """
+        Log the reports of processed cores, and attach them to their synthetic failures
+        :param wait:    wait for all cores
+        :return:        list of (case, report)
+        """
+        reports = self.crash_pipeline.collect(wait)
+        for case, report in reports:
+            self.alert(report, 'info')
+            if case is not None:
+                self.touchstone_loggers['XmlSummaryLog'].attach_details(case, report)
+        return reports
+
     def _on_timeout(self):
         """
         Handles process timeout
         """
+        self._flush_logs()
         msg = '\n\n!!!!!!!!!!!!!!!!!!!! TIMEOUT !!!!!!!!    {}-{} is not finished in {} minutes, Touchstone will be killed.\n'.format(self.currentSet, self.currentId, self.timeout)
         self.alert(msg)
         total_so_far = self._get_total()
@@ -582,6 +740,8 @@ class TouchstoneMonitor(collections.MutableMapping):
             proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8')
         self.childProc = proc
         self.touchstonePid = proc.pid
+        self.proc_watcher = ProcessWatcher(proc, self.event_loop)
+        self.proc_watcher.start()
         f_iter = iter(proc.stdout.readline, '')
         if self.procdump:
             # in this case, touchstone is actually the child of procdump
@@ -652,18 +812,26 @@ class TouchstoneMonitor(collections.MutableMapping):
 
         Returns: True if the Touchstone sub process is still running
         """
-        is_running = self.childProc and self.childProc.poll() is None
+        is_running = self.childProc and self._is_child_alive()
         if not is_running and self.childProc:
             self._get_return_code()
             self.childProc = None
             # leave touchstonePid unchanged, which is used to get core if applicable
         return is_running
 
+    def _is_child_alive(self):
+        if self.proc_watcher is not None:
+            return not self.proc_watcher.exited.is_set()
+        return self.childProc.poll() is None
+
     def _get_return_code(self):
         """
         Get touchstone return code
         :return:
         """
+        if self.proc_watcher is not None:
+            self.proc_watcher.join()
+            self.proc_watcher = None
         pid = self.childProc.pid
         return_code = self.childProc.wait()  # make sure this is called after poll() to avoid deadlock
         if os.name != 'nt' and return_code < 0:
@@ -705,6 +873,7 @@ class TouchstoneMonitor(collections.MutableMapping):
         """
         Handles Touchstone crashes
         """
+        self._flush_logs()
         if self.abort:
             return
 
@@ -712,7 +881,7 @@ class TouchstoneMonitor(collections.MutableMapping):
             self._close_sub_console()
             msg = "\nERROR: Could not start running tests. Check given arguments and/or DLL.\n"
             msg += "try to get the core file\n"
-            msg += self._get_core_and_back_trace()
+            msg += self._get_core_and_back_trace(wait=True)
             raise BoosterError(__name__, msg)
 
         total_so_far = self._get_total()
@@ -932,9 +1101,9 @@ End of tests
          even when all tests complete
          This provides a last chance for loggers to send data
         """
-        for i in range(self.server_timeout):
-            if self.active_loggers > 0:
-                asyncore.loop(timeout=1, count=1)
+        end = time.time() + self.server_timeout
+        while self.active_loggers > 0 and time.time() < end:
+            self.event_loop.run_once(max(0, end - time.time()))
 
     def _start_touchstone(self):
         """ Launch touchstone binary
@@ -952,8 +1121,11 @@ End of tests
         now = time.time()
         self.sessionStartTime = now
         while True:
-            # Loop times out after a second
-            asyncore.loop(timeout=1, count=1)
+            # wait for touchstone data, its exit (see ProcessWatcher), a signal or the next timeout
+            self.event_loop.run_once(self._next_timeout())
+            self._flush_logs(due_only=True)
+            if self.crash_pipeline.pending:
+                self._collect_crash_reports()
             now = time.time()
             if self.active_loggers == 0 and self.sessionInited:
                 # delay checking subprocess health
@@ -987,7 +1159,7 @@ End of tests
         if self.active_loggers > 0:
             logger.debug(
                 "There are still {} active loggers. Attempting to close them explicitly...".format(self.active_loggers))
-            asyncore.close_all()
+            self.event_loop.close_all()
 
         # append a synthetic test-case for abort
         if self.abort:
@@ -998,12 +1170,63 @@ End of tests
         # Dump test_results dictionary to a file
         logger.debug("Saving test results in " + self.outputPrefix + "_summary.pickle")
         AtaUtil.pickle_obj(test_results, self.outputPrefix + "_summary.pickle")
+        self._save_durations(test_results)
 
 
+    def _save_durations(self, test_results):
+        """
+        Save the duration of the suite and of its test sets in <outputPrefix>_durations.json,
+        TouchstoneHistory uses it to schedule the next runs
+        """
+        self._end_test_set()
+        durations = {
+            'suite': self.test_suite_name,
+            'elapsed': time.time() - self.sessionStartTime if self.sessionStartTime else 0,
+            'sets': self.setDurations,
+            'failed': sum(test_results.get(s, 0) for s in ('FAILED', 'CRASHED', 'TIMEOUT')),
+            'abort': bool(self.abort),
+        }
+        try:
+            with open(self.outputPrefix + "_durations.json", 'w') as fh:
+                json.dump(durations, fh, indent=1)
+        except (IOError, OSError) as e:
+            logger.warning('failed to save durations: {}'.format(e))
+
+    def _next_timeout(self):
+        """
+        Seconds until the current timeout expires: initialization, or the running test case
+        """
+        if self.abort or self.sessionCompleted:
+            return 0
+        limit = self.timeout * 60 if self.sessionInited else self.timeoutBeforeInitialized
+        # the cap only guards against a missed wake up
+        timeout = min(max(0, self.lastTestCaseTime + limit - time.time()), 60)
+        for ts_log in self.touchstone_loggers.values():
+            due = ts_log.sink.due()
+            if due is not None:
+                timeout = min(timeout, due)
+        return timeout
+
+    def _flush_logs(self, due_only=False):
+        """
+        Write the buffered lines of the touchstone logs
+        :param due_only:    only the logs whose flush interval expired
+        """
+        for ts_log in self.touchstone_loggers.values():
+            if due_only:
+                ts_log.flush_if_due()
+            else:
+                ts_log.flush()
+
     def _cleanup(self, cwd):
         if self.server is not None:
             self.server.close()
         self.kill_child()
+        self.event_loop.close()
+        if self.crash_pipeline.pending:
+            logger.info('waiting for the processing of {} cores'.format(len(self.crash_pipeline.pending)))
+        self._collect_crash_reports(wait=True)
+        self.crash_pipeline.close()
         # close all touchstone log files
         for ts_log in self.touchstone_loggers:
             self.touchstone_loggers[ts_log].close_log()
@@ -1045,6 +1268,7 @@ End of tests
         Log important information, such as crash, timeout, kill, etc
         to make sure it is logged everywhere.
         """
+        self._flush_logs()      # what leads to the alert comes first
         if hint == 'info':
             logger.info(msg)
             self.touchstone_loggers['Console'].write_log(msg)
@@ -1052,73 +1276,133 @@ End of tests
             logger.warning(msg)
             self.touchstone_loggers['Console'].write_log(msg)
             self.touchstone_loggers['VerboseLog'].write_log(msg)
+        self._flush_logs()
 
 
-class Server(asyncore.dispatcher):
+class Server(object):
     """
     Receives connections from a Touchstone process and establishes handlers for each client.
     """
 
     def __init__(self, address, ts_monitor):
-        asyncore.dispatcher.__init__(self)
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s = self.socket
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        s.setsockopt(socket.IPPROTO_TCP, 1, 1)
-        s.bind(address)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            s.setsockopt(socket.IPPROTO_TCP, 1, 1)
+            s.setblocking(False)
+            s.bind(address)
+        except socket.error:
+            s.close()
+            raise
         self.ts_monitor = ts_monitor
+        self.event_loop = ts_monitor.event_loop
+        self.event_loop.register(self)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def listen(self, backlog):
+        self.socket.listen(backlog)
+
+    def handle_read(self):
+        self.handle_accept()
 
     def handle_accept(self):
         """ Handles a new connection from a client socket """
-        client_info = self.accept()  # client_sock, peer_addr
-        if client_info:
-            Handler(client_info[0], self.ts_monitor)
+        try:
+            client_sock, peer_addr = self.socket.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                return
+            raise
+        Handler(client_sock, self.ts_monitor)
 
     def handle_close(self):
         """ Handling closing a connection. This occurs when all clients finished sending data """
         try:
             self.close()
         except Exception as e:
-            print('handle close exception: ' + e)
+            print('handle close exception: {}'.format(e))
 
+    def close(self):
+        self.event_loop.unregister(self)
+        self.socket.close()
 
-class Handler(asynchat.async_chat):
+
+class Handler(object):
     """
     This is used for handling the data sent from a client to the server
     """
 
     def __init__(self, sock, context):
-        self.received_data = []
-        asynchat.async_chat.__init__(self, sock)
-        self.set_terminator(b'\n')  # we receive data in lines
+        self.buffer = bytearray()   # data received after the last complete line
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.terminator = b'\n'  # we receive data in lines
         self.name = None
         self.bad_logname = False
         self.log_file = None
         self.test_complete = False
         self.context = context
+        self.closed = False
+        context.event_loop.register(self)
         return
 
-    def collect_incoming_data(self, data):
-        # client can send data in chunks
-        self.received_data.append(data)
+    def fileno(self):
+        return self.socket.fileno()
+
+    def handle_read(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            if e.args[0] not in (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN, errno.ECONNABORTED, errno.EPIPE):
+                raise
+            data = b''
+        if not data:
+            self.handle_close()
+            return
+        buf = self.buffer
+        start = len(buf)
+        buf += data
+        # only the new data is searched for terminators
+        end = buf.find(self.terminator, start)
+        if end < 0:
+            return
+        start = 0
+        try:
+            while end >= 0:
+                self.found_terminator(bytes(buf[start:end]))
+                if self.closed:
+                    return
+                start = end + 1
+                end = buf.find(self.terminator, start)
+        finally:
+            del buf[:start]         # the buffer is reused, only the incomplete line is kept
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.context.event_loop.unregister(self)
+            self.socket.close()
 
-    def found_terminator(self):
+    def found_terminator(self, line):
         """ When a full line has been received
         """
-        try:
-            if pyver.major == 2:
-                data = ''.join(self.received_data)
-            else:
-                data = b''.join(self.received_data).decode('utf8')
-        except Exception as e:
-            print('====found_terminator exception:')
-            traceback.print_exc()
-            for c in self.received_data:
-                print('    {}'.format(c))
-            print('===')
-            data = ''
-        self.received_data = []
+        if pyver.major == 2:
+            data = line
+        else:
+            try:
+                data = line.decode('utf8')
+            except Exception as e:
+                print('====found_terminator exception:')
+                traceback.print_exc()
+                print('    {}'.format(line))
+                print('===')
+                data = ''
         # The first data received from a client is the log type
         if not self.name:
             self.name = data
@@ -1134,6 +1418,8 @@ class Handler(asynchat.async_chat):
 
 
     def handle_close(self):
+        if self.closed:
+            return
         try:
             self.close()
         except Exception as e:
@@ -1143,6 +1429,7 @@ class Handler(asynchat.async_chat):
         logger.debug('---- {} disconnected: {}'.format(self.name, self.context.active_loggers))
         if self.name and not self.bad_logname:
             self._getLogger().on_disconnect()
+            self._getLogger().flush()
  
 
     def _getLogger(self):
@@ -1157,6 +1444,56 @@ class Handler(asynchat.async_chat):
 
 
 
+class LogSink(object):
+    """
+    Buffered output file of a TouchstoneLog. Lines are written in batches, once FLUSH_SIZE bytes are pending or
+    FLUSH_INTERVAL seconds after the first pending line (the monitor calls flush_if_due when it wakes up), and
+    on demand, e.g. on crash, timeout and disconnect
+    """
+    FLUSH_INTERVAL = 1.0
+    FLUSH_SIZE = 65536
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w')
+        self.pending = []
+        self.size = 0
+        self.since = None       # time of the first pending line
+        self.on_flush = None    # called with the file once pending lines are written, e.g. to write a trailer
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending.append('\n')
+        self.size += len(data) + 1
+        if self.since is None:
+            self.since = time.time()
+        if self.size >= self.FLUSH_SIZE:
+            self.flush()
+
+    def due(self):
+        """
+        Seconds until the pending lines are due, None if nothing is pending
+        """
+        if self.since is None:
+            return None
+        return max(0, self.since + self.FLUSH_INTERVAL - time.time())
+
+    def flush(self):
+        if self.pending:
+            self.file.write(''.join(self.pending))
+            if self.on_flush is not None:
+                self.on_flush(self.file)
+            self.file.flush()
+            self.pending = []
+            self.size = 0
+        self.since = None
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+
 class TouchstoneLog(object):
     """
     The base class for TouchstoneLog types
@@ -1183,10 +1520,7 @@ class TouchstoneLog(object):
         self.owner = owner          # TouchstoneMonitor
         self.logname = logname
         self.base_logname = os.path.basename(self.logname)
-        self.handler = logging.FileHandler(filename=logname, mode='w')
-        self.log = logging.getLogger(self.base_logname)
-        self.log.setLevel(logging.DEBUG)
-        self.log.addHandler(self.handler)
+        self.sink = LogSink(logname)
 
     def action(self, line):
         """
@@ -1197,20 +1531,29 @@ class TouchstoneLog(object):
 
     def close_log(self):
         try:
-            self.handler.close()
+            self.sink.close()
         except Exception as e:
             print('{} close exception: {}'.format(self.base_logname, e))
             pass
 
+    _non_printable = re.compile('[^{}]'.format(re.escape(string.printable)))
+
     def _escape(self, data):
         """ escape non-printable characters
         """
-        printable = [c if c in string.printable else repr(c) for c in data]
-        return ''.join(printable)
+        if self._non_printable.search(data) is None:
+            return data
+        return self._non_printable.sub(lambda m: repr(m.group()), data)
 
     def write_log(self, data):
-        self.log.debug(str(data))
-        self.handler.flush()
+        self.sink.write(str(data))
+
+    def flush(self):
+        self.sink.flush()
+
+    def flush_if_due(self):
+        if self.sink.due() == 0:
+            self.flush()
 
     def on_connect(self):
         """ handler when a named touchstone socket is connected
@@ -1269,6 +1612,18 @@ FAILED,,unknown,unknown-suite,unknown-set,unknown-case,1,unknown,"Fail to launch
         super(SummaryCsvLog, self).close_log()
 
 
+class _Failure(object):
+    """
+    Synthetic failed test case, details can be attached to it until it is written (see XmlSummaryLog.hold)
+    """
+    def __init__(self, head, line):
+        self.head = head        # opening <testcase> tag
+        self.line = line        # <failure> tag
+        self.fresh = True       # not written before the next flush, so that it can be held
+        self.holds = 0          # reports expected, e.g. one per core
+        self.written = False
+
+
 class XmlSummaryLog(TouchstoneLog):
     """
     Info and status of each test case, in XML format.
@@ -1282,27 +1637,111 @@ class XmlSummaryLog(TouchstoneLog):
     </testcase>
     </testsuite>
 
+    Lines are streamed to the file as they come. The counts of the header are padded to be patched in place, and
+    the closing tags are written after the last line at each flush (and overwritten by the next lines), so that the
+    summary is complete and well-formed up to the last flush if the monitor dies. Synthetic failures not written
+    yet (e.g. held for a backtrace) are part of the closing tags, and of the counts.
     """
+    COUNTS_WIDTH = 40
+    case_tag = re.compile(r'\s*<testcase\s')
+    failure_tag = re.compile(r'\s*<failure\s')
+    close_tag = re.compile(r'\s*</testcase>|\s*<testcase\s+name="[^"]+"\s*/>')
 
     def __init__(self, owner, output_prefix):
         super(XmlSummaryLog, self).__init__(owner, output_prefix + "__summary.xml")
-        self.cache = []
         self.test_suite_name = None
+        self.total = 0
+        self.failures = 0
+        self.last_line = None
+        self.case_open = False              # the last line written opens a test case
+        self.pending = collections.deque()  # lines before the header, or from a held synthetic case on
+        self.counts_offset = None           # the header is written once the suite name is known
+        self.sink.on_flush = self._write_trailer
 
     def action(self, line):
         """
         Args:
             line: data to write in a log file
         """
-        # Add data to a cache in the context
         # non-printable characters might break the xml parser
         printable_line = self._escape(line)
         if self.test_suite_name is None:
             self.test_suite_name = printable_line
             self.owner.set_test_suite(self.test_suite_name)
+            self._write_header()
         else:
-            self.cache.append(printable_line)
+            self._append(printable_line)
+
+    def _append(self, entry):
+        self.last_line = entry.line if isinstance(entry, _Failure) else entry
+        self.pending.append(entry)
+        self._stream()
 
+    def _stream(self):
+        """
+        Write the pending lines, up to the first held case
+        """
+        if self.counts_offset is None:
+            return
+        while self.pending:
+            entry = self.pending[0]
+            if isinstance(entry, _Failure):
+                if entry.fresh or entry.holds:
+                    return
+                entry.written = True
+                self._write_line(entry.head)
+                entry = entry.line
+            self.pending.popleft()
+            self._write_line(entry)
+
+    def _write_line(self, line):
+        if self.case_tag.match(line):
+            self.total += 1
+            self.case_open = True
+        if self.failure_tag.match(line): self.failures += 1
+        if self.close_tag.match(line): self.case_open = False
+        self.write_log(line)
+
+    def flush(self):
+        for entry in self.pending:
+            if isinstance(entry, _Failure):
+                entry.fresh = False
+        self._stream()
+        super(XmlSummaryLog, self).flush()
+
+    def _counts(self, held=0):
+        """
+        :param held:    number of synthetic failures not written yet
+        """
+        return ' tests="{}" failures="{}"'.format(self.total + held, self.failures + held).ljust(self.COUNTS_WIDTH)
+
+    def _write_header(self):
+        suite_name = 'unknown' if self.test_suite_name is None else self.test_suite_name.strip()
+        self.sink.flush()
+        fh = self.sink.file
+        fh.write('<?xml version="1.0" encoding="UTF-8" ?>\n<testsuite')
+        self.counts_offset = fh.tell()
+        fh.write('{} name="{}">\n'.format(self._counts(), suite_name))
+        self._stream()
+
+    def _write_trailer(self, fh):
+        """
+        Close the test suite (and the last test case if it is open) after the lines written so far, with the
+        synthetic failures not written yet, and update its counts. The file position is left before the closing tags
+        """
+        if self.counts_offset is None:
+            return
+        end = fh.tell()
+        held = [entry for entry in self.pending if isinstance(entry, _Failure)]
+        trailer = ['  </testcase>'] if self.case_open else []
+        for case in held:
+            trailer.extend([case.head, case.line, '  </testcase>'])
+        trailer.append('</testsuite>')
+        fh.write('\n'.join(trailer) + '\n')
+        fh.truncate()
+        fh.seek(self.counts_offset)
+        fh.write(self._counts(len(held)))
+        fh.seek(end)
 
     def append_case(self, test_set=None, test_case=None, fail_msg=None):
         """
@@ -1315,11 +1754,40 @@ class XmlSummaryLog(TouchstoneLog):
         if test_set is None: test_set = 'unknown'
         if test_case is None: test_case = 'unknown'
         if fail_msg is None:
-            self.cache.append('  <testcase name="{}-{}" />'.format(test_set, test_case))
+            self._append('  <testcase name="{}-{}" />'.format(test_set, test_case))
+            return None
+        else:
+            case = _Failure('  <testcase name="{}-{}">'.format(test_set, test_case),
+                            '    <failure message="{}" />'.format(fail_msg))
+            self._append(case)
+            self._append('  </testcase>')
+            return case
+
+    def hold(self, case):
+        """
+        Keep a synthetic case, and the lines after it, until details are attached to it.
+        Must be called before the next flush
+        :param case:    returned by append_case
+        """
+        if case is not None and not case.written:
+            case.holds += 1
+
+    def attach_details(self, case, details):
+        """
+        Add details, e.g. a backtrace, to the failure of a synthetic case
+        :param case:    returned by append_case
+        """
+        if case.written:
+            logger.debug('{} is already written, details are not attached'.format(case.line))
+            return
+        line = case.line
+        details = xml.sax.saxutils.escape(re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '?', details))
+        if line.endswith(' />'):
+            case.line = '{}>{}</failure>'.format(line[:-3], details)
         else:
-            self.cache.append('  <testcase name="{}-{}">'.format(test_set, test_case))
-            self.cache.append('    <failure message="{}" />'.format(fail_msg))
-            self.cache.append('  </testcase>')
+            case.line = '{}\n{}</failure>'.format(line[:-len('</failure>')], details)
+        case.holds = max(0, case.holds - 1)
+        self._stream()
 
 
     def close_testcase(self):
@@ -1334,47 +1802,33 @@ class XmlSummaryLog(TouchstoneLog):
             </testcase>
         Because the socket can be broken anytime, closing tag </testcase> can be lost.
         """
-        n = len(self.cache)
-        if n > 0:
-            close_tag = re.compile(r'\s*</testcase>|\s*<testcase\s+name="[^"]+"\s*/>')
-            last_line = self.cache[n - 1]
-            if not close_tag.match(last_line):
-                self.cache.append('  </testcase>')
+        if self.last_line is not None and not self.close_tag.match(self.last_line):
+            self._append('  </testcase>')
 
     def close_log(self):
         """
-        Actually write to summary.xml log:
-            count total/failures
+        Complete summary.xml:
+            write the lines still held
             generate synthetic failure if no test case is actually logged
         """
         self.close_testcase()
-        suite_name = self.test_suite_name
-        if suite_name is None:
-            suite_name = 'unknown'
-        else:
-            suite_name = suite_name.strip()
-
-        p_case = re.compile(r'\s*<testcase\s')
-        p_fail = re.compile(r'\s*<failure\s')
-        total = 0
-        failures = 0
-        for e in self.cache:
-            if p_case.match(e): total += 1
-            if p_fail.match(e): failures += 1
+        if self.counts_offset is None:
+            self._write_header()
+        self._write_all()
 
         # Make junit parser red if total is zero
-        if total == 0:
+        if self.total == 0:
             self.append_case('Unknown', '1', 'Touchstone Monitor: zero test case executes - fail to launch or empty suite')
-            total = 1
-            failures = 1
-
-        self.write_log('''<?xml version="1.0" encoding="UTF-8" ?>
-<testsuite tests="{total}" failures="{failures}" name="{suite_name}">
-{data}
-</testsuite>
-'''.format(total=total, failures=failures, suite_name=suite_name, data='\n'.join(self.cache)))
+            self._write_all()
         super(XmlSummaryLog, self).close_log()
 
+    def _write_all(self):
+        for entry in self.pending:
+            if isinstance(entry, _Failure):
+                entry.fresh = False
+                entry.holds = 0
+        self._stream()
+
 
 
 
@@ -1385,60 +1839,48 @@ class ServerStatusLog(TouchstoneLog):
     """
     def __init__(self, owner, output_prefix):
         super(ServerStatusLog, self).__init__(owner, output_prefix + "__status.log")
+        # message type (up to the colon) -> pattern of the message, handler
+        self.commands = {
+            'CASE': (re.compile(r'CASE:(.+)-([0-9]+)$'), self.on_test_start),
+            'STATUS': (re.compile(r'STATUS:(.+)\((.+)-([0-9]+)\)'), self.on_test_finish),
+            'SET CHANGE': (re.compile(r'SET CHANGE:(.+)'), self.on_set_change),
+            'INIT': (re.compile(r'INIT'), self.on_session_init),
+            'START': (re.compile(r'START'), self.on_session_start),
+            'COMPLETE': (re.compile(r'COMPLETE'), self.on_session_completed),
+        }
 
-        class OnSessionCompleted(object):
-            def __init__(self):
-                self.pattern = re.compile(r'COMPLETE')
-
-            def __call__(self, monitor, m):
-                monitor.sessionComplete = True
-
-        class OnSessionInit(object):
-            def __init__(self):
-                self.pattern = re.compile(r'INIT')
-
-            def __call__(self, monitor, m):
-                monitor.sessionInited = True
-
-        class OnSessionStart(object):
-            def __init__(self):
-                self.pattern = re.compile(r'START')
-
-            def __call__(self, monitor, m):
-                monitor.sessionStarted = True
-
-        class OnSetChange(object):
-            def __init__(self):
-                self.pattern = re.compile(r'SET CHANGE:(.+)')
+    def on_session_completed(self, monitor, m):
+        monitor.sessionComplete = True
 
-            def __call__(self, monitor, m):
-                name = m.group(1)
-                monitor.set_test_set(name)
+    def on_session_init(self, monitor, m):
+        monitor.sessionInited = True
 
-        class OnTestStart(object):
-            def __init__(self):
-                self.pattern = re.compile(r'CASE:(.+)-([0-9]+)$')
+    def on_session_start(self, monitor, m):
+        monitor.sessionStarted = True
 
-            def __call__(self, monitor, m):
-                name, id = m.groups()
-                monitor.set_test_id(name, int(id))
+    def on_set_change(self, monitor, m):
+        monitor.set_test_set(m.group(1))
 
-        class OnTestFinish(object):
-            def __init__(self):
-                self.pattern = re.compile(r'STATUS:(.+)\((.+)-([0-9]+)\)')
+    def on_test_start(self, monitor, m):
+        name, id = m.groups()
+        monitor.set_test_id(name, int(id))
 
-            def __call__(self, monitor, m):
-                status, name, id = m.groups()
-                monitor.set_test_status(name, int(id), status)
+    def on_test_finish(self, monitor, m):
+        status, name, id = m.groups()
+        monitor.set_test_status(name, int(id), status)
 
-        self.commands = [           # in the order of frequency
-            OnTestStart(),
-            OnTestFinish(),
-            OnSetChange(),
-            OnSessionInit(),
-            OnSessionStart(),
-            OnSessionCompleted(),
-        ]
+    def _find_command(self, line):
+        """
+        Return the (pattern, handler) of a status line, None if it is unknown
+        """
+        colon = line.find(':')
+        command = self.commands.get(line[:colon] if colon > 0 else line)
+        if command is None:
+            # e.g. INIT followed by some text
+            for name, cmd in self.commands.items():
+                if line.startswith(name):
+                    return cmd
+        return command
 
     def on_connect(self):
         self.owner.sessionInited = True
@@ -1458,10 +1900,11 @@ class ServerStatusLog(TouchstoneLog):
         # print('========ServerStatus: [{}]'.format(line))
         self.write_log(line)
         monitor = self.owner
-        for cmd in self.commands:
-            m = re.match(cmd.pattern, line)
+        command = self._find_command(line)
+        if command is not None:
+            m = command[0].match(line)
             if m:
-                cmd(monitor, m)
+                command[1](monitor, m)
                 return
         monitor.alert('====UNKNOWN STATUS: [{}]'.format(line))
 
@@ -1523,16 +1966,34 @@ class VerboseLog(TouchstoneLog):
 
 
 class ConsoleLog(TouchstoneLog):
+    BATCH = 1000        # console lines are copied to the booster log in batches, one record per batch
+
     def __init__(self, owner, output_prefix):
         TouchstoneLog.__init__(self, owner, output_prefix + "__console.log")
+        self.lines = []
 
     def on_connect(self):
         self.write_log('\n' * 8)
 
     def action(self, line):
-        logger.debug(line)
+        self.lines.append(line)
+        if len(self.lines) >= self.BATCH:
+            self._log_lines()
         self.write_log(line)
 
+    def _log_lines(self):
+        if self.lines:
+            logger.debug('\n'.join(self.lines))
+            self.lines = []
+
+    def flush(self):
+        self._log_lines()
+        super(ConsoleLog, self).flush()
+
+    def close_log(self):
+        self._log_lines()
+        super(ConsoleLog, self).close_log()
+
 
 class TouchstoneLoggerFactory(object):
     """
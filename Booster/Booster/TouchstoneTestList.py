@@ -1,16 +1,37 @@
 from __future__ import print_function
+"""
+    Run the Touchstone suites of test lists
+
+    With parallel="N", suites run concurrently in N forked worker slots. A slot patches its own copies of the
+    env/suite XML files (next to the originals, so relative paths still resolve) and runs Touchstone in the usual
+    working directory on a port assigned by the kernel. The output prefix, and so the fallback file and the saved
+    core dumps, are in the slot directory test_output/.slot<N>, so that concurrent suites never collide. The slot
+    directory is moved to test_output once a suite is done.
+    The output of each suite is printed once it is finished. An abort stops the slots from starting new suites.
+
+    Parallel suites are scheduled from their duration history (see TouchstoneHistory): recently failed suites
+    first, then longest first. order="file" keeps the order of the test lists, which is the default of sequential
+    runs (e.g. for setup and teardown suites), order="history" reorders them as well.
+"""
 
 import glob
+import multiprocessing
 import os
 import re
+import shutil
+import sys
+import traceback
 
 from collections import namedtuple
 import Copy
 import ReplaceInFile
 import TouchstoneMonitor
+from TouchstoneHistory import TouchstoneHistory
 import ata.log
+from BoosterError import BoosterError, BoosterTagError
 
 logger = ata.log.AtaLog(__name__)
+LOG_DIR = os.path.join('log', 'parallel')
 
 _bamboo_working_directory_cleaned = False
 def CopyTouchstoneOutputToDestination(outdir):
@@ -34,32 +55,208 @@ def CopyTouchstoneOutputToDestination(outdir):
         logger.debug("Copy all files from %s to %s" % (outdir, test_output))
         Copy.copyGlobFiles(outdir + '/*', test_output)
 
-def RunOneTestSuite(envFile, suiteFile, outputPrefix, touchstoneBinary, cwd=None, outdir=None, connectionstring=None, toolPrefix=None, dm_encoding=None, dsLocator=None, isDebug=False):
+def RunOneTestSuite(envFile, suiteFile, outputPrefix, touchstoneBinary, cwd=None, outdir=None, connectionstring=None, toolPrefix=None, dm_encoding=None, dsLocator=None, isDebug=False, slot=None):
     if not os.path.exists(suiteFile):
         return False
         
     cwd = getWorkingDirectory(cwd, touchstoneBinary)
     if outdir is not None:
         outdir = cwd + '/test_output'
-        
+
+    runEnv, runSuite, slotdir = envFile, suiteFile, None
+    if slot is not None and not isDebug:
+        # the originals are shared by the slots, patch private copies instead
+        runEnv, runSuite = getSlotCopy(envFile, slot), getSlotCopy(suiteFile, slot)
+        slotdir = getSlotDirectory(outdir, slot)
+
     if not isDebug:
-        fixDMEncoding(envFile, dm_encoding)
-        fixConnectionString(connectionstring, envFile, suiteFile)
-        fixResultSetsDir(envFile, suiteFile)
-        fixTestSetsDir(suiteFile)
-        setSchemaMapDir(envFile, suiteFile, cwd)
-        setSSLCertificatesDir(envFile, suiteFile, cwd)
-        setDataSourceLocator(envFile, suiteFile, dsLocator)
+        # the helpers return their replacements, so that each file is rewritten only once
+        connection = fixConnectionString(connectionstring) + fixResultSetsDir(suiteFile)
+        locations = setSchemaMapDir(cwd) + setSSLCertificatesDir(cwd) + setDataSourceLocator(dsLocator)
+        ReplaceInFile.replaceMany(runEnv, fixDMEncoding(dm_encoding) + connection + locations)
+        ReplaceInFile.replaceMany(runSuite, connection + fixTestSetsDir(suiteFile) + locations)
         
-    testoutput, log = getOutputPath(outputPrefix, outdir)
+    testoutput, log = getOutputPath(outputPrefix, slotdir or outdir)
     memoryToolPrefix = fixMemoryTestPrefix(toolPrefix, outdir, outputPrefix)
     touchstone = getTouchstoneExeCommand(touchstoneBinary, memoryToolPrefix)
-    abort, abort_reason = runTouchstoneMonitor(touchstone, cwd, envFile, suiteFile, testoutput, isDebug)
+    try:
+        abort, abort_reason = runTouchstoneMonitor(touchstone, cwd, runEnv, runSuite, testoutput, isDebug)
+    finally:
+        if runSuite != suiteFile:
+            os.remove(runEnv)
+            os.remove(runSuite)
+            mergeSlotOutput(slotdir, outdir)
     if abort:
         raise AssertionError(abort_reason)
     
     return True
 
+
+def getSlotCopy(xmlFile, slot):
+    """
+    Copy xmlFile to <name>.slot<slot>.xml in the same directory
+    :return:    the copy
+    """
+    name, ext = os.path.splitext(xmlFile)
+    copy = '{}.slot{}{}'.format(name, slot, ext)
+    shutil.copyfile(xmlFile, copy)
+    return copy
+
+
+def getSlotDirectory(outdir, slot):
+    """
+    Create the output directory of a slot, where the monitor puts the output, fallback file and core dumps
+    """
+    slotdir = os.path.abspath(os.path.join(outdir, '.slot{}'.format(slot)))
+    if not os.path.isdir(slotdir):
+        os.makedirs(slotdir)
+    return slotdir
+
+
+def mergeSlotOutput(slotdir, outdir):
+    """
+    Move everything a suite left in the output directory of its slot to outdir, but the fallback file
+    """
+    for name in os.listdir(slotdir):
+        src = os.path.join(slotdir, name)
+        dst = os.path.join(outdir, name)
+        if name == 'fallback.dat':
+            continue
+        if os.path.isdir(src) and not os.path.islink(src):
+            Copy.copyGlobFiles(src + '/*', dst)
+            shutil.rmtree(src)
+        else:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            shutil.move(src, dst)
+
+
+def getDurationsFile(suiteOutput, outdir):
+    return '{}/{}_durations.json'.format(outdir, suiteOutput)
+
+
+def removeDurationsFile(suiteOutput, outdir):
+    """
+    Remove the durations left by a previous run, so that only the durations of this run are recorded
+    """
+    durations = getDurationsFile(suiteOutput, outdir)
+    if os.path.isfile(durations):
+        os.remove(durations)
+
+
+def getParallel(root):
+    value = root.attrib.get('parallel', '1')
+    try:
+        parallel = int(value)
+    except ValueError:
+        raise BoosterTagError(__name__, 'parallel must be a number of worker slots: ' + value)
+    return max(1, parallel)
+
+
+_slot = None
+_aborted = None
+
+
+def _initSlot(slots, aborted):
+    global _slot, _aborted
+    _slot = slots.get()
+    _aborted = aborted
+
+
+def _runSlotSuite(task):
+    """
+    Run one suite in a pool process with its output redirected to its log
+    :return:    (suiteOutput, found, abort reason, error)
+    """
+    envFile, suiteFile, suiteOutput, args = task
+    if _aborted.is_set():
+        return suiteOutput, None, None, None
+    cwd = os.getcwd()
+    log = os.path.join(LOG_DIR, suiteOutput + '.log')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    try:
+        print('Slot {} runs {}'.format(_slot, suiteFile))
+        removeDurationsFile(suiteOutput, args[2])
+        return suiteOutput, RunOneTestSuite(envFile, suiteFile, suiteOutput, *args, slot=_slot), None, None
+    except AssertionError as err:
+        _aborted.set()
+        return suiteOutput, True, str(err), None
+    except Exception:
+        traceback.print_exc()
+        return suiteOutput, True, None, traceback.format_exc().splitlines()[-1]
+    finally:
+        os.chdir(cwd)       # the monitor changes to its working directory
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+def _dumpLog(suiteOutput):
+    log = os.path.join(LOG_DIR, suiteOutput + '.log')
+    print('------------------------------ [{}] ------------------------------'.format(suiteOutput))
+    try:
+        with open(log, 'r') as fh:
+            for line in fh:
+                sys.stdout.write(line)
+    except IOError as e:
+        logger.warning('cannot read {}: {}'.format(log, e))
+    sys.stdout.flush()
+
+
+def RunTestSuites(suites, parallel, args, history=None):
+    """
+    Run suites on parallel worker slots, a slot takes the next suite as soon as it is free
+    :param suites:      list of (envFile, suiteFile, suiteOutput), in scheduling order
+    :param parallel:    number of worker slots
+    :param args:        the other arguments of RunOneTestSuite, from touchstoneBinary to isDebug
+    :param history:     TouchstoneHistory recording the durations of the suites
+    :return:            None, raise AssertionError if a suite aborted
+    """
+    if not os.path.isdir(LOG_DIR):
+        os.makedirs(LOG_DIR)
+    parallel = min(parallel, len(suites))
+    slots = multiprocessing.Queue()
+    for slot in range(parallel):
+        slots.put(slot + 1)
+    aborted = multiprocessing.Event()
+    logger.info('run {} suites on {} slots'.format(len(suites), parallel))
+    abort_reason = None
+    errors = []
+    pool = multiprocessing.Pool(parallel, _initSlot, (slots, aborted))
+    try:
+        tasks = [(envFile, suiteFile, suiteOutput, args) for envFile, suiteFile, suiteOutput in suites]
+        for suiteOutput, found, abort, error in pool.imap_unordered(_runSlotSuite, tasks, 1):
+            if found is None:
+                logger.info('cancelled: ' + suiteOutput)
+                continue
+            _dumpLog(suiteOutput)
+            if found and not error and history is not None:
+                history.record(suiteOutput, getDurationsFile(suiteOutput, args[2]))
+            if not found:
+                print('Can not find suite of ' + suiteOutput)
+            if abort and abort_reason is None:
+                abort_reason = abort
+            if error:
+                errors.append('{}: {}'.format(suiteOutput, error))
+    finally:
+        pool.close()
+        pool.join()
+        for slotdir in glob.glob(os.path.join(args[2], '.slot*')):
+            shutil.rmtree(slotdir, True)
+    if errors:
+        raise BoosterError(__name__, '\n'.join(errors))
+    if abort_reason is not None:
+        raise AssertionError(abort_reason)
+
 def _doExecute(root, isDebug):
     print('====================================')
     print('      Enter TouchstoneTestList')
@@ -73,6 +270,7 @@ def _doExecute(root, isDebug):
     datasourceLocator = None
     if 'true' == root.find('Locator').attrib.get('enable', 'true'):
         datasourceLocator = root.find('Locator').text
+    parallel = getParallel(root)
     testLists = getTestLists(cwd, root)
     if not testLists:
         print('No test list found')
@@ -80,19 +278,43 @@ def _doExecute(root, isDebug):
         print('Executing testlists:')
         print(testLists)
 
+        suites = []
+        for testListName in testLists:
+            testListFile = cwd + '/Tests/TouchstoneTestLists/' + testListName
+            testfileList = getTestFiles(cwd, testListFile)
+
+            if not testfileList:
+                print('No test file in ' + testListName)
+            suites.extend(testfileList)
+
+        history = TouchstoneHistory(cwd)
+        if root.attrib.get('order', 'history' if parallel > 1 else 'file') == 'history':
+            suites = history.order(suites)
+        args = (touchstoneBinary, cwd, outdir, connectionstring, toolPrefix, dm_encoding, datasourceLocator, isDebug)
         try:
-            for testListName in testLists:
-                testListFile = cwd + '/Tests/TouchstoneTestLists/' + testListName
-                testfileList = getTestFiles(cwd, testListFile)
-
-                if not testfileList:
-                    print('No test file in ' + testListName)
-                else:
-                    for envFile, suiteFile, suiteOutput in testfileList:
-                        if not RunOneTestSuite(envFile, suiteFile, suiteOutput, touchstoneBinary, cwd, outdir, connectionstring, toolPrefix, dm_encoding, datasourceLocator, isDebug):
-                            print('Can not find ' + suiteFile)
+            if parallel > 1 and len(suites) > 1 and not isDebug and hasattr(os, 'fork'):
+                RunTestSuites(suites, parallel, args, history)
+            else:
+                if parallel > 1 and not isDebug and not hasattr(os, 'fork'):
+                    logger.warning('fork is not supported, run suites sequentially')
+                for envFile, suiteFile, suiteOutput in suites:
+                    if not isDebug:
+                        removeDurationsFile(suiteOutput, outdir)
+                    try:
+                        found = RunOneTestSuite(envFile, suiteFile, suiteOutput, *args)
+                    except AssertionError:
+                        # an aborted suite is recorded as failed, its durations are the ones of this run
+                        if not isDebug:
+                            history.record(suiteOutput, getDurationsFile(suiteOutput, outdir))
+                        raise
+                    if not found:
+                        print('Can not find ' + suiteFile)
+                    elif not isDebug:
+                        history.record(suiteOutput, getDurationsFile(suiteOutput, outdir))
         except AssertionError as err:
             print(err)
+        finally:
+            history.save()
 
         if not isDebug:
             CopyTouchstoneOutputToDestination(outdir)
@@ -190,30 +412,31 @@ def getOutputPath(suiteOutput, outputDir):
     return outputName, logPath
 
 
-def fixDMEncoding(file, encoding):
-    if encoding is not None:
-        oldString = '<SqlWCharEncoding>([^<]+)</SqlWCharEncoding>'
-        newString = '<SqlWCharEncoding>' + encoding + '</SqlWCharEncoding>'
-        ReplaceInFile.replace(file, oldString, newString, re_flags=re.IGNORECASE)
+def fixDMEncoding(encoding):
+    if encoding is None:
+        return []
+    oldString = '<SqlWCharEncoding>([^<]+)</SqlWCharEncoding>'
+    newString = '<SqlWCharEncoding>' + encoding + '</SqlWCharEncoding>'
+    return [(oldString, newString, True, re.IGNORECASE)]
 
 
-def fixConnectionString(connectionString, env, suite):
-    if connectionString is not None:
-        oldString = '<ConnectionString>([^<]+)</ConnectionString>'
-        newString = '<ConnectionString>' + connectionString + '</ConnectionString>'
-        ReplaceInFile.replace(env, oldString, newString, re_flags=re.IGNORECASE)
-        ReplaceInFile.replace(suite, oldString, newString, re_flags=re.IGNORECASE)
+def fixConnectionString(connectionString):
+    if connectionString is None:
+        return []
+    oldString = '<ConnectionString>([^<]+)</ConnectionString>'
+    newString = '<ConnectionString>' + connectionString + '</ConnectionString>'
+    return [(oldString, newString, True, re.IGNORECASE)]
 
 
-def fixResultSetsDir(env, suite):
+def fixResultSetsDir(suite):
+    replacements = []
     oldString = '>.*ResultSets/'
     suiteDir = os.path.dirname(suite)
     resultDir = suiteDir + '/ResultSets/'
     newString = '>' + resultDir
     logger.debug('Fixing result set path')
     logger.debug(oldString + ' => ' + newString)
-    ReplaceInFile.replace(env, oldString, newString, 'True')
-    ReplaceInFile.replace(suite, oldString, newString, 'True')
+    replacements.append((oldString, newString, True))
 
     oldString = '>.*ResultSets<'
     suiteDir = os.path.dirname(suite)
@@ -223,8 +446,8 @@ def fixResultSetsDir(env, suite):
     logger.debug('Fixing result set path')
     # print(oldString + ' => ' + newString)
     logger.debug(oldString + ' => ' + newString)
-    ReplaceInFile.replace(env, oldString, newString, 'True')
-    ReplaceInFile.replace(suite, oldString, newString, 'True')
+    replacements.append((oldString, newString, True))
+    return replacements
 
 
 def fixTestSetsDir(suite):
@@ -235,12 +458,13 @@ def fixTestSetsDir(suite):
         newString = 'SetFile="' + testsetsDir
         logger.debug('Fixing result set path')
         logger.debug(oldString + ' => ' + newString)
-        ReplaceInFile.replace(suite, oldString, newString, 'True')
-    else:
-        logger.warning(testsetsDir + ' does not exist, use test sets from Touchstone')
+        return [(oldString, newString, True)]
+    logger.warning(testsetsDir + ' does not exist, use test sets from Touchstone')
+    return []
 
 
-def setDataSourceLocator(env, suite, datasourceLocator):
+def setDataSourceLocator(datasourceLocator):
+    replacements = []
     if datasourceLocator is not None:
         ds_values = datasourceLocator.split(',')
         ds_dict = {}
@@ -248,23 +472,21 @@ def setDataSourceLocator(env, suite, datasourceLocator):
             k, v = value.split("=", 1)
             ds_dict[k] = v
         for key in ds_dict:
-            ReplaceInFile.replace(env, "$(%s)" % key, ds_dict[key])
-            ReplaceInFile.replace(suite, "$(%s)" % key, ds_dict[key])
+            replacements.append(("$(%s)" % key, ds_dict[key]))
             logger.info("replace the key: " + key + " with value: " + ds_dict[key])
+    return replacements
 
 
-def setSchemaMapDir(env, suite, cwd):
+def setSchemaMapDir(cwd):
     SchemaFileDir = cwd + '/Tests/TestDefinitions/SchemaMap'
-    ReplaceInFile.replace(env, "[schemaMapDir]", SchemaFileDir)
-    ReplaceInFile.replace(suite, "[schemaMapDir]", SchemaFileDir)
     logger.info("Set  schemaMapDir:  " + SchemaFileDir)
+    return [("[schemaMapDir]", SchemaFileDir)]
 
 
-def setSSLCertificatesDir(env, suite, cwd):
+def setSSLCertificatesDir(cwd):
     SSLCertificatesDir = cwd + '/Tests'
-    ReplaceInFile.replace(env, "[SSLDir]", SSLCertificatesDir)
-    ReplaceInFile.replace(suite, "[SSLDir]", SSLCertificatesDir)
     logger.info("Set  SSLCertificatesDir:  " + SSLCertificatesDir)
+    return [("[SSLDir]", SSLCertificatesDir)]
 
 
 def runTouchstoneMonitor(touchstone, cwd, env, suite, output, isDebug):
@@ -88,6 +88,114 @@ def _rep_pattern(v, pat, r, raiseUnknown=False):
     return v
 
 
+# $(name), where name may carry one level of parentheses, e.g. $(PROGRAMFILES(X86))
+p3 = re.compile(r'\$\(((?:[^()]|\([^()]*\))+)\)')
+
+
+class MacroExpander(object):
+    """
+    Single pass $(name) expander
+
+    Every text/attribute is tokenized once for $(name) references, and each name is resolved against a list of
+    layers (dictionaries), the first layer defining the name wins. Resolved values are expanded recursively
+    with the same layers and memoized, so the cost grows with the document size, not with the number of variables.
+    References that cannot be resolved are left untouched so that a later pass can pick them up.
+
+    """
+    def __init__(self, *layers):
+        """
+        Constructor
+        :param layers:      dictionaries of name/value, in the order of precedence. None is ignored
+        """
+        self.layers = [l for l in layers if l is not None]
+        self._cache = {}
+        self._resolving = set()
+
+    def lookup(self, name):
+        """
+        Return the fully expanded value of name, or None if no layer defines it
+        :param name:        name of the variable, without $( )
+        :return:            expanded value or None
+        """
+        if name in self._cache:
+            return self._cache[name]
+        if name in self._resolving:
+            return None         # circular reference, leave it as is
+        for layer in self.layers:
+            if name in layer:
+                value = layer[name]
+                break
+        else:
+            return None
+        if value is None:
+            return None
+        self._resolving.add(name)
+        try:
+            value = self.expand(value)
+        finally:
+            self._resolving.discard(name)
+        self._cache[name] = value
+        return value
+
+    def _sub(self, m):
+        value = self.lookup(m.group(1))
+        return m.group(0) if value is None else value
+
+    def expand(self, s):
+        """
+        Expand all $(name) references in a string
+        :param s:           input string, None is returned as is
+        :return:            expanded string
+        """
+        if not s or '$(' not in s:
+            return s
+        return p3.sub(self._sub, s)
+
+    def expandTree(self, root):
+        """
+        Expand text and attributes of every element in a tree in one traversal
+        :param root:        ElementTree element
+        :return:            root
+        """
+        for element in root.iter():
+            element.text = self.expand(element.text)
+            for key in element.attrib:
+                value = element.attrib[key]
+                if '$(' in value:
+                    element.attrib[key] = self.expand(value)
+        return root
+
+
+def tree2dict(root):
+    """
+    Collect tag/text of a tree as a dictionary, the first element of the same tag wins
+    :param root:        ElementTree element
+    :return:            dictionary
+    """
+    d = {}
+    for element in root.iter():
+        if element.text is not None and element.tag not in d:
+            d[element.tag] = element.text
+    return d
+
+
+def env2dict(environ=None):
+    """
+    Collect environment variables as a dictionary of macro names, BOOSTER_VAR_name is exposed as name.
+    The first environment variable mapping to the same name wins
+    :param environ:     environment to collect, default is os.environ
+    :return:            dictionary
+    """
+    if environ is None:
+        environ = os.environ
+    d = {}
+    for key in environ.keys():
+        name = key.replace('BOOSTER_VAR_', '') if 'BOOSTER_VAR_' in key else key
+        if name not in d:
+            d[name] = environ[key]
+    return d
+
+
 
 class VarMgr(object):
     """
@@ -136,6 +244,15 @@ class VarMgr(object):
         return _varDict[name]['value'] if name in _varDict else fallback
 
 
+    def snapshot(self):
+        """
+        Return a copy of all "current" variables
+        :return:            dictionary of name: (value, source)
+        """
+        global _varDict
+        return dict((name, (_varDict[name]['value'], _varDict[name]['source'])) for name in _varDict)
+
+
     def dumpAll(self, withSource=True):
         """
         Dump all "current" variables, ordered in name
@@ -1,12 +1,16 @@
 from __future__ import print_function
+"""
+    <Zip dest="build.zip" exclude_root="false" reproducible="false" [password="..."] workers="8">dir</Zip>
+
+    reproducible="true" sets the timestamp of every entry to SOURCE_DATE_EPOCH (default 1980-01-01), entries keep
+    the modification time of their file otherwise, see Archive
+"""
 import os
-import zipfile
+import Archive
 import Command
+import Parallel
 import ata.log
 
-from contextlib import contextmanager
-from shutil import make_archive
-
 logger = ata.log.AtaLog(__name__)
 
 def Execute(root):
@@ -23,10 +27,8 @@ def Execute(root):
         raise Exception('{} does not exist'.format(file))
         # exit(-1)
     print('Create ' + archive + '.zip from ' + file)
-    if (exclude_root == 'true') :
-        createZip(archive, file, password, True)
-    else:
-        createZip(archive, file, password)
+    createZip(archive, file, password, exclude_root == 'true', Parallel.getWorkers(root),
+              root.attrib.get('reproducible', 'false') == 'true')
 
 
 def Debug(root):
@@ -50,37 +52,22 @@ def getSource(root):
     return sourceDir
 
 
-def getPassword(root):
-    password = root.attrib.get('password', 'undef')
-    return password
+def getInputs(root):
+    return [getSource(root)]
 
 
-def createZip64(archiveName, source, exclude_root=False):
-    if (exclude_root):
-        lenDirPath = len(source)
-    else:
-        lenDirPath = len(os.path.dirname(source))
+def getOutputs(root):
+    return [getDest(root) + '.zip']
 
-    with zipfile.ZipFile(archiveName + '.zip', 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
-        for root, dirs, files in os.walk(source):
-            for file in files:
-                filePath = os.path.join(root, file)
-                zf.write(filePath, filePath[lenDirPath:])
-    zf.close()
 
+def getPassword(root):
+    password = root.attrib.get('password', 'undef')
+    return password
 
-def createZip(archiveName, source, password, exclude_root=False):
+
+def createZip(archiveName, source, password='undef', exclude_root=False, workers=1, reproducible=False):
     if password == 'undef':
-        try:
-            if (exclude_root):
-                make_archive(archiveName, 'zip', source)
-            else:
-                rootDir = os.path.dirname(source)
-                if (rootDir == ''): rootDir = './'
-                baseDir = os.path.basename(source)
-                make_archive(archiveName, 'zip', rootDir, baseDir)
-        except:
-            createZip64(archiveName, source, exclude_root)
+        Archive.createZip(archiveName + '.zip', source, exclude_root, workers, reproducible)
 
     else:
         outputzip = archiveName + '.zip'
@@ -1,6 +1,8 @@
 import os
+import ActionRegistry
+# action modules are imported on first use, see ActionRegistry
 for module in os.listdir(os.path.dirname(__file__)):
     if module == '__init__.py' or module[-3:] != '.py':
         continue
-    __import__(module[:-3], locals(), globals())
-del module
\ No newline at end of file
+    ActionRegistry.registerLazy(module[:-3], __name__ + '.' + module[:-3])
+del module
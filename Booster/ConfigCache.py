@@ -0,0 +1,261 @@
+"""
+On-disk cache of expanded build files
+
+init.setBuildFile parses a config file, filters it on plan settings, expands its variables and recursively does the
+same for every imported file, writing the results into build/. A cache entry keeps those expanded files together with
+the side effects of the expansion (environment variables, booster variables, plan settings), and it is valid as long
+as the content of the source file and all of its transitive imports, and the values of the variables they actually
+reference, are unchanged. A warm agent can then skip the expansion entirely.
+
+The cache is disabled by the --no-config-cache option of booster.py, by environment BOOSTER_NO_CONFIG_CACHE=1
+(or bamboo variable no_config_cache=1), or by DEBUG_SKIP=configcache.
+"""
+from __future__ import print_function
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import uuid
+
+import AtaUtil
+import ata.log
+import Booster.Var as Var
+from Booster.Debug import Debug as Debugger
+
+logger = ata.log.AtaLog(__name__)
+
+CACHE_VERSION = 1
+_tagPattern = re.compile(r'<([\w.\-]+)')
+_recorder = None
+
+
+def isEnabled():
+    """
+    Return True unless the config cache is turned off
+    """
+    for key in ('BOOSTER_NO_CONFIG_CACHE', 'BAMBOO_NO_CONFIG_CACHE'):
+        if os.environ.get(key, '0').strip().lower() in ('1', 'true'):
+            return False
+    return not Debugger().skip('configcache')
+
+
+def disable():
+    """
+    Turn off the config cache for this run and its child processes
+    """
+    os.environ['BOOSTER_NO_CONFIG_CACHE'] = '1'
+
+
+def recordInput(fname):
+    """
+    Called for every source file that an expansion depends on. A file that doesn't exist is recorded as well,
+    so that the entry is invalidated once the file shows up
+    """
+    if _recorder is not None:
+        _recorder.inputs[os.path.abspath(fname)] = _fileHash(fname)
+
+
+def recordOutput(fname):
+    """
+    Called for every build file written by an expansion
+    """
+    if _recorder is not None and fname not in _recorder.outputs:
+        _recorder.outputs.append(fname)
+
+
+def lookup(file, settings, dependencies, output):
+    """
+    Return the cache entry for an expansion, or None if the cache is disabled, or this is a nested expansion
+    """
+    if _recorder is not None or not os.path.isfile(file) or not isEnabled():
+        return None
+    try:
+        return ConfigCache(file, settings, dependencies, output)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        logger.warning('config cache is not available: {}'.format(e))
+        return None
+
+
+def _fileHash(fname):
+    if not os.path.isfile(fname):
+        return None
+    h = hashlib.sha1()
+    with open(fname, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _versionVariables(environ):
+    # importVersion reads all BAMBOO_*_VERSION variables
+    return dict((k, environ[k]) for k in environ.keys()
+                if k.startswith('BAMBOO_') and k.endswith('_VERSION') and 'CAPABILITY' not in k)
+
+
+def _str(s):
+    # json gives unicode in python 2, environment wants str
+    if sys.version_info[0] < 3 and isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+class ConfigCache(object):
+    """
+    Cache entry of one top level setBuildFile call
+
+    Usage:
+        cache = lookup(file, settings, dependencies, output)
+        if cache is None or not cache.replay():
+            ... expand, calling recordInput/recordOutput, between cache.start() and cache.store()
+
+    """
+    def __init__(self, file, settings, dependencies, output):
+        self.file = file
+        self.settings = settings
+        self.inputs = {}
+        self.outputs = []
+        key = json.dumps([CACHE_VERSION, os.getcwd(), os.path.abspath(file), _fileHash(file), output,
+                          sorted(settings.items()), sorted(dependencies.items())])
+        self.key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.path = os.path.join(AtaUtil.get_cache_dir('config'), self.key)
+        self._seeds = list(settings.values()) + list(dependencies.values())
+        self._environ = None
+        self._vars = None
+        self._settings = None
+
+    def _load(self):
+        manifest = os.path.join(self.path, 'manifest.json')
+        if not os.path.isfile(manifest):
+            return None
+        with open(manifest, 'r') as fh:
+            m = json.load(fh)
+        if m.get('version') != CACHE_VERSION:
+            return None
+        for fname in m['inputs']:
+            if _fileHash(fname) != m['inputs'][fname]:
+                return None
+        env = Var.env2dict()
+        for name in m['variables']:
+            if env.get(name) != m['variables'][name]:
+                return None
+        for key in m['environ']:
+            if os.environ.get(key) != m['environ'][key]:
+                return None
+        if _versionVariables(os.environ) != m['versions']:
+            return None
+        for i in range(len(m['outputs'])):
+            if not os.path.isfile(os.path.join(self.path, '{}.xml'.format(i))):
+                return None
+        return m
+
+    def replay(self):
+        """
+        Restore the build files and the side effects of a previous expansion
+        :return:        True on a cache hit, False if the expansion has to be done
+        """
+        try:
+            m = self._load()
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('config cache entry {} is corrupted: {}'.format(self.key, e))
+            m = None
+        if m is None:
+            logger.info('config cache miss: ' + self.file)
+            return False
+        for i, out in enumerate(m['outputs']):
+            out = _str(out)
+            d = os.path.dirname(out)
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+            shutil.copyfile(os.path.join(self.path, '{}.xml'.format(i)), out)
+        for key in m['setenv']:
+            os.environ[_str(key)] = _str(m['setenv'][key])
+        vm = Var.VarMgr()
+        for name, value, source in m['varmgr']:
+            vm.add(_str(name), _str(value), _str(source))
+        for key in m['settings']:
+            self.settings[_str(key)] = _str(m['settings'][key])
+        logger.info('config cache hit: ' + self.file)
+        return True
+
+    def start(self):
+        """
+        Start recording an expansion
+        """
+        global _recorder
+        self._environ = dict(os.environ)
+        self._vars = Var.VarMgr().snapshot()
+        self._settings = dict(self.settings)
+        _recorder = self
+
+    def stop(self):
+        """
+        Stop recording, it is safe to call it more than once
+        """
+        global _recorder
+        if _recorder is self:
+            _recorder = None
+
+    def _references(self):
+        # names referenced as $(name) by the source files, then by the values they resolve to
+        env = Var.env2dict(self._environ)
+        texts = list(self._seeds)
+        tags = set()
+        for fname in self.inputs:
+            if self.inputs[fname] is None:
+                continue
+            with open(fname, 'rb') as fh:
+                text = fh.read().decode('utf-8', 'replace')
+            if '__latest__' in text:
+                return None, None       # latest labels are resolved from perforce, never cache them
+            texts.append(text)
+            tags.update(_tagPattern.findall(text))
+        names = set()
+        while texts:
+            for name in Var.p3.findall(texts.pop()):
+                if name not in names:
+                    names.add(name)
+                    if env.get(name):
+                        texts.append(env[name])
+        variables = dict((name, env.get(name)) for name in names)
+        environ = dict(('BAMBOO_' + tag, self._environ.get('BAMBOO_' + tag)) for tag in tags)
+        return variables, environ
+
+    def store(self):
+        """
+        Stop recording and save the expansion as a cache entry
+        """
+        self.stop()
+        try:
+            variables, environ = self._references()
+            if variables is None:
+                return
+            current = Var.VarMgr().snapshot()
+            m = {
+                'version': CACHE_VERSION,
+                'file': os.path.abspath(self.file),
+                'inputs': self.inputs,
+                'variables': variables,
+                'environ': environ,
+                'versions': _versionVariables(self._environ),
+                'outputs': self.outputs,
+                'setenv': dict((k, os.environ[k]) for k in os.environ.keys() if self._environ.get(k) != os.environ[k]),
+                'varmgr': [[n, current[n][0], current[n][1]] for n in current if self._vars.get(n) != current[n]],
+                'settings': dict((k, self.settings[k]) for k in self.settings if self._settings.get(k) != self.settings[k]),
+            }
+            tmp = '{}.{}'.format(self.path, uuid.uuid4().hex)
+            os.makedirs(tmp)
+            try:
+                for i, out in enumerate(self.outputs):
+                    shutil.copyfile(out, os.path.join(tmp, '{}.xml'.format(i)))
+                with open(os.path.join(tmp, 'manifest.json'), 'w') as fh:
+                    json.dump(m, fh, indent=1, sort_keys=True)
+                if os.path.isdir(self.path):
+                    shutil.rmtree(self.path, ignore_errors=True)
+                os.rename(tmp, self.path)
+            finally:
+                if os.path.isdir(tmp):
+                    shutil.rmtree(tmp, ignore_errors=True)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            logger.warning('failed to save config cache for {}: {}'.format(self.file, e))
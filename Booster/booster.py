@@ -9,6 +9,7 @@ import traceback
 import AtaUtil
 import Booster.Command as Command
 import Booster.Var as Var
+import ConfigCache
 import ata.log
 import build
 import init
@@ -28,11 +29,14 @@ def main(argv):
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-e', '--env', type=str, help='loadable environment, usually for debug purpose or simulation')
+    parser.add_argument('--no-config-cache', action='store_true', help='always expand config files, bypass the config cache')
     parser.add_argument('file', type=str, nargs='?', help='substituted config file')
     args = parser.parse_args()
     if args.env is not None:
         extra = Var.file2dict(args.env)
         os.environ.update(extra)
+    if args.no_config_cache:
+        ConfigCache.disable()
 
     logger.info(whatis)
     if args.file is None:
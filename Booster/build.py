@@ -7,11 +7,15 @@ from __future__ import print_function
 import glob
 import os
 import os.path
+import time
 import weakref
 import xml.etree.ElementTree as ET
 from Booster.XMLFile import XMLFile
 
 import Booster
+from Booster import ActionRegistry
+from Booster import Incremental
+from Booster import Parallel
 import ata.log
 logger = ata.log.AtaLog(__name__)
 from Booster.Debug import Debug as Debugger
@@ -30,15 +34,37 @@ def skipnode(e):
 def Execute(configfile):
     #print('Start executing all build files')
     logger.info('Start executing all build files')
+    loadActions(configfile)
     process(configfile)
     #print('Finish executing all build files')
     logger.info('Finish executing all build files')
     #createArtifacts()
 
+# Import the action modules used by a build file and its imports, and report their import cost
+def loadActions(file):
+    tags = set()
+    collectTags(file, tags)
+    start = time.time()
+    ActionRegistry.preload(tags)
+    logger.info('=========== action modules loaded in {:.3f}s ============'.format(time.time() - start))
+    for module, seconds in ActionRegistry.importCost():
+        logger.info('{:.3f}s {}'.format(seconds, module))
+
+
+def collectTags(file, tags):
+    xml = XMLFile(file)
+    for element in xml.iter():
+        if (element.tag == 'Import'):
+            collectTags(element.text, tags)
+        else:
+            tags.add(element.tag)
+
+
 # Start executing all the actions defined in build file in sequence
 def process(file):
     xml = XMLFile(file)
     dbg = Debugger()
+    grouped = []        # actions already run by a parallel group
     logger.info('--Enter ' + os.path.basename(file) + '--')
     for element in xml.iter():
         if (element.tag == 'Import'):
@@ -47,6 +73,7 @@ def process(file):
             continue
 
         if skipnode(element): continue
+        if Parallel.isParallelChild(element): continue
 
         if element.tag == 'Debug':
             # TODO - insert Debug tag
@@ -55,20 +82,26 @@ def process(file):
                 d.dumpAll()
                 d.dumpOverride()
 
-        module_name = 'Booster.' + element.tag
+        action = ActionRegistry.lookup(element.tag)
+        if action is None:
+            continue        # not an action, e.g. children of an action or variables
+        if 'group' in element.attrib:
+            if element in grouped: continue
+            members = Parallel.groupMembers(element)
+            grouped.extend(members)
+            Parallel.run(members, Parallel.getWorkers(element), dry='BOOSTERDEBUG' in os.environ)
+            continue
         brk = element.attrib.get('break', '')
         if brk.lower() == 'true':
             pass
-        try:
-            if dbg.trace('var'):
-                print('+++++ process: {}:{} ....'.format(file, element.tag))
-            if ('BOOSTERDEBUG' in os.environ):
-                eval(module_name + '.Debug')(element)
-            else:
-                eval(module_name + '.Execute')(element)
-                pass # just a breakpoint holder
-        except (AttributeError, SyntaxError):
-            continue
+        if dbg.trace('var'):
+            print('+++++ process: {}:{} ....'.format(file, element.tag))
+        if ('BOOSTERDEBUG' in os.environ):
+            if action.debug is not None:
+                action.debug(element)
+        elif action.execute is not None:
+            Incremental.executeAction(action, element)
+            pass # just a breakpoint holder
 
 
 def createArtifacts():
@@ -80,7 +113,8 @@ def createArtifacts():
     #    newFileName = file + '.xml'
     #    os.rename(file, newFileName)
     # Zip up log
-    Booster.Zip.createZip('log', logDir)
+    from Booster import Zip
+    Zip.createZip('log', logDir)
 
 
 
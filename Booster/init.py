@@ -12,8 +12,14 @@ import xml.etree.ElementTree as ET
 import socket
 
 import errno
+import hashlib
+import json
+import time
+import uuid
 
 from Booster import Command
+import AtaUtil
+import ConfigCache
 import ata.log
 from Booster.Var import VarMgr
 from Booster.Debug import Debug as Debugger
@@ -29,6 +35,12 @@ from Booster.Remove import removeSingleFile
 logger = ata.log.AtaLog(__name__)
 BOOSTER_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# config files synced from perforce by this run, file -> (long label, local file); every label of a file is
+# synced to the same local file, so only the label synced last is remembered
+_syncedConfigFiles = {}
+# latest labels resolved by this run, see getLatestLabel
+_latestLabels = {}
+
 
 def ExecuteInputFile(configfile):
     logger.info('=========== Executing ============')
@@ -41,6 +53,7 @@ def ExecuteInputFile(configfile):
     fileBaseNme = os.path.basename(configfile)
     buildFile = 'build/' + fileBaseNme
     dependencySettings = {}
+    prefetchConfigFiles(configfile, planSettings, dependencySettings)
     dependencySettings = getDependencyFiles(configfile, planSettings, dependencySettings)
     compilersettings = initCompilerSettings(planSettings)
     setBuildFile(configfile, planSettings, dependencySettings, buildFile)
@@ -65,6 +78,7 @@ def ExecuteTask(configfile):
     parent_dir = os.path.basename(os.path.abspath(os.path.join(configfile, os.pardir)))
     buildFile = 'build/' + parent_dir + '/' + fileBaseNme
     dependencySettings = {}
+    prefetchConfigFiles(configfile, planSettings, dependencySettings)
     dependencySettings = getDependencyFiles(configfile, planSettings, dependencySettings)
     setBuildFile(configfile, planSettings, dependencySettings)
     return buildFile
@@ -103,6 +117,7 @@ def ExecuteBambooBuild():
     parent_dir = os.path.basename(os.path.abspath(os.path.join(configfile, os.pardir)))
     buildFile = 'build/' + parent_dir + '/' + fileBaseNme
     dependencySettings = {}
+    prefetchConfigFiles(configfile, planSettings, dependencySettings)
     dependencySettings = getDependencyFiles(configfile, planSettings, dependencySettings)
     compilersettings = initCompilerSettings(planSettings)
     setBuildFile(configfile, planSettings, dependencySettings)
@@ -462,19 +477,12 @@ def setP4Root():
 
 def getDependencyFiles(file, planSettings, dependencySettings):
     try:
-        xml = XMLFile(file)
+        root = getDependencyRoot(file, planSettings)
     except Exception as e:
         # print('Failed to parse ' + file)
         logger.info('Failed to parse ' + file)
         logger.error(e)
         exit(-1)
-    root = xml.root()
-
-    # filter on build settings
-    for key in planSettings.keys():
-        value = str(planSettings[key])
-        root = includeAttrib(root, key, value)
-        root = excludeAttrib(root, 'skip_' + key, value)
 
     upperCasePlanSettings = upperDictKeys(planSettings)
     for element in root.iter():
@@ -504,11 +512,70 @@ def getDependencyFiles(file, planSettings, dependencySettings):
     return dependencySettings
 
 
-def syncConfigFile(file, labelname):
-    propsfileview = '//' + file
+def getDependencyRoot(file, planSettings):
+    """
+    Parse a config file and filter it on plan settings
+    """
+    root = XMLFile(file).root()
+    for key in planSettings.keys():
+        value = str(planSettings[key])
+        root = includeAttrib(root, key, value)
+        root = excludeAttrib(root, 'skip_' + key, value)
+    return root
+
+
+def prefetchConfigFiles(file, planSettings, dependencySettings):
+    """
+    Sync the props and import files that getDependencyFiles loads from perforce, all files known at a time in one
+    batch, so that the number of p4 commands grows with the depth of the imports, not with the number of files.
+    Variables defined by props files are guessed from the files synced so far: a path that doesn't resolve, or
+    resolves to another file in getDependencyFiles, is synced there by syncConfigFile
+    """
+    upperCasePlanSettings = upperDictKeys(planSettings)
+    settings = dict(dependencySettings)
     p4root = os.environ.get('BAMBOO_AGENTWORKINGDIRECTORY', os.environ.get('P4ROOT', 'undef'))
-    propsfile = os.path.join(p4root, file)
-    removeSingleFile(propsfile)
+    files = [file]
+    props = []
+    seen = set()
+    while True:
+        batch = []
+        for fname in files:
+            try:
+                root = getDependencyRoot(fname, planSettings)
+            except Exception:
+                continue        # reported by getDependencyFiles
+            for element in root.iter():
+                if element.tag not in ('Props', 'Import') or not element.text:
+                    continue
+                path = substituteInString(element.text, upperCasePlanSettings)
+                path = substituteInString(path, settings)
+                if '$(' in path or (element.tag, path) in seen:
+                    continue
+                seen.add((element.tag, path))
+                if element.tag == 'Props':
+                    batch.append((path, element.attrib.get('label', 'default'), props))
+                elif os.path.exists(os.path.join(BOOSTER_DIR, path)):
+                    files.append(os.path.join(BOOSTER_DIR, path))
+                elif os.path.exists(os.path.join(p4root, path)):
+                    files.append(os.path.join(p4root, path))
+                else:
+                    batch.append((path, 'default', files))
+        if not batch:
+            return
+        synced = syncConfigFiles([(path, label) for path, label, found in batch])
+        for (path, label, found), local in zip(batch, synced):
+            if local is not None and os.path.isfile(local):
+                found.append(local)
+        # first file defining a variable wins, as in getDependencyFiles
+        for propsfile in props:
+            for key, value in parsePropsFile(propsfile).items():
+                settings.setdefault(key, value)
+
+
+def getConfigLabel(labelname):
+    """
+    :return:    long label of a config file, e.g. head__CL123
+    """
     if labelname == 'default':
         labelname = os.environ.get('BAMBOO_PRODUCT_LABEL')
         longlabel = os.environ.get(labelname)
@@ -516,15 +583,77 @@ def syncConfigFile(file, labelname):
         longlabel = os.environ.get(labelname)
     longlabel = longlabel.replace('__head__CL', 'head__CL')
     longlabel = longlabel.replace('__head__', 'head')
+    return longlabel
+
+
+def syncConfigFile(file, labelname):
+    propsfileview = '//' + file
+    p4root = os.environ.get('BAMBOO_AGENTWORKINGDIRECTORY', os.environ.get('P4ROOT', 'undef'))
+    propsfile = os.path.join(p4root, file)
+    longlabel = getConfigLabel(labelname)
+    if _syncedConfigFile(file, longlabel):
+        return _syncedConfigFile(file, longlabel)
+    removeSingleFile(propsfile)
     logger.info('== Load file ' + propsfile + ' from ' + longlabel + ' ==')
     (label, changelists) = P4Sync.parseLabel(longlabel)
     p4 = P4Sync.getP4Exe()
     P4Sync.sync(p4, propsfileview, label)
     for cl in changelists:
         P4Sync.unshelvedepot(p4, cl, propsfileview)
+    _syncedConfigFiles[file] = (longlabel, propsfile)
     return propsfile
 
 
+def _syncedConfigFile(file, longlabel):
+    """
+    Return the local file if file was synced from longlabel by this run, None otherwise
+    """
+    synced = _syncedConfigFiles.get(file)
+    if synced is not None and synced[0] == longlabel:
+        return synced[1]
+    return None
+
+
+def syncConfigFiles(files):
+    """
+    Sync config files from perforce like syncConfigFile, with one p4 command per step for all of them
+    :param files:   list of (file, label name), file being a depot path without the leading //
+    :return:        list of the local files, None for the files not synced (all of them if the batch failed)
+    """
+    p4root = os.environ.get('BAMBOO_AGENTWORKINGDIRECTORY', os.environ.get('P4ROOT', 'undef'))
+    batch = {}
+    revisions = []
+    shelves = {}
+    for file, labelname in files:
+        longlabel = getConfigLabel(labelname)
+        if _syncedConfigFile(file, longlabel) or file in batch:
+            continue
+        batch[file] = longlabel
+        propsfile = os.path.join(p4root, file)
+        removeSingleFile(propsfile)
+        logger.info('== Load file ' + propsfile + ' from ' + longlabel + ' ==')
+        (label, changelists) = P4Sync.parseLabel(longlabel)
+        revisions.append(('//' + file, label))
+        for cl in changelists:
+            shelves.setdefault(cl, []).append('//' + file)
+    synced = True
+    if revisions:
+        p4 = P4Sync.getP4Exe()
+        try:
+            P4Sync.syncBatch(p4, revisions)
+            for cl in sorted(shelves):
+                P4Sync.unshelveBatch(p4, cl, shelves[cl])
+        except Exception as e:
+            # e.g. a guessed path that doesn't exist, the files not synced are synced one by one later
+            logger.warning('batch sync of {} config files failed: {}'.format(len(revisions), e))
+            synced = False
+    if synced:
+        # only once every step succeeded: a file missing its shelved changes is synced again by syncConfigFile
+        for file, longlabel in batch.items():
+            _syncedConfigFiles[file] = (longlabel, os.path.join(p4root, file))
+    return [_syncedConfigFile(file, getConfigLabel(labelname)) for file, labelname in files]
+
+
 def getImportFile(file, optional):
     p4root = os.environ.get('BAMBOO_AGENTWORKINGDIRECTORY', os.environ.get('P4ROOT', 'undef'))
     if os.path.exists(os.path.join(BOOSTER_DIR, file)):
@@ -1236,8 +1365,23 @@ def removeUndefSettingKey(settingsDict):
             del settingsDict[key]
 
 
-# Generating build process from the input file
+# Generating build process from the input file, reuse the cached result if its inputs are unchanged
 def setBuildFile(file, settings, dependencies, output='default'):
+    cache = ConfigCache.lookup(file, settings, dependencies, output)
+    if cache is None:
+        expandBuildFile(file, settings, dependencies, output)
+        return
+    if cache.replay():
+        return
+    cache.start()
+    try:
+        expandBuildFile(file, settings, dependencies, output)
+        cache.store()
+    finally:
+        cache.stop()
+
+
+def expandBuildFile(file, settings, dependencies, output='default'):
     upperCasePlanSettings = upperDictKeys(settings)
     try:
         xml = XMLFile(file)
@@ -1246,6 +1390,7 @@ def setBuildFile(file, settings, dependencies, output='default'):
         logger.info('Failed to parse ' + file)
         logger.error(e)
         exit(-1)
+    ConfigCache.recordInput(file)
 
     root = xml.root()
     if output == 'default':
@@ -1278,12 +1423,8 @@ def setBuildFile(file, settings, dependencies, output='default'):
     root = removeEmptyNode(root)
 
 
-    # import dependencies
-    root = importDict(root, dependencies)
-
-
-    # substitute variables defined in current build file first
-    root = substituteTree(root, root)
+    # import dependencies, then substitute variables defined in current build file, in one traversal
+    root = Var.MacroExpander(dependencies, Var.tree2dict(root)).expandTree(root)
 
     # import config files
     remove_nodes = []
@@ -1301,6 +1442,7 @@ def setBuildFile(file, settings, dependencies, output='default'):
                 element.text = 'build/' + parent_dir + '/' + importFileBaseName
             else:
                 logger.info('optional import file {name} not exist'.format(name=element.text))
+                ConfigCache.recordInput(os.path.join(BOOSTER_DIR, importfile))
                 remove_nodes.append(element)    # not reliable to remove at iterating
     for e in remove_nodes:
         p = e.parent
@@ -1338,6 +1480,7 @@ def setBuildFile(file, settings, dependencies, output='default'):
                 raise
     with open(buildFile, 'w'):
         xml.tree().write(buildFile)
+    ConfigCache.recordOutput(buildFile)
 
 
 def setCompilerSettings(file, planSettings, dependencySettings):
@@ -1430,13 +1573,7 @@ def excludeAttrib(root, key, value):
 # get value of all variables from input tree
 # set value for all variables in base tree
 def substituteTree(inputRoot, baseRoot):
-    for element in inputRoot.iter():
-        varName = element.tag
-        varValue = element.text
-        oldString = '$(' + varName + ')'
-        newString = varValue
-        substituteOne(oldString, newString, baseRoot)
-    return baseRoot
+    return Var.MacroExpander(Var.tree2dict(inputRoot)).expandTree(baseRoot)
 
 
 # substitute one variable in a tree
@@ -1455,17 +1592,7 @@ def substituteOne(varName, varValue, root):
 
 # substitude variables in a string recursively
 def substituteInString(inString, inVariables):
-    flag = 0
-    outString = inString
-    for key in inVariables.keys():
-        varName = '$(' + key + ')'
-        if varName in inString:
-            outString = inString.replace(varName, inVariables[key])
-            flag =1
-    if flag == 1:
-        return substituteInString(outString, inVariables)
-    else:
-        return outString
+    return Var.MacroExpander(inVariables).expand(inString)
 
 
 
@@ -1480,25 +1607,12 @@ def importFile(importFile, baseRoot, settings, dict):
 
 # import env variables
 def importEnv(root):
-    for key in os.environ.keys():
-        value = os.environ[key]
-        if 'BOOSTER_VAR_' in key:
-            oldString = '$(' + key.replace('BOOSTER_VAR_','') + ')'
-        else:
-            oldString = '$(' + key + ')'
-        newString = value
-        substituteOne(oldString, newString, root)
-    return root
+    return Var.MacroExpander(Var.env2dict()).expandTree(root)
 
 
 # import dictionary
 def importDict(root, dict):
-    for key in dict.keys():
-        value = dict[key]
-        oldString = '$(' + key + ')'
-        newString = value
-        substituteOne(oldString, newString, root)
-    return root
+    return Var.MacroExpander(dict).expandTree(root)
 
 
 # If a customized bamboo variable is set, override the default value
@@ -1541,8 +1655,61 @@ def importLatestLabals(root):
     return root
 
 
-# Find latest label
+# Find latest label, once per run for a prefix (and across runs with BOOSTER_LABEL_CACHE_TTL)
 def getLatestLabel(node):
+    key = [node.attrib.get('prefix', 'undef'), node.attrib.get('p4port', os.environ.get('P4PORT')),
+           node.attrib.get('p4user'), node.attrib.get('path')]
+    name = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+    if name not in _latestLabels:
+        label = loadLatestLabel(name)
+        if label is None:
+            label = queryLatestLabel(node)
+            saveLatestLabel(name, key, label)
+        _latestLabels[name] = label
+    return _latestLabels[name]
+
+
+def getLabelCacheTTL():
+    """
+    :return:    seconds a latest label is reused by later runs, 0 (default) to query perforce every run
+    """
+    try:
+        return int(os.environ.get('BOOSTER_LABEL_CACHE_TTL', os.environ.get('BAMBOO_LABEL_CACHE_TTL', '0')))
+    except ValueError:
+        return 0
+
+
+def loadLatestLabel(name):
+    ttl = getLabelCacheTTL()
+    if ttl <= 0:
+        return None
+    try:
+        with open(os.path.join(AtaUtil.get_cache_dir('labels'), name + '.json'), 'r') as fh:
+            entry = json.load(fh)
+        if time.time() - entry['time'] > ttl:
+            return None
+        logger.info('latest label of {} from cache: {}'.format(entry['key'][0], entry['label']))
+        return str(entry['label'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def saveLatestLabel(name, key, label):
+    if getLabelCacheTTL() <= 0:
+        return
+    try:
+        path = os.path.join(AtaUtil.get_cache_dir('labels'), name + '.json')
+        tmp = '{}.{}'.format(path, uuid.uuid4().hex)
+        with open(tmp, 'w') as fh:
+            json.dump({'key': key, 'label': label, 'time': time.time()}, fh)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logger.warning('failed to cache latest label {}: {}'.format(label, e))
+
+
+def queryLatestLabel(node):
     label = node.attrib.get('prefix', 'undef') + '*'
     if platform.system() == 'Windows':
         label = '"' + label + '"'